@@ -1,12 +1,13 @@
 from __future__ import print_function
+# Importing the package requires only NumPy : matplotlib is imported when a plot is made and scipy when the cholesky solver is used
+# (see benchmark_import.py)
 # from . import fit_poly_3d
 # from . import plot_scatter_3d
-from .fit_poly_3d import fit_poly
+from .fit_poly_3d import fit_poly, fit_poly_multi, fit_poly_grid, fit_poly_tiles, fit_poly_coreset
 from .plot_scatter_3d import plot_scatter
 from .surface_generator import generate_data
+from .fitted_surface import FittedSurface
+from .tiled_fit import MosaicSurface
 
 def hi(name: str):
    print(f"Hi there, {name}")
-   
-print(f"{__file__} imported")
-   
\ No newline at end of file
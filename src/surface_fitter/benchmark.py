@@ -0,0 +1,286 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Benchmark suite of the stages of the fit : generate -> read -> assemble -> solve -> fit_poly_base -> evaluate -> write
+# for a matrix of parameters : number of points N, polynomial order and input format (txt, gz, npy).
+# For every stage the wall time, CPU time, throughput (points/s), peak memory used by the stage (peak RSS or tracemalloc, see
+# run_stage) and the maximum RSS of the process are recorded. Data are generated from the known polynomial of surface_generator.py
+# (GENERATOR_COEFF_LIST) at random positions and every fit is checked against it, so that a speedup cannot silently
+# break the results (exit code 1 when any accuracy check fails).
+#
+#    python ./src/surface_fitter/benchmark.py --n_points=1000,100000 --orders=3,7 --formats=txt,npy --json=bench.json
+#    python ./src/surface_fitter/benchmark.py --full --json=bench_full.json      # N = 1e3 .. 1e7, orders 1 .. 9, all formats
+#    python ./src/surface_fitter/benchmark.py --json=new.json --compare=bench.json  # ratios of wall times new/old
+#
+########################################################################################################################
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+import numpy as np
+
+try :
+   from . import fit_engine
+   from . import fit_poly_3d
+   from . import grid_eval
+   from . import fitted_surface
+   from . import fit_stats
+   from . import surface_generator
+except ImportError :
+   import fit_engine
+   import fit_poly_3d
+   import grid_eval
+   import fitted_surface
+   import fit_stats
+   import surface_generator
+
+IMAGE_SIZE = 8192
+FORMATS = ["txt","gz","npy"]
+
+# maximum RMS difference of the fitted and generator surfaces and maximum absolute difference of the coefficients for orders >= 3,
+# which represent the generator polynomial exactly (values in the text files are saved with 8 decimal places) :
+SURFACE_TOLERANCE = 1e-6
+COEFF_TOLERANCE = 1e-4
+
+########################################################################################################################################
+# Runs func() (with its standard output suppressed) and RETURNS (result,stats) , stats is a dictionary with keys :
+#    wall_s, cpu_s, points_per_s, peak_mb (peak memory used by the stage above the memory used at its start), memory_method, max_rss_mb
+# Peak memory is measured as the peak RSS of the stage (reset through /proc/self/clear_refs, see fit_stats.start_peak_rss) or, with
+# trace_memory=True or when the peak RSS cannot be reset, as the peak of memory allocated during the stage traced by tracemalloc
+# (slows down pure Python code)
+########################################################################################################################################
+def run_stage( func, n_points, trace_memory=False ) :
+   gc.collect()
+   memory_method = "rss"
+   memory = None
+   if not trace_memory :
+      memory = fit_stats.start_peak_rss()
+   if memory is None or not memory["open"] :
+      memory_method = "tracemalloc"
+      tracemalloc.start()
+
+   t_start = time.perf_counter()
+   cpu_start = time.process_time()
+   try :
+      with open(os.devnull,"w") as devnull :
+         with contextlib.redirect_stdout( devnull ) :
+            result = func()
+   except BaseException :
+      if memory_method == "tracemalloc" :
+         tracemalloc.stop()
+      else :
+         fit_stats.stop_peak_rss( memory )
+      raise
+   wall = time.perf_counter() - t_start
+   cpu = time.process_time() - cpu_start
+
+   if memory_method == "tracemalloc" :
+      peak_mb = tracemalloc.get_traced_memory()[1] / (1024.00*1024.00)
+      tracemalloc.stop()
+   else :
+      peak_mb = fit_stats.stop_peak_rss( memory ) - memory["rss_start_mb"]
+
+   stats = { "wall_s" : wall, "cpu_s" : cpu, "points_per_s" : n_points / max( wall, 1e-9 ), "peak_mb" : peak_mb, "memory_method" : memory_method,
+             "max_rss_mb" : fit_stats.get_peak_rss_mb() }
+
+   return (result,stats)
+
+########################################################################################################################################
+# Generates n_points random points (x,y in pixels) with values of the generator polynomial of surface_generator.py and saves them to
+# file in the given format : txt (X Y Z text), gz (gzip-compressed text) or npy (array of shape (3,n_points)), format is recognised
+# by the extension of filename (see surface_generator.generate_points)
+########################################################################################################################################
+def generate_points( filename, n_points, seed=0 ) :
+   surface_generator.generate_points( filename, size=IMAGE_SIZE, sampling="random", n_points=n_points, seed=seed )
+
+def get_generator_surface() :
+   return fitted_surface.FittedSurface.from_coeff_list( surface_generator.GENERATOR_COEFF_LIST, IMAGE_SIZE/2.00, IMAGE_SIZE/2.00 )
+
+########################################################################################################################################
+# Checks fitted coefficients a of order n against the generator polynomial
+# RETURNS : dictionary with keys coeff_max_abs_error (None for orders < 3 which cannot represent the generator polynomial),
+#           rms_vs_generator (RMS of difference of fitted and generator surface on a grid), ok
+########################################################################################################################################
+def check_accuracy( a, n ) :
+   generator = get_generator_surface()
+   fitted = fitted_surface.FittedSurface.from_fit( a, n, IMAGE_SIZE/2.00, IMAGE_SIZE/2.00 )
+   (x_axis,y_axis) = grid_eval.get_grid_axes( size=IMAGE_SIZE, step=64 )
+   (x_grid,y_grid) = np.meshgrid( x_axis, y_axis )
+   rms = np.sqrt( np.mean( ( fitted( x_grid, y_grid ) - generator( x_grid, y_grid ) )**2 ) )
+
+   coeff_error = None
+   ok = True
+   if n >= generator.order :
+      a_true = np.zeros( len(a) )
+      (p_exp,q_exp) = fit_engine.get_exponents( n )
+      for (a_pq,p,q) in surface_generator.GENERATOR_COEFF_LIST :
+         a_true[ (p_exp == p) & (q_exp == q) ] = a_pq
+      coeff_error = float( np.max( np.abs( a - a_true ) ) )
+      ok = ( rms < SURFACE_TOLERANCE and coeff_error < COEFF_TOLERANCE )
+
+   return { "coeff_max_abs_error" : coeff_error, "rms_vs_generator" : float(rms), "ok" : bool(ok) }
+
+########################################################################################################################################
+# Benchmarks all the stages for n_points points in format fmt and all the orders, files are created in work_dir
+# RETURNS : list of dictionaries (one per order) with keys n_points, order, format, stages (dictionary stage -> stats), accuracy
+########################################################################################################################################
+def benchmark_case( n_points, orders, fmt, work_dir, grid_step=10, trace_memory=False, verbose=0 ) :
+   extension = { "txt" : ".txt", "gz" : ".txt.gz", "npy" : ".npy" }[fmt]
+   filename = os.path.join( work_dir, "bench_%d%s" % (n_points,extension) )
+
+   common = {}
+   (result,common["generate"]) = run_stage( lambda : generate_points( filename, n_points ), n_points, trace_memory=trace_memory )
+   common["generate"]["file_bytes"] = os.stat( filename ).st_size
+   ((x,y,z),common["read"]) = run_stage( lambda : fit_poly_3d.read_text_file( filename, use_cache=False ), n_points, trace_memory=trace_memory )
+   x_norm = ( np.asarray( x, dtype=np.float64 ) - IMAGE_SIZE/2.00 ) / ( IMAGE_SIZE/2.00 )
+   y_norm = ( np.asarray( y, dtype=np.float64 ) - IMAGE_SIZE/2.00 ) / ( IMAGE_SIZE/2.00 )
+   z = np.asarray( z, dtype=np.float64 )
+
+   results = []
+   for n in orders :
+      stages = dict( common )
+      ((gram,rhs),stages["assemble"]) = run_stage( lambda : fit_engine.calc_normal_equations( x_norm, y_norm, z, n ), n_points, trace_memory=trace_memory )
+      (a,stages["solve"]) = run_stage( lambda : fit_engine.solve_normal_equations( gram, rhs ), n_points, trace_memory=trace_memory )
+      (fit_result,stages["fit_poly_base"]) = run_stage( lambda : fit_poly_3d.fit_poly_base( x, y, z, image_size=IMAGE_SIZE, polynomial_order=n, save_files=False ), n_points, trace_memory=trace_memory )
+      (fitted_values,stages["evaluate_points"]) = run_stage( lambda : fit_engine.calc_poly_values( x_norm, y_norm, a, n ), n_points, trace_memory=trace_memory )
+      (grid,stages["evaluate_grid"]) = run_stage( lambda : grid_eval.evaluate_grid( a, n, IMAGE_SIZE/2.00, IMAGE_SIZE/2.00, size=IMAGE_SIZE, step=grid_step ), n_points, trace_memory=trace_memory )
+      stages["evaluate_grid"]["grid_points"] = grid[2].size
+      stages["evaluate_grid"]["points_per_s"] = grid[2].size / max( stages["evaluate_grid"]["wall_s"], 1e-9 )
+
+      def write_fitted_vs_data() :
+         with open( os.path.join( work_dir, "fitted_vs_data.txt" ), "w" ) as out_f :
+            fit_poly_3d.save_fitted_vs_data( out_f, x, y, fitted_values, z )
+      (result,stages["write_fitted_vs_data"]) = run_stage( write_fitted_vs_data, n_points, trace_memory=trace_memory )
+      def write_fitted_vs_data_npy() :
+         out_f = np.lib.format.open_memmap( os.path.join( work_dir, "fitted_vs_data.npy" ), mode="w+", dtype=np.float64, shape=(5,n_points) )
+         fit_poly_3d.save_fitted_vs_data( out_f, x, y, fitted_values, z )
+         fit_poly_3d.close_fitted_vs_data( out_f )
+      (result,stages["write_fitted_vs_data_npy"]) = run_stage( write_fitted_vs_data_npy, n_points, trace_memory=trace_memory )
+      (result,stages["write_fitted_surface"]) = run_stage( lambda : fit_poly_3d.save_fitted_surface( a, n, IMAGE_SIZE/2.00, IMAGE_SIZE/2.00, size=IMAGE_SIZE, step=grid_step ), n_points, trace_memory=trace_memory )
+      stages["write_fitted_surface"]["points_per_s"] = stages["evaluate_grid"]["grid_points"] / max( stages["write_fitted_surface"]["wall_s"], 1e-9 )
+
+      accuracy = check_accuracy( a, n )
+      accuracy["fit_poly_base_max_abs_diff"] = float( np.max( np.abs( fit_result[2] - a ) ) )
+      results.append( { "n_points" : n_points, "order" : n, "format" : fmt, "stages" : stages, "accuracy" : accuracy } )
+      print_case( results[-1], verbose=verbose )
+
+   os.remove( filename )
+
+   return results
+
+########################################################################################################################################
+# Benchmarks the original generate_data (fixed grid of 82 x 82 points written line by line)
+########################################################################################################################################
+def benchmark_generate_data( work_dir, trace_memory=False ) :
+   filename = os.path.join( work_dir, "test.txt" )
+   (result,stats) = run_stage( lambda : surface_generator.generate_data( filename ), 82*82, trace_memory=trace_memory )
+   os.remove( filename )
+
+   return stats
+
+def print_case( case, verbose=0 ) :
+   accuracy = case["accuracy"]
+   status = "OK"
+   if not accuracy["ok"] :
+      status = "FAILED"
+   print("N = %d , order = %d , format = %s : accuracy %s (max |a - a_true| = %s , RMS vs generator = %.3e)" % (case["n_points"],case["order"],case["format"],status,accuracy["coeff_max_abs_error"],accuracy["rms_vs_generator"]))
+   for (stage,stats) in case["stages"].items() :
+      print("   %-22s wall = %10.4f s , cpu = %10.4f s , %14.1f points/s , peak = %8.1f MB (%s) , max RSS = %.1f MB" % (stage,stats["wall_s"],stats["cpu_s"],stats["points_per_s"],stats["peak_mb"],stats["memory_method"],stats["max_rss_mb"]))
+
+########################################################################################################################################
+# Prints ratios of wall times of the same cases and stages in results and in the results saved in compare_file
+########################################################################################################################################
+def compare_results( results, compare_file ) :
+   with open(compare_file,"r") as f :
+      old_results = json.load( f )
+
+   old_cases = {}
+   for case in old_results["cases"] :
+      old_cases[ (case["n_points"],case["order"],case["format"]) ] = case
+
+   print("# N ORDER FORMAT STAGE WALL_OLD[s] WALL_NEW[s] RATIO(NEW/OLD)")
+   for case in results["cases"] :
+      old_case = old_cases.get( (case["n_points"],case["order"],case["format"]) )
+      if old_case is None :
+         continue
+      for (stage,stats) in case["stages"].items() :
+         if stage in old_case["stages"] :
+            old_wall = old_case["stages"][stage]["wall_s"]
+            print("%d %d %s %s %.6f %.6f %.3f" % (case["n_points"],case["order"],case["format"],stage,old_wall,stats["wall_s"],stats["wall_s"]/max(old_wall,1e-9)))
+
+def parse_options():
+   usage="Usage: %prog [options]\n"
+   usage+='\tBenchmark of the stages of the polynomial surface fit\n'
+   parser = OptionParser(usage=usage,version=1.00)
+   parser.add_option('--n_points','--n',dest="n_points",default="1000,10000,100000", help="Comma separated list of numbers of points [default %default]",type="string")
+   parser.add_option('--orders','--order',dest="orders",default="1,3,5,7,9", help="Comma separated list of polynomial orders [default %default]",type="string")
+   parser.add_option('--formats','--format',dest="formats",default="txt,npy", help="Comma separated list of input formats : txt, gz, npy [default %default]",type="string")
+   parser.add_option('--full',action="store_true",dest="full",default=False, help="Full matrix : N = 1e3 .. 1e7 , orders 1 .. 9 , all formats [default %default]")
+   parser.add_option('--grid_step','--step',dest="grid_step",default=10, help="Step of the evaluated and saved grid [default %default]",type="int")
+   parser.add_option('--tracemalloc',action="store_true",dest="trace_memory",default=False, help="Measure peak memory of the stages with tracemalloc instead of peak RSS (slows down pure Python code) [default %default]")
+   parser.add_option('--work_dir','--tmp_dir',dest="work_dir",default=None, help="Directory for the generated files [default temporary directory]",type="string")
+   parser.add_option('--json','--outfile',dest="json_file",default=None, help="Save results to JSON file [default %default]",type="string")
+   parser.add_option('--compare',dest="compare_file",default=None, help="Compare wall times with results saved earlier in this JSON file [default %default]",type="string")
+   parser.add_option('--verb','--verbose','--debug_level',dest="verbose",default=0, help="Verbosity level [default %default]",type="int")
+
+   (options, args) = parser.parse_args()
+
+   return (options, args)
+
+if __name__ == '__main__':
+   (options, args) = parse_options()
+
+   n_points_list = [ int(float(val)) for val in options.n_points.split(",") ]
+   orders = [ int(val) for val in options.orders.split(",") ]
+   formats = options.formats.split(",")
+   if options.full :
+      n_points_list = [ 1000, 10000, 100000, 1000000, 10000000 ]
+      orders = list( range(1,10) )
+      formats = FORMATS
+
+   work_dir = options.work_dir
+   if work_dir is None :
+      work_dir = tempfile.mkdtemp( prefix="surface_fitter_bench_" )
+   else :
+      os.makedirs( work_dir, exist_ok=True )
+
+   results = { "meta" : { "time" : time.strftime( "%Y-%m-%d %H:%M:%S" ), "python" : platform.python_version(), "numpy" : np.__version__,
+                          "platform" : platform.platform(), "cpu_count" : os.cpu_count(), "grid_step" : options.grid_step },
+               "generate_data" : None, "cases" : [] }
+
+   # output files of fit_poly_base and save_fitted_surface are written to the current directory :
+   current_dir = os.getcwd()
+   os.chdir( work_dir )
+   try :
+      # warm-up : lazily imported modules (e.g. scipy.linalg) are not included in the first measured stage :
+      fit_engine.solve_normal_equations( np.eye(1), np.ones(1) )
+
+      results["generate_data"] = benchmark_generate_data( work_dir, trace_memory=options.trace_memory )
+      print("generate_data (82 x 82 points) : wall = %.4f s" % (results["generate_data"]["wall_s"]))
+      for fmt in formats :
+         for n_points in n_points_list :
+            results["cases"] += benchmark_case( n_points, orders, fmt, work_dir, grid_step=options.grid_step, trace_memory=options.trace_memory, verbose=options.verbose )
+   finally :
+      os.chdir( current_dir )
+      if options.work_dir is None :
+         shutil.rmtree( work_dir, ignore_errors=True )
+
+   if options.json_file is not None :
+      with open(options.json_file,"w") as out_f :
+         json.dump( results, out_f, indent=1 )
+      print("Results saved to file %s" % (options.json_file))
+
+   if options.compare_file is not None :
+      compare_results( results, options.compare_file )
+
+   failed = [ case for case in results["cases"] if not case["accuracy"]["ok"] ]
+   if len(failed) > 0 :
+      print("ERROR : accuracy check failed in %d cases" % (len(failed)))
+      sys.exit(1)
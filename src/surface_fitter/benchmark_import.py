@@ -0,0 +1,89 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Import-time benchmark : starts n_runs fresh Python interpreters importing the package (or a module) and reports the
+# wall time of the import, also checks that heavy optional modules (matplotlib, scipy) are not imported :
+#    python ./src/surface_fitter/benchmark_import.py --n_runs=20 [--module=surface_fitter] [--max_ms=500]
+# exit code is 1 when a heavy module was imported or when the median time exceeds max_ms (if set)
+#
+########################################################################################################################
+import json
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+import numpy as np
+
+# modules which must not be imported by the fitting code :
+HEAVY_MODULES = ["matplotlib","scipy","mpl_toolkits"]
+
+# code executed in a fresh interpreter, prints JSON with the import time and the list of imported heavy modules :
+CHILD_CODE = '''
+import sys, time, json
+t_start = time.perf_counter()
+import %s
+t_end = time.perf_counter()
+heavy = sorted( set( [ name.split(".")[0] for name in sys.modules if name.split(".")[0] in %s ] ) )
+print( json.dumps( { "import_ms" : 1000.00*(t_end - t_start), "heavy" : heavy } ) )
+'''
+
+########################################################################################################################################
+# RETURNS dictionary with import times (ms) of module in n_runs fresh interpreters : import_ms (list), wall_ms (list - including start
+# of the interpreter), heavy (heavy modules imported)
+########################################################################################################################################
+def benchmark_import( module="surface_fitter", n_runs=10, python=sys.executable ) :
+   env = dict( os.environ )
+   src_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+   env["PYTHONPATH"] = src_dir + os.pathsep + env.get( "PYTHONPATH", "" )
+
+   import_ms = []
+   wall_ms = []
+   heavy = set()
+   for run in range(0,n_runs) :
+      t_start = time.perf_counter()
+      out = subprocess.check_output( [ python, "-c", CHILD_CODE % (module,HEAVY_MODULES) ], env=env )
+      wall_ms.append( 1000.00*(time.perf_counter() - t_start) )
+
+      result = json.loads( out.decode().strip().splitlines()[-1] )
+      import_ms.append( result["import_ms"] )
+      heavy.update( result["heavy"] )
+
+   return { "module" : module, "n_runs" : n_runs, "import_ms" : import_ms, "wall_ms" : wall_ms, "heavy" : sorted(heavy) }
+
+def parse_options():
+   usage="Usage: %prog [options]\n"
+   usage+='\tImport-time benchmark of the package\n'
+   parser = OptionParser(usage=usage,version=1.00)
+   parser.add_option('--module',dest="module",default="surface_fitter", help="Module to import [default %default]",type="string")
+   parser.add_option('--n_runs','--runs',dest="n_runs",default=10, help="Number of fresh interpreters [default %default]",type="int")
+   parser.add_option('--max_ms',dest="max_ms",default=None, help="Fail (exit code 1) if the median import time is larger [default %default - not checked]",type="float")
+   parser.add_option('--json',dest="json_file",default=None, help="Save results to JSON file [default %default]",type="string")
+
+   (options, args) = parser.parse_args()
+
+   return (options, args)
+
+if __name__ == '__main__':
+   (options, args) = parse_options()
+
+   result = benchmark_import( module=options.module, n_runs=options.n_runs )
+   print("Import of %s in %d fresh interpreters :" % (result["module"],result["n_runs"]))
+   print("   import time  : median = %.2f ms , min = %.2f ms , max = %.2f ms" % (np.median(result["import_ms"]),np.min(result["import_ms"]),np.max(result["import_ms"])))
+   print("   process wall : median = %.2f ms (including start of the interpreter)" % (np.median(result["wall_ms"])))
+
+   if options.json_file is not None :
+      with open(options.json_file,"w") as out_f :
+         json.dump( result, out_f, indent=1 )
+      print("Results saved to file %s" % (options.json_file))
+
+   failed = False
+   if len(result["heavy"]) > 0 :
+      print("ERROR : heavy modules imported : %s" % (result["heavy"]))
+      failed = True
+   if options.max_ms is not None and np.median(result["import_ms"]) > options.max_ms :
+      print("ERROR : median import time %.2f ms exceeds the limit of %.2f ms" % (np.median(result["import_ms"]),options.max_ms))
+      failed = True
+
+   if failed :
+      sys.exit(1)
@@ -0,0 +1,333 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Coreset (weighted subsample) fit for very large inputs (1e8 - 1e9 points), where even the streaming fit is dominated by I/O.
+# Low-order surfaces are determined to a given accuracy by a much smaller, spatially balanced and correctly weighted subsample :
+#
+#  1. a uniform pool of pool_size points is drawn from the input in blocks of BLOCK_POINTS consecutive points (random blocks of
+#     arrays and memory-mapped .npy files, random byte offsets of text files), so that only the pool is read
+#  2. every point i of the pool gets inclusion probability pi_i :
+#        stratified : pool binned spatially over the image (n_bins x n_bins), the same expected number of points from every bin
+#                     (bins with fewer points are taken completely)
+#        leverage   : pi_i ~ 0.5*h_i/Sum h + 0.5/pool_size , where h_i = d_i^T (D^T D)^-1 d_i is the leverage score of the point
+#        uniform    : pi_i = sample_size/pool_size
+#     and is included with this probability (Poisson sampling) with the Horvitz-Thompson weight w_i = (N/pool_size)/pi_i, so that the
+#     weighted normal equations of the subsample are unbiased estimates of the normal equations of all the N points
+#  3. weighted least-squares fit of the subsample, the error of the coefficients with respect to the fit of all the points (full pass)
+#     is estimated with the cluster-robust sandwich estimator (points of a block are correlated in spatially ordered inputs) :
+#        Cov(a) = G^-1 ( Sum_b g_b g_b^T ) G^-1 , g_b = Sum_{i in block b} w_i r_i d_i , G = Sum w_i d_i d_i^T , r_i residuals
+#     and converted to the maximum standard error of the fitted surface over the image (surface_error). The tolerance is compared
+#     with the error bound confidence*surface_error (default DEFAULT_CONFIDENCE, the standard error is a 1-sigma estimate and its
+#     maximum over the image is not a bound of the maximum difference), if it is exceeded the sample is enlarged
+#     (error ~ 1/sqrt(sample_size)) and the fit repeated.
+#  4. optionally the fit is validated on an independent held-out sample (RMS of its residuals) or compared with the full pass.
+#
+########################################################################################################################
+import os
+import numpy as np
+
+try :
+   from . import data_reader
+   from . import fit_engine
+   from . import fit_stats
+   from . import grid_fit
+   from . import streaming_fit
+except ImportError :
+   import data_reader
+   import fit_engine
+   import fit_stats
+   import grid_fit
+   import streaming_fit
+
+SUBSAMPLE_METHODS = ["stratified","leverage","uniform"]
+
+DEFAULT_SAMPLE_SIZE = 100000
+DEFAULT_MAX_SAMPLE_SIZE = 10000000
+DEFAULT_N_BINS = 32
+
+# size of the uniform pool in units of the sample size :
+DEFAULT_OVERSAMPLE = 4
+
+# number of consecutive points (lines) read at once :
+BLOCK_POINTS = 64
+
+# number of points along each axis of the grid on which the error of the fitted surface is estimated :
+ERROR_GRID_POINTS = 33
+
+# confidence factor k : the tolerance is required for the error bound k*surface_error (k standard errors) :
+DEFAULT_CONFIDENCE = 3.00
+
+class PointSource :
+   #####################################################################################################################################
+   # Source of the points : tuple of arrays (x,y,z), memory-mapped .npy file (array of shape (n_columns,N), see data_reader.py),
+   # plain text file (sampled at random byte offsets) or other file (gzip-compressed text is read completely with data_reader)
+   #####################################################################################################################################
+   def __init__( self, data, columns=(0,1,2) ) :
+      self.filename = None
+      self.arrays = None
+      self.columns = columns
+      if isinstance( data, str ) :
+         self.filename = data
+         if streaming_fit.is_gzip_file( data ) :
+            print("WARNING : compressed file %s cannot be sampled at random offsets -> it is read completely" % (data))
+         if data.endswith(".npy") or streaming_fit.is_gzip_file( data ) or os.path.exists( data_reader.get_cache_filename( data, columns ) ) :
+            # memory-mapped .npy file (or cache of parsed columns) is sampled directly :
+            self.arrays = data_reader.read_columns( data, columns=columns )
+      else :
+         self.arrays = tuple( [ np.asarray( values ) for values in data ] )
+         self.columns = (0,1,2)
+
+      if self.arrays is not None :
+         self.n_points = len(self.arrays[0])
+      else :
+         self.file_size = os.stat( self.filename ).st_size
+         self.bytes_per_line = None
+         self.n_points = self.estimate_n_lines()
+
+   #####################################################################################################################################
+   # Reads up to n_lines lines of the text file starting from the first full line after byte offset
+   # RETURNS : (lines,positions) - lines and byte positions of their beginnings
+   #####################################################################################################################################
+   def read_lines( self, in_f, offset, n_lines ) :
+      in_f.seek( offset )
+      if offset > 0 :
+         in_f.readline() # move to the beginning of the next line
+      lines = []
+      positions = []
+      for i in range(0,n_lines) :
+         position = in_f.tell()
+         line = in_f.readline()
+         if not line :
+            break
+         lines.append( line )
+         positions.append( position )
+
+      return (lines,positions)
+
+   #####################################################################################################################################
+   # RETURNS number of lines of the text file estimated from the mean length of lines at a few random offsets (exact for small files)
+   #####################################################################################################################################
+   def estimate_n_lines( self, n_blocks=64 ) :
+      with open( self.filename, "rb" ) as in_f :
+         if self.file_size <= n_blocks*BLOCK_POINTS*256 :
+            return sum( [ 1 for line in in_f if line.strip() and not line.startswith(b"#") ] )
+         offsets = np.linspace( 0, self.file_size, n_blocks, endpoint=False ).astype(np.int64)
+         lines = []
+         for offset in offsets :
+            lines += self.read_lines( in_f, int(offset), BLOCK_POINTS )[0]
+
+      self.bytes_per_line = float( sum( [ len(line) for line in lines ] ) ) / max( 1, len(lines) )
+      return int( self.file_size / self.bytes_per_line )
+
+   #####################################################################################################################################
+   # Draws a uniform random subset of about n_draw points in blocks of BLOCK_POINTS consecutive points (all the points when n_draw >=
+   # n_points). Lines of overlapping blocks of text files are read only once.
+   # RETURNS : (x,y,z,blocks) - arrays of values as float64 and index of the block of every point (clusters of correlated points used in
+   #           the estimate of the error, every point is its own block when all the points are returned)
+   #####################################################################################################################################
+   def draw( self, n_draw, rng ) :
+      if self.arrays is not None :
+         if n_draw >= self.n_points :
+            return tuple( [ np.asarray( values, dtype=np.float64 ) for values in self.arrays ] ) + (np.arange( 0, self.n_points ),)
+         n_blocks = ( self.n_points + BLOCK_POINTS - 1 ) // BLOCK_POINTS
+         blocks = np.sort( rng.choice( n_blocks, size=min( n_blocks, max( 1, n_draw // BLOCK_POINTS ) ), replace=False ) )
+         indexes = ( blocks[:,None]*BLOCK_POINTS + np.arange( 0, BLOCK_POINTS )[None,:] ).ravel()
+         valid = ( indexes < self.n_points )
+         return tuple( [ np.asarray( values[indexes[valid]], dtype=np.float64 ) for values in self.arrays ] ) + (np.repeat( np.arange( 0, len(blocks) ), BLOCK_POINTS )[valid],)
+
+      if n_draw >= self.n_points or self.bytes_per_line is None :
+         data = data_reader.parse_text_file( self.filename, columns=self.columns )
+         return tuple( [ data[i] for i in range(0,len(self.columns)) ] ) + (np.arange( 0, data.shape[1] ),)
+
+      offsets = np.sort( rng.integers( 0, self.file_size, size=max( 1, n_draw // BLOCK_POINTS ) ) )
+      lines = []
+      blocks = []
+      last_position = -1
+      with open( self.filename, "rb" ) as in_f :
+         for (block,offset) in enumerate( offsets ) :
+            (block_lines,positions) = self.read_lines( in_f, int(offset), BLOCK_POINTS )
+            # offsets are sorted, so lines already read by the previous block are at its beginning :
+            n_read = np.searchsorted( positions, last_position, side="right" )
+            lines += block_lines[n_read:]
+            blocks += [block]*( len(block_lines) - n_read )
+            if len(positions) > 0 :
+               last_position = max( last_position, positions[-1] )
+      data = np.loadtxt( lines, comments="#", usecols=self.columns, ndmin=2 )
+
+      return tuple( [ data[:,i] for i in range(0,len(self.columns)) ] ) + (np.array( blocks, dtype=np.int64 ),)
+
+########################################################################################################################################
+# RETURNS inclusion probabilities pi_i of the points (x,y) (pixel coordinates) of the pool for the expected sample size sample_size
+#   method : stratified, leverage or uniform (see the description at the top)
+########################################################################################################################################
+def calc_inclusion_probabilities( x, y, sample_size, method="stratified", image_size=8192, n_bins=DEFAULT_N_BINS, n=3, x_c=None, y_c=None, basis="monomial" ) :
+   pool_size = len(x)
+   if sample_size >= pool_size :
+      return np.ones( pool_size )
+
+   if method == "uniform" :
+      return np.full( pool_size, float(sample_size) / pool_size )
+
+   if method == "stratified" :
+      if image_size is None or image_size <= 0 :
+         image_size = max( np.max(x), np.max(y) ) + 1
+      bin_size = float(image_size) / n_bins
+      bins = np.clip( ( x // bin_size ).astype(np.int64), 0, n_bins-1 )*n_bins + np.clip( ( y // bin_size ).astype(np.int64), 0, n_bins-1 )
+      counts = np.bincount( bins, minlength=n_bins*n_bins )
+
+      # water filling : the same number of points t from every bin, Sum min(count,t) = sample_size :
+      sorted_counts = np.sort( counts[ counts > 0 ] )
+      n_taken = 0
+      target = 0.00
+      for (index,count) in enumerate( sorted_counts ) :
+         target = float( sample_size - n_taken ) / ( len(sorted_counts) - index )
+         if count >= target :
+            break
+         n_taken += count
+      return np.minimum( 1.00, target / counts[bins] )
+
+   if method == "leverage" :
+      x_norm = ( x - x_c ) / x_c
+      y_norm = ( y - y_c ) / y_c
+      gram_inv = np.linalg.pinv( grid_fit.calc_gram( x_norm, y_norm, n, basis=basis ) )
+      leverage = np.empty( pool_size )
+      for start in range(0,pool_size,fit_engine.DEFAULT_CHUNK_SIZE) :
+         design = fit_engine.calc_design_matrix( x_norm[start:start+fit_engine.DEFAULT_CHUNK_SIZE], y_norm[start:start+fit_engine.DEFAULT_CHUNK_SIZE], n, basis=basis )
+         leverage[start:start+len(design)] = np.sum( np.dot( design, gram_inv ) * design, axis=1 )
+      probabilities = 0.50*leverage/np.sum( leverage ) + 0.50/pool_size
+
+      return np.minimum( 1.00, sample_size * probabilities )
+
+   print("ERROR : unknown subsampling method %s, allowed are : %s" % (method,SUBSAMPLE_METHODS))
+   raise ValueError("Unknown subsampling method %s" % (method))
+
+########################################################################################################################################
+# RETURNS maximum standard error of the surface over the image (on a grid of ERROR_GRID_POINTS x ERROR_GRID_POINTS normalised
+# coordinates in [-1,1]) for covariance cov of the coefficients
+########################################################################################################################################
+def calc_surface_error( cov, n, basis="monomial" ) :
+   axis = np.linspace( -1.00, 1.00, ERROR_GRID_POINTS )
+   design = fit_engine.calc_design_matrix( np.repeat( axis, len(axis) ), np.tile( axis, len(axis) ), n, basis=basis )
+   variance = np.sum( np.dot( design, cov ) * design, axis=1 )
+
+   return np.sqrt( np.max( np.maximum( variance, 0.00 ) ) )
+
+########################################################################################################################################
+# Weighted fit of the subsample (normalised coordinates x,y) and the sandwich estimate of the covariance of the coefficients.
+# Points are drawn in blocks of consecutive points whose residuals are correlated (e.g. neighbouring pixels of spatially ordered files),
+# so the middle term is built from the block totals g_b = Sum_{i in b} w_i r_i d_i : Sum_b g_b g_b^T (cluster-robust estimator)
+#   blocks : index of the block of every point (None - independent points)
+# RETURNS : (a,cov,residuals)
+########################################################################################################################################
+def fit_weighted( x, y, z, weights, n, solver="cholesky", basis="monomial", blocks=None ) :
+   (gram,rhs) = fit_engine.calc_normal_equations( x, y, z, n, basis=basis, weights=weights )
+   a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+   residuals = z - fit_engine.calc_poly_values( x, y, a, n, basis=basis )
+
+   if blocks is None :
+      (meat,meat_rhs) = fit_engine.calc_normal_equations( x, y, np.zeros( len(z) ), n, basis=basis, weights=(weights*residuals)**2 )
+   else :
+      (block_ids,block_index) = np.unique( blocks, return_inverse=True )
+      block_totals = np.zeros( (len(block_ids),len(gram)) )
+      for start in range(0,len(z),fit_engine.DEFAULT_CHUNK_SIZE) :
+         end = min( start + fit_engine.DEFAULT_CHUNK_SIZE, len(z) )
+         design = fit_engine.calc_design_matrix( x[start:end], y[start:end], n, basis=basis )
+         scores = design * ( weights[start:end]*residuals[start:end] )[:,None]
+         for m in range(0,len(gram)) :
+            block_totals[:,m] += np.bincount( block_index[start:end], weights=scores[:,m], minlength=len(block_ids) )
+      meat = np.dot( block_totals.T, block_totals )
+   gram_inv = np.linalg.pinv( gram )
+   cov = np.dot( gram_inv, np.dot( meat, gram_inv ) )
+
+   return (a,cov,residuals)
+
+########################################################################################################################################
+# Coreset fit of polynomial of order n to the source (file name or tuple of arrays x,y,z in pixel coordinates)
+#   sample_size  : expected size of the (first) subsample
+#   method       : stratified, leverage or uniform
+#   tolerance    : required maximum error of the fitted surface with respect to the full pass (in units of z), the sample is enlarged
+#                  up to max_sample_size until confidence*surface_error <= tolerance (None - single subsample of sample_size points)
+#   confidence   : confidence factor k of the error bound k*surface_error compared with the tolerance (k standard errors)
+#   n_validate   : number of points of an independent held-out sample used to validate the fit (RMS of the residuals)
+#   full_pass    : also fit all the points (reads all the data) and report the true difference of the coefficients and the surface
+#   image_size   : image size used to normalise the coordinates (as in fit_poly_base) and to bin the points
+#   stats        : fit_stats.FitStats for the stages subsample, assemble, validate and full_pass
+# RETURNS : dictionary (report) with keys a (coefficients in the basis), x_c, y_c, cov, coeff_error, surface_error, error_bound
+#           (confidence*surface_error), confidence, n_sample, n_pool,
+#           n_total, sample_rms, holdout_rms (if n_validate > 0), full_pass_coeff_diff and full_pass_surface_diff (if full_pass), converged
+########################################################################################################################################
+def fit_coreset( source, n=3, sample_size=DEFAULT_SAMPLE_SIZE, method="stratified", tolerance=None, confidence=DEFAULT_CONFIDENCE, max_sample_size=DEFAULT_MAX_SAMPLE_SIZE, n_validate=0, full_pass=False, image_size=8192, n_bins=DEFAULT_N_BINS, oversample=DEFAULT_OVERSAMPLE, solver="cholesky", basis="monomial", seed=None, stats=None, verbose=0 ) :
+   if method not in SUBSAMPLE_METHODS :
+      print("ERROR : unknown subsampling method %s, allowed are : %s" % (method,SUBSAMPLE_METHODS))
+      raise ValueError("Unknown subsampling method %s" % (method))
+   if stats is None :
+      stats = fit_stats.FitStats()
+   if not isinstance( source, PointSource ) :
+      source = PointSource( source )
+   rng = np.random.default_rng( seed )
+   n_total = source.n_points
+
+   while True :
+      with stats.stage( "subsample" ) as stage :
+         (x,y,z,blocks) = source.draw( oversample*sample_size, rng )
+         if image_size is None or image_size <= 0 :
+            (x_c,y_c) = ( ( np.min(x) + np.max(x) ) / 2.00,( np.min(y) + np.max(y) ) / 2.00 )
+         else :
+            (x_c,y_c) = (image_size/2.00,image_size/2.00)
+         pool_size = len(z)
+         probabilities = calc_inclusion_probabilities( x, y, sample_size, method=method, image_size=image_size, n_bins=n_bins, n=n, x_c=x_c, y_c=y_c, basis=basis )
+         selected = np.nonzero( rng.random( pool_size ) < probabilities )[0]
+         weights = ( float(n_total) / pool_size ) / probabilities[selected]
+         (x,y,z,blocks) = ( ( x[selected] - x_c ) / x_c,( y[selected] - y_c ) / y_c,z[selected],blocks[selected] )
+         stage["n_points"] = len(z)
+
+      with stats.stage( "assemble", n_points=len(z) ) :
+         (a,cov,residuals) = fit_weighted( x, y, z, weights, n, solver=solver, basis=basis, blocks=blocks )
+         surface_error = calc_surface_error( cov, n, basis=basis )
+      error_bound = confidence*surface_error
+      print("Coreset fit (%s) : %d points of pool %d out of %d , estimated surface error = %.6e (bound %.6e for confidence factor %.2f)" % (method,len(z),pool_size,n_total,surface_error,error_bound,confidence))
+
+      converged = ( tolerance is None or error_bound <= tolerance )
+      if converged or sample_size >= max_sample_size or pool_size >= n_total :
+         break
+      sample_size = min( max_sample_size, int( 1.20 * sample_size * ( error_bound / tolerance )**2 ) + 1 )
+
+   report = { "a" : a, "x_c" : x_c, "y_c" : y_c, "cov" : cov, "coeff_error" : np.sqrt( np.maximum( np.diag( cov ), 0.00 ) ), "surface_error" : surface_error,
+              "error_bound" : error_bound, "confidence" : confidence,
+              "n_sample" : len(z), "n_pool" : pool_size, "n_total" : n_total, "method" : method, "converged" : converged,
+              "sample_rms" : np.sqrt( np.sum( weights*residuals**2 ) / np.sum( weights ) ) }
+
+   if n_validate > 0 :
+      with stats.stage( "validate", n_points=n_validate ) :
+         (x_val,y_val,z_val,blocks_val) = source.draw( n_validate, np.random.default_rng( rng.integers( 0, 2**63 ) ) )
+         residuals = z_val - fit_engine.calc_poly_values( ( x_val - x_c ) / x_c, ( y_val - y_c ) / y_c, a, n, basis=basis )
+         report["holdout_rms"] = np.sqrt( np.mean( residuals**2 ) )
+         report["n_holdout"] = len(z_val)
+
+   if full_pass :
+      with stats.stage( "full_pass", n_points=n_total ) :
+         (x_all,y_all,z_all) = source.arrays if source.arrays is not None else data_reader.read_columns( source.filename, columns=source.columns )
+         (gram,rhs) = fit_engine.calc_normal_equations( fit_engine.NormalisedArray( x_all, x_c, x_c ), fit_engine.NormalisedArray( y_all, y_c, y_c ), z_all, n, basis=basis )
+         a_full = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+         report["full_pass_coeff_diff"] = np.abs( a - a_full )
+         # maximum |p(x,y) - p_full(x,y)| on the grid (rank-1 "covariance" of the difference) :
+         report["full_pass_surface_diff"] = calc_surface_error( np.outer( a - a_full, a - a_full ), n, basis=basis )
+
+   return report
+
+########################################################################################################################################
+# Prints the report of fit_coreset
+########################################################################################################################################
+def print_report( report, n ) :
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   print("Coreset fit (%s) : %d points (pool %d) out of %d , estimated error of the surface with respect to the full pass = %.6e , bound = %.6e (confidence factor %.2f, %s)" % (report["method"],report["n_sample"],report["n_pool"],report["n_total"],report["surface_error"],report["error_bound"],report["confidence"],("converged" if report["converged"] else "tolerance NOT reached")))
+   for m in range(0,len(p_exp)) :
+      line = "\t c_%d%d = %.8f +/- %.8f" % (p_exp[m],q_exp[m],report["a"][m],report["coeff_error"][m])
+      if "full_pass_coeff_diff" in report :
+         line += " (full pass difference %.8f)" % (report["full_pass_coeff_diff"][m])
+      print(line)
+   print("RMS of residuals : subsample = %.8f" % (report["sample_rms"]))
+   if "holdout_rms" in report :
+      print("RMS of residuals : held-out sample of %d points = %.8f" % (report["n_holdout"],report["holdout_rms"]))
+   if "full_pass_surface_diff" in report :
+      print("Maximum difference of the surface with respect to the full pass = %.6e" % (report["full_pass_surface_diff"]))
@@ -0,0 +1,85 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Shared reader of the X Y Z ... text files used by fit_poly_3d.py and plot_scatter_3d.py
+# Text files are parsed with the vectorised NumPy parser (np.loadtxt, plain or .gz) and only the required columns
+# are loaded. The parsed columns are cached next to the input file as :
+#    FILENAME.cache_SIZE_MTIME_cCOLUMNS.npy   (e.g. test.txt.cache_434176_1752710000000000000_c0-1-2.npy)
+# and on later runs the cached copy is memory-mapped instead of parsing the text file again. The cache is invalidated
+# (and overwritten) whenever size or modification time of the input file changes.
+# Binary .npy files (with columns in rows, i.e. shape (n_columns,n_points)) can also be read directly.
+#
+########################################################################################################################
+import glob
+import os
+import numpy as np
+
+########################################################################################################################################
+# RETURNS path of the cache file for the given input file and the list of columns
+########################################################################################################################################
+def get_cache_filename( filename, columns ) :
+   st = os.stat( filename )
+   columns_string = "-".join( [ ("%d" % c) for c in columns ] )
+
+   return ("%s.cache_%d_%d_c%s.npy" % (filename,st.st_size,st.st_mtime_ns,columns_string))
+
+########################################################################################################################################
+# Removes cache files of older versions of the input file (different size or modification time)
+########################################################################################################################################
+def remove_stale_cache( filename, columns, keep ) :
+   columns_string = "-".join( [ ("%d" % c) for c in columns ] )
+
+   for cache_file in glob.glob( glob.escape(filename) + (".cache_*_c%s.npy" % columns_string) ) :
+      if cache_file != keep :
+         try :
+            os.remove( cache_file )
+         except OSError :
+            print("WARNING : could not remove stale cache file %s" % (cache_file))
+
+########################################################################################################################################
+# Parses text file and returns array of shape (len(columns),n_points), lines starting with # are skipped
+########################################################################################################################################
+def parse_text_file( filename, columns=(0,1,2) ) :
+   data = np.loadtxt( filename, comments="#", usecols=columns, ndmin=2, dtype=np.float64 )
+
+   # columns in rows, so that every column is a contiguous array :
+   return np.ascontiguousarray( data.T )
+
+########################################################################################################################################
+# Reads required columns from a text (or .npy) file
+#   use_cache : save parsed columns to a .npy file next to the input and memory-map it on later runs
+# RETURNS : tuple of 1D arrays (one per required column), empty arrays for an empty or non-existing file
+########################################################################################################################################
+def read_columns( filename, columns=(0,1,2), use_cache=True, verbose=0 ) :
+   columns = tuple( columns )
+
+   if not os.path.exists(filename) or os.stat(filename).st_size <= 0 :
+      print("WARNING : empty or non-existing file %s" % (filename))
+      return tuple( [ np.zeros(0) for c in columns ] )
+
+   if filename.endswith(".npy") :
+      data = np.load( filename, mmap_mode="r" )
+      return tuple( [ data[c] for c in columns ] )
+
+   data = None
+   if use_cache :
+      cache_file = get_cache_filename( filename, columns )
+      if os.path.exists( cache_file ) :
+         if verbose > 0 :
+            print("DEBUG : using cached columns %s from file %s" % (columns,cache_file))
+         data = np.load( cache_file, mmap_mode="r" )
+      else :
+         data = parse_text_file( filename, columns )
+         try :
+            tmp_file = cache_file + (".tmp%d.npy" % os.getpid())
+            np.save( tmp_file, data )
+            os.replace( tmp_file, cache_file )
+            remove_stale_cache( filename, columns, keep=cache_file )
+            if verbose > 0 :
+               print("DEBUG : columns %s of file %s cached in %s" % (columns,filename,cache_file))
+         except OSError :
+            print("WARNING : could not save cache file %s" % (cache_file))
+   else :
+      data = parse_text_file( filename, columns )
+
+   return tuple( [ data[i] for i in range(0,len(columns)) ] )
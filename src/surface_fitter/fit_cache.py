@@ -0,0 +1,286 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Content-addressed on-disk cache of fits (opt-in, enabled by cache_dir in fit_poly or --cache_dir option).
+# An entry is keyed by the hash of :
+#    SHA-256 of the content of the input file , columns , image_size
+# (the image centre is a function of the data and image_size) and stores the normal equations (Gram matrix, rhs, Sum z^2,
+# number of points), the image centre and the coefficients solved for the order of the entry. The normal equations of
+# order n contain all the moments Sum x^a y^b (a+b <= 2n) and Sum z x^p y^q (p+q <= n) of the data, so the normal
+# equations of any lower order m are obtained by selecting rows/columns of monomials with p+q <= m (no access to the data).
+# The hash of the content of a file is calculated once per version (path, size, modification time) of the file and remembered
+# in the cache directory.
+# Entries are .npz files, least recently used entries (access time is stored as modification time of the file) are
+# removed when the total size of the cache exceeds max_bytes.
+#
+# Inspect or clear the cache :
+#    python fit_cache.py --cache_dir=DIR [--list] [--clear]
+#
+########################################################################################################################
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+import numpy as np
+
+try :
+   from . import fit_engine
+except ImportError :
+   import fit_engine
+
+DEFAULT_MAX_BYTES = 1024*1024*1024
+
+# version of the format of the entries, included in the keys :
+CACHE_VERSION = 1
+
+# size of blocks in which the input file is read to calculate its hash :
+HASH_BLOCK_BYTES = 16*1024*1024
+
+########################################################################################################################################
+# RETURNS hex digest of SHA-256 of the content of a file
+########################################################################################################################################
+def calc_file_hash( filename, block_bytes=HASH_BLOCK_BYTES ) :
+   import hashlib # imported only when the cache is used (fast import of the package)
+
+   sha = hashlib.sha256()
+   with open(filename,'rb') as f :
+      while True :
+         buf = f.read( block_bytes )
+         if len(buf) <= 0 :
+            break
+         sha.update( buf )
+
+   return sha.hexdigest()
+
+########################################################################################################################################
+# RETURNS indexes of the parameters of order m polynomial in the vector of parameters of order n >= m (order of get_exponents)
+########################################################################################################################################
+def get_lower_order_indexes( n, m ) :
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+
+   return np.nonzero( (p_exp + q_exp) <= m )[0]
+
+class FitCache :
+   def __init__( self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, verbose=0 ) :
+      self.cache_dir = cache_dir
+      self.max_bytes = max_bytes
+      self.verbose = verbose
+      os.makedirs( cache_dir, exist_ok=True )
+
+   #####################################################################################################################################
+   # RETURNS hash of the content of the file, remembered for the current version (path,size,modification time) of the file
+   #####################################################################################################################################
+   def get_file_hash( self, filename ) :
+      import hashlib
+
+      st = os.stat( filename )
+      version = ("%s %d %d" % (os.path.abspath(filename),st.st_size,st.st_mtime_ns))
+      hash_file = os.path.join( self.cache_dir, "file_%s.txt" % (hashlib.sha256( version.encode() ).hexdigest()) )
+
+      if os.path.exists( hash_file ) :
+         with open(hash_file,"r") as f :
+            return f.read().strip()
+
+      file_hash = calc_file_hash( filename )
+      def write_hash( tmp_file ) :
+         with open(tmp_file,"w") as f :
+            f.write( file_hash + "\n" )
+
+      self.write_atomic( hash_file, write_hash )
+      if self.verbose > 0 :
+         print("DEBUG : hash of file %s = %s" % (filename,file_hash))
+
+      return file_hash
+
+   #####################################################################################################################################
+   # RETURNS key of the cache entry for the data (hash of the file content), columns, image_size and basis of the polynomial
+   #####################################################################################################################################
+   def get_key( self, data_hash, columns=(0,1,2), image_size=8192, basis="monomial" ) :
+      import hashlib
+
+      params = { "version" : CACHE_VERSION, "data" : data_hash, "columns" : [ int(c) for c in columns ], "image_size" : image_size }
+      if basis != "monomial" :
+         # normal equations of orthogonal bases (see orthogonal_basis.py), keys of the monomial fits are not changed :
+         params["basis"] = basis
+
+      return hashlib.sha256( json.dumps( params, sort_keys=True ).encode() ).hexdigest()
+
+   def get_entry_filename( self, key ) :
+      return os.path.join( self.cache_dir, "fit_%s.npz" % (key) )
+
+   #####################################################################################################################################
+   # Writes file through a temporary file and os.replace, so that other processes never see partially written entries
+   #####################################################################################################################################
+   def write_atomic( self, filename, write_func ) :
+      tmp_file = filename + (".tmp%d" % os.getpid())
+      try :
+         write_func( tmp_file )
+         os.replace( tmp_file, filename )
+      except OSError :
+         print("WARNING : could not save cache file %s" % (filename))
+         if os.path.exists( tmp_file ) :
+            os.remove( tmp_file )
+
+   #####################################################################################################################################
+   # RETURNS dictionary with keys order, gram, rhs, sum_z2, n_points, x_c, y_c, x_range, y_range ((min,max) of the data, None for
+   # entries saved without them) and a (coefficients, None if they were solved for a different order or with a different solver) for
+   # polynomial of order n, or None if there is no entry with order >= n
+   #####################################################################################################################################
+   def load( self, key, n, solver=None ) :
+      entry_file = self.get_entry_filename( key )
+      if not os.path.exists( entry_file ) :
+         return None
+
+      try :
+         with np.load( entry_file ) as data :
+            entry = { name : data[name] for name in data.files }
+      except (OSError,ValueError) :
+         print("WARNING : could not read cache file %s -> ignored" % (entry_file))
+         return None
+
+      order = int( entry["order"] )
+      if order < n :
+         if self.verbose > 0 :
+            print("DEBUG : cache entry %s has order %d < %d" % (entry_file,order,n))
+         return None
+
+      # mark as recently used :
+      os.utime( entry_file, None )
+
+      a = None
+      if order == n and str( entry["solver"] ) == solver :
+         a = entry["a"]
+      indexes = get_lower_order_indexes( order, n )
+      if self.verbose > 0 :
+         print("DEBUG : normal equations of order %d served from cache entry %s of order %d" % (n,entry_file,order))
+
+      (x_range,y_range) = (None,None)
+      if "x_range" in entry and "y_range" in entry :
+         (x_range,y_range) = (tuple( entry["x_range"].tolist() ),tuple( entry["y_range"].tolist() ))
+
+      return { "order" : n, "gram" : entry["gram"][np.ix_(indexes,indexes)], "rhs" : entry["rhs"][indexes], "sum_z2" : float( entry["sum_z2"] ),
+               "n_points" : int( entry["n_points"] ), "x_c" : float( entry["x_c"] ), "y_c" : float( entry["y_c"] ), "x_range" : x_range, "y_range" : y_range, "a" : a }
+
+   #####################################################################################################################################
+   # Saves normal equations and coefficients of order n fit. An existing entry of a higher order is kept (it also serves order n)
+   #   x_range, y_range : (min,max) of the data coordinates (extent of the residual maps of a fit served from the cache)
+   #####################################################################################################################################
+   def save( self, key, n, gram, rhs, sum_z2, n_points, x_c, y_c, a, solver, x_range=None, y_range=None ) :
+      entry_file = self.get_entry_filename( key )
+      if os.path.exists( entry_file ) :
+         try :
+            with np.load( entry_file ) as data :
+               if int( data["order"] ) > n :
+                  return
+         except (OSError,ValueError) :
+            pass
+
+      def write_entry( tmp_file ) :
+         with open(tmp_file,"wb") as f :
+            ranges = {}
+            if x_range is not None and y_range is not None :
+               ranges = { "x_range" : np.array( x_range, dtype=np.float64 ), "y_range" : np.array( y_range, dtype=np.float64 ) }
+            np.savez( f, order=n, gram=gram, rhs=rhs, sum_z2=sum_z2, n_points=n_points, x_c=x_c, y_c=y_c, a=a, solver=solver, **ranges )
+
+      self.write_atomic( entry_file, write_entry )
+      if self.verbose > 0 :
+         print("DEBUG : fit of order %d saved to cache entry %s" % (n,entry_file))
+      self.evict()
+
+   #####################################################################################################################################
+   # RETURNS list of (filename,size,last_used) of all the files in the cache directory, least recently used first
+   #####################################################################################################################################
+   def list_entries( self ) :
+      entries = []
+      for name in os.listdir( self.cache_dir ) :
+         if not ( name.startswith("fit_") or name.startswith("file_") ) or ".tmp" in name :
+            continue
+         path = os.path.join( self.cache_dir, name )
+         try :
+            st = os.stat( path )
+         except OSError :
+            continue
+         entries.append( (path,st.st_size,st.st_mtime) )
+
+      return sorted( entries, key=lambda entry : entry[2] )
+
+   def get_size( self ) :
+      return sum( [ entry[1] for entry in self.list_entries() ] )
+
+   #####################################################################################################################################
+   # Removes least recently used files until the total size of the cache is not larger than max_bytes
+   #####################################################################################################################################
+   def evict( self ) :
+      entries = self.list_entries()
+      total_size = sum( [ entry[1] for entry in entries ] )
+
+      for (path,size,last_used) in entries :
+         if total_size <= self.max_bytes :
+            break
+         try :
+            os.remove( path )
+            total_size -= size
+            if self.verbose > 0 :
+               print("DEBUG : cache file %s removed (least recently used)" % (path))
+         except OSError :
+            print("WARNING : could not remove cache file %s" % (path))
+
+   #####################################################################################################################################
+   # Removes all the entries, RETURNS number of removed files
+   #####################################################################################################################################
+   def clear( self ) :
+      entries = self.list_entries()
+      for (path,size,last_used) in entries :
+         try :
+            os.remove( path )
+         except OSError :
+            print("WARNING : could not remove cache file %s" % (path))
+
+      return len(entries)
+
+   #####################################################################################################################################
+   # Prints entries of the cache (order and number of points of the fits)
+   #####################################################################################################################################
+   def print_entries( self ) :
+      entries = self.list_entries()
+      print("# FILE SIZE[bytes] LAST_USED ORDER N_POINTS")
+      for (path,size,last_used) in entries :
+         (order,n_points) = ("-","-")
+         if os.path.basename( path ).startswith("fit_") :
+            try :
+               with np.load( path ) as data :
+                  (order,n_points) = ("%d" % data["order"],"%d" % data["n_points"])
+            except (OSError,ValueError) :
+               pass
+         print("%s %d %s %s %s" % (os.path.basename(path),size,time.strftime( "%Y-%m-%d_%H:%M:%S", time.localtime(last_used) ),order,n_points))
+
+      print("Cache %s : %d files , %d bytes (limit %d bytes)" % (self.cache_dir,len(entries),sum( [ entry[1] for entry in entries ] ),self.max_bytes))
+
+
+def parse_options():
+   usage="Usage: %prog [options]\n"
+   usage+='\tInspect or clear the cache of fits\n'
+   parser = OptionParser(usage=usage,version=1.00)
+   parser.add_option('--cache_dir','--dir',dest="cache_dir",default=None, help="Cache directory [default %default]",type="string")
+   parser.add_option('--list','--ls',action="store_true",dest="list_entries",default=False, help="List cache entries [default %default]")
+   parser.add_option('--clear','--remove_all',action="store_true",dest="clear",default=False, help="Remove all cache entries [default %default]")
+   parser.add_option('--max_mb','--cache_max_mb',dest="max_mb",default=DEFAULT_MAX_BYTES//(1024*1024), help="Size limit of the cache in MB, least recently used entries above it are removed [default %default]",type="int")
+
+   (options, args) = parser.parse_args()
+
+   return (options, args)
+
+if __name__ == '__main__':
+   (options, args) = parse_options()
+   if options.cache_dir is None :
+      print("ERROR : cache directory not specified (use --cache_dir=DIR)")
+      sys.exit(-1)
+
+   cache = FitCache( options.cache_dir, max_bytes=options.max_mb*1024*1024 )
+   if options.clear :
+      n_removed = cache.clear()
+      print("Removed %d files from cache %s" % (n_removed,options.cache_dir))
+   else :
+      cache.evict()
+      cache.print_entries()
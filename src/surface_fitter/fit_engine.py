@@ -0,0 +1,323 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Vectorised least-squares engine for the polynomial surface fit.
+# The monomial design matrix X[k,m] = x_k^p_m * y_k^q_m is built with NumPy (exponents in the same (p,q) order as
+# get_polynonial in fit_poly_3d.py) and the normal equations (X^T X) a = X^T z are accumulated in row chunks, so that
+# the memory used is O(chunk_size*P) and not O(N*P). The system can then be solved with one of the SOLVERS :
+#    cholesky : Cholesky factorisation of the normal equations (default)
+#    solve    : np.linalg.solve of the normal equations (as in the original loop-based code)
+#    lstsq    : least-squares (QR/SVD) solution directly on the design matrix, better conditioned but O(N*P) memory
+#    qr       : QR factorisation of the design matrix updated chunk by chunk (R of the previous chunks stacked with the next
+#               chunk), i.e. the accuracy of lstsq with O(chunk_size*P) memory
+# Instead of monomials the polynomial can be expressed in the Legendre or Chebyshev basis (see orthogonal_basis.py).
+#
+########################################################################################################################
+import numpy as np
+
+try :
+   from . import orthogonal_basis
+except ImportError :
+   import orthogonal_basis
+
+SOLVERS = ["cholesky","solve","lstsq","qr"]
+
+# number of data points processed at once when building the design matrix :
+DEFAULT_CHUNK_SIZE = 65536
+
+########################################################################################################################################
+# Normalised coordinates (values - centre)/scale of an array-like (array of any float type, memory-mapped array or list) calculated
+# only for the requested elements or chunk (as float64), so that the input is never modified or copied as a whole : obj[start:end]
+# RETURNS a normalised float64 chunk and np.asarray( obj ) the whole normalised array (only when really required, e.g. lstsq)
+########################################################################################################################################
+class NormalisedArray :
+   def __init__( self, values, centre, scale ) :
+      self.values = values
+      self.centre = float(centre)
+      self.scale = float(scale)
+
+   def __len__( self ) :
+      return len(self.values)
+
+   @property
+   def shape( self ) :
+      return (len(self.values),)
+
+   def __getitem__( self, index ) :
+      return ( np.asarray( self.values[index], dtype=np.float64 ) - self.centre ) / self.scale
+
+   def __array__( self, dtype=None, copy=None ) :
+      values = self[:]
+      if dtype is not None :
+         values = values.astype( dtype, copy=False )
+      return values
+
+########################################################################################################################################
+# RETURNS Sum z^2 in float64 for array-like z of any float type (in chunks, no float64 copy of the whole array)
+########################################################################################################################################
+def calc_sum_squares( z, chunk_size=DEFAULT_CHUNK_SIZE ) :
+   sum_z2 = 0.00
+   for start in range(0,len(z),chunk_size) :
+      z_chunk = np.asarray( z[start:start+chunk_size], dtype=np.float64 )
+      sum_z2 += np.dot( z_chunk, z_chunk )
+
+   return sum_z2
+
+########################################################################################################################################
+# RETURNS number of parameters of a polynomial of order n, i.e. (n+1)*(n+2)/2
+########################################################################################################################################
+def get_n_params( n ) :
+   return ((n+1)*(n+2)) // 2
+
+########################################################################################################################################
+# RETURNS arrays of exponents p and q (x^p*y^q) in the same order as used by get_polynonial and calc_polynonial
+########################################################################################################################################
+def get_exponents( n ) :
+   p_list = []
+   q_list = []
+   for p in range(0,n+1) :
+      for q in range(0,n-p+1) :
+         p_list.append(p)
+         q_list.append(q)
+
+   return (np.array(p_list,dtype=int),np.array(q_list,dtype=int))
+
+########################################################################################################################################
+# RETURNS list of [a_pq,p,q] (the same format as get_polynonial in fit_poly_3d.py) for coefficients a in the order of get_exponents
+########################################################################################################################################
+def get_coeff_list( a, n ) :
+   (p_exp,q_exp) = get_exponents( n )
+
+   return [ [a[m],int(p_exp[m]),int(q_exp[m])] for m in range(0,len(p_exp)) ]
+
+########################################################################################################################################
+# Calculates table of powers [x^0, x^1, ... , x^max_power] by repeated multiplication (faster and more accurate than x**p)
+########################################################################################################################################
+def calc_powers( x, max_power ) :
+   powers = [ np.ones_like(x) ]
+   for i in range(1,max_power+1) :
+      powers.append( powers[i-1]*x )
+
+   return powers
+
+########################################################################################################################################
+# Calculates table of basis functions [B_0(x), ... , B_n(x)] : powers of x for the monomial basis (see orthogonal_basis.py)
+########################################################################################################################################
+def calc_basis_powers( x, n, basis="monomial" ) :
+   if basis == "monomial" :
+      return calc_powers( x, n )
+
+   return orthogonal_basis.calc_basis_values( x, n, basis=basis )
+
+########################################################################################################################################
+# Calculates design matrix X[k,m] = x_k^p_m * y_k^q_m for (already normalised) coordinates x and y
+#   out   : optional pre-allocated array of shape (len(x),n_params) to be filled
+#   basis : monomial (default), legendre or chebyshev - then X[k,m] = B_p_m(x_k) * B_q_m(y_k)
+#   The matrix is allocated in the Fortran (column-major) order, so that every monomial column is written contiguously
+########################################################################################################################################
+def calc_design_matrix( x, y, n, out=None, basis="monomial" ) :
+   x = np.asarray( x, dtype=np.float64 )
+   y = np.asarray( y, dtype=np.float64 )
+   (p_exp,q_exp) = get_exponents( n )
+
+   if out is None :
+      out = np.empty( (len(x),len(p_exp)), dtype=np.float64, order="F" )
+
+   x_powers = calc_basis_powers( x, n, basis=basis )
+   y_powers = calc_basis_powers( y, n, basis=basis )
+   for m in range(0,len(p_exp)) :
+      np.multiply( x_powers[p_exp[m]], y_powers[q_exp[m]], out=out[:,m] )
+
+   return out
+
+########################################################################################################################################
+# Accumulates normal equations : gram = X^T X and rhs = X^T z for normalised coordinates x,y and values z
+#   Data are processed in chunks of chunk_size points, so that the full design matrix is never kept in memory
+#   z can also be a 2D array of shape (N,n_columns) with many value columns, rhs has then shape (n_params,n_columns)
+#   weights : optional weights of the points (weighted least squares : gram = X^T W X , rhs = X^T W z)
+########################################################################################################################################
+def calc_normal_equations( x, y, z, n, chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial", weights=None ) :
+   n_params = get_n_params( n )
+   len_data = len(z)
+   gram = np.zeros( (n_params,n_params) )
+   rhs  = np.zeros( (n_params,) + np.shape(z)[1:] )
+
+   design = None
+   for start in range(0,len_data,chunk_size) :
+      end = min( start + chunk_size, len_data )
+      if design is None or design.shape[0] != (end-start) :
+         design = np.empty( (end-start,n_params), order="F" )
+      calc_design_matrix( x[start:end], y[start:end], n, out=design, basis=basis )
+
+      z_chunk = np.asarray( z[start:end], dtype=np.float64 )
+      if weights is not None :
+         w_chunk = np.asarray( weights[start:end], dtype=np.float64 )
+         gram += np.dot( design.T, w_chunk[:,None]*design )
+         rhs  += np.dot( design.T, ( w_chunk*z_chunk.T ).T )
+      else :
+         gram += np.dot( design.T, design )
+         rhs  += np.dot( design.T, z_chunk )
+
+   return (gram,rhs)
+
+########################################################################################################################################
+# Solves normal equations gram * a = rhs using the required solver (cholesky or solve, lstsq and qr are replaced by cholesky)
+#   rhs can be a 2D array (n_params,n_columns), the matrix is then factorised once and solved for all the columns
+########################################################################################################################################
+def solve_normal_equations( gram, rhs, solver="cholesky" ) :
+   if solver in ("lstsq","qr") :
+      # only the normal equations are available (e.g. read from the cache of fits) :
+      solver = "cholesky"
+
+   if solver == "cholesky" :
+      import scipy.linalg
+      try :
+         c_and_lower = scipy.linalg.cho_factor( gram )
+         return scipy.linalg.cho_solve( c_and_lower, rhs )
+      except np.linalg.LinAlgError :
+         print("WARNING : normal equations are not positive definite -> using np.linalg.solve instead of Cholesky decomposition")
+
+   elif solver != "solve" :
+      print("ERROR : solver %s cannot be used for normal equations, allowed are : cholesky, solve" % (solver))
+      raise ValueError("Unknown solver %s" % (solver))
+
+   return np.linalg.solve( gram, rhs )
+
+########################################################################################################################################
+# Least-squares solution by QR factorisation of the design matrix calculated in chunks : the triangular matrix R of the already
+# processed rows is stacked with the design matrix of the next chunk and factorised again. The values z are appended as the last
+# columns of the design matrix, so that Q^T z are the last columns of the triangular factor (Q is never calculated)
+# RETURNS : (a,gram,rhs) , where gram = R^T R and rhs = R^T Q^T z are the normal equations
+########################################################################################################################################
+def fit_qr( x, y, z, n, chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial" ) :
+   n_params = get_n_params( n )
+   n_columns = 1 if np.ndim( z ) == 1 else np.shape( z )[1]
+   # triangular factor of the design matrix augmented by the values [D | z] (Q is never formed) :
+   r_aug = np.zeros( (0,n_params + n_columns) )
+
+   for start in range(0,len(z),chunk_size) :
+      end = min( start + chunk_size, len(z) )
+      design = calc_design_matrix( x[start:end], y[start:end], n, basis=basis )
+      chunk = np.hstack( (design,np.asarray( z[start:end], dtype=np.float64 ).reshape( end - start, n_columns )) )
+      r_aug = np.linalg.qr( np.vstack( (r_aug,chunk) ), mode="r" )
+
+   r = r_aug[:n_params,:n_params]
+   qt_z = r_aug[:n_params,n_params:]
+   if np.ndim( z ) == 1 :
+      qt_z = qt_z[:,0]
+
+   if r.shape[0] < n_params :
+      a = np.linalg.lstsq( r, qt_z, rcond=None )[0]
+   else :
+      import scipy.linalg
+      a = scipy.linalg.solve_triangular( r, qt_z )
+
+   return (a,np.dot( r.T, r ),np.dot( r.T, qt_z ))
+
+########################################################################################################################################
+# Main function of the engine, fits polynomial of order n to normalised coordinates x,y and values z
+#   basis : monomial (default), legendre or chebyshev (see orthogonal_basis.py)
+# RETURNS : (ok,a,gram,rhs) , where a are coefficients in the order of get_exponents and gram,rhs are the normal equations
+#   for 2D z of shape (N,n_columns) a and rhs have shape (n_params,n_columns)
+########################################################################################################################################
+def fit_normalised( x, y, z, n, solver="cholesky", chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial" ) :
+   if solver not in SOLVERS :
+      print("ERROR : unknown solver %s, allowed are : %s" % (solver,SOLVERS))
+      raise ValueError("Unknown solver %s" % (solver))
+
+   if solver == "lstsq" :
+      design = calc_design_matrix( x, y, n, basis=basis )
+      z_arr = np.asarray( z, dtype=np.float64 )
+      (a,residuals,rank,sv) = np.linalg.lstsq( design, z_arr, rcond=None )
+      gram = np.dot( design.T, design )
+      rhs  = np.dot( design.T, z_arr )
+   elif solver == "qr" :
+      (a,gram,rhs) = fit_qr( x, y, z, n, chunk_size=chunk_size, basis=basis )
+   else :
+      (gram,rhs) = calc_normal_equations( x, y, z, n, chunk_size=chunk_size, basis=basis )
+      a = solve_normal_equations( gram, rhs, solver=solver )
+
+   # check if ok solution :
+   ok = np.allclose( np.dot(gram, a), rhs )
+
+   return (ok,a,gram,rhs)
+
+########################################################################################################################################
+# RETURNS coefficients a (order of get_exponents) as a matrix A[p,q] = a_pq of shape (n+1,n+1), A[p,q] = 0 for p+q > n
+########################################################################################################################################
+def get_coeff_matrix( a, n ) :
+   (p_exp,q_exp) = get_exponents( n )
+   coeff_matrix = np.zeros( (n+1,n+1) )
+   coeff_matrix[p_exp,q_exp] = a
+
+   return coeff_matrix
+
+########################################################################################################################################
+# Calculates values of polynomial with coefficients a (order of get_exponents) in normalised coordinates x,y (in chunks)
+#   for 2D a of shape (n_params,n_columns) values of all the polynomials are returned as array (N,n_columns)
+#   basis : monomial (default), legendre or chebyshev (see orthogonal_basis.py)
+########################################################################################################################################
+def calc_poly_values( x, y, a, n, chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial" ) :
+   a = np.asarray( a, dtype=np.float64 )
+
+   if a.ndim > 1 :
+      out = np.empty( (len(x),) + a.shape[1:] )
+      for col in range(0,a.shape[1]) :
+         out[:,col] = calc_poly_values( x, y, a[:,col], n, chunk_size=chunk_size, basis=basis )
+      return out
+
+   return calc_poly_values_matrix( x, y, get_coeff_matrix( a, n ), chunk_size=chunk_size, basis=basis )
+
+########################################################################################################################################
+# Calculates values of polynomial with coefficients in the matrix form A[p,q] = a_pq (see get_coeff_matrix) for 1D arrays x,y (in chunks)
+# p(x,y) = Sum_p c_p(y) x^p , where c_p(y) = Sum_q a_pq y^q are calculated for a chunk of points as a single matrix product A * [y^q]
+# and the sum over p with the Horner scheme, so the design matrix is not required
+# (the Clenshaw recurrence is used instead of the Horner scheme for the legendre and chebyshev bases, see orthogonal_basis.py)
+########################################################################################################################################
+def calc_poly_values_matrix( x, y, coeff_matrix, chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial" ) :
+   if basis != "monomial" :
+      return orthogonal_basis.calc_values_matrix( x, y, coeff_matrix, basis=basis, chunk_size=chunk_size )
+
+   len_data = len(x)
+   out = np.empty( len_data )
+   n_x = coeff_matrix.shape[0] - 1
+   n_y = coeff_matrix.shape[1] - 1
+
+   for start in range(0,len_data,chunk_size) :
+      end = min( start + chunk_size, len_data )
+      x_chunk = np.asarray( x[start:end], dtype=np.float64 )
+      y_powers = np.array( calc_powers( np.asarray( y[start:end], dtype=np.float64 ), n_y ) )
+      c_p = np.dot( coeff_matrix, y_powers )
+
+      val = c_p[n_x].copy()
+      for p in range(n_x-1,-1,-1) :
+         val *= x_chunk
+         val += c_p[p]
+      out[start:end] = val
+
+   return out
+
+########################################################################################################################################
+# Calculates gradient X^T (Xa - z) (half of the derivatives of chi2 by the coefficients) in one pass over the data (in chunks)
+########################################################################################################################################
+def calc_gradient( x, y, z, a, n, chunk_size=DEFAULT_CHUNK_SIZE, basis="monomial" ) :
+   len_data = len(z)
+   gradient = np.zeros( np.shape(a) )
+
+   for start in range(0,len_data,chunk_size) :
+      end = min( start + chunk_size, len_data )
+      design = calc_design_matrix( x[start:end], y[start:end], n, basis=basis )
+      residuals = np.dot( design, a ) - np.asarray( z[start:end], dtype=np.float64 )
+      gradient += np.dot( design.T, residuals )
+
+   return gradient
+
+########################################################################################################################################
+# RETURNS monomial coefficients (order of get_exponents) of the polynomial with coefficients a of order n in the given basis
+########################################################################################################################################
+def to_monomial( a, n, basis="monomial" ) :
+   if basis == "monomial" :
+      return np.asarray( a, dtype=np.float64 )
+   (p_exp,q_exp) = get_exponents( n )
+
+   return orthogonal_basis.to_monomial( a, p_exp, q_exp, basis=basis )
@@ -6,7 +6,7 @@ from __future__ import print_function
 #
 #  Test :
 #    # generates points from surface : val = 2.0*xp**3 + 1.0*(xp**2)*(yp) + 3.0*(xp)*(yp**2) + 4*xp*yp + 3*xp + yp + 10 
-#    python ./surface_generator.py > test.txt
+#    python ./surface_generator.py   # saves test.txt
 # 
 #    # fit 3 order polynomial:
 #    python ./fit_poly_3d.py test.txt --order=3 
@@ -36,14 +36,52 @@ from __future__ import print_function
 import numpy as np
 import os
 import sys
-import scipy.linalg
 import copy
 from optparse import OptionParser,OptionGroup
 import re
 
-import matplotlib as m
-import matplotlib.pyplot as plt
-plt.style.use('seaborn-v0_8-whitegrid') # in python2 was : seaborn-whitegrid')
+
+try :
+   from . import fit_engine
+   from . import streaming_fit
+   from . import data_reader
+   from . import parallel_fit
+   from . import grid_eval
+   from . import order_sweep
+   from . import robust_fit
+   from . import fitted_surface
+   from . import fit_cache
+   from . import plot_scatter_3d
+   from . import fit_stats
+   from . import text_writer
+   from . import orthogonal_basis
+   from . import grid_fit
+   from . import tiled_fit
+   from . import coreset
+   from . import residual_maps
+except ImportError :
+   # when executed as a script (python ./fit_poly_3d.py) and not as a part of the package :
+   import fit_engine
+   import streaming_fit
+   import data_reader
+   import parallel_fit
+   import grid_eval
+   import order_sweep
+   import robust_fit
+   import fitted_surface
+   import fit_cache
+   import plot_scatter_3d
+   import fit_stats
+   import text_writer
+   import orthogonal_basis
+   import grid_fit
+   import tiled_fit
+   import coreset
+   import residual_maps
+
+
+# number of points evaluated and written to the fitted_vs_data file at once in fit_poly_base :
+EVAL_BLOCK_SIZE = text_writer.DEFAULT_BLOCK_ROWS
 
 def parse_options():
    usage="Usage: %prog [options]\n"
@@ -55,6 +93,37 @@ def parse_options():
    parser.add_option('--image_size','--size',dest="image_size",default=8192, help="Image size [default %]",type="int")
    parser.add_option('--ncols','--n_columns','--num_columns',dest="ncols",default=10, help="Number of columns in a file [default %]",type="int")
    parser.add_option('--verb','--verbose','--debug_level',dest="verbose",default=0, help="Verbosity level [default %]",type="int")
+   parser.add_option('--solver',dest="solver",default="cholesky", help="Solver of the least-squares problem : cholesky, solve, lstsq or qr [default %default]",type="string")
+   parser.add_option('--basis',dest="basis",default="monomial", help="Basis of the polynomial : monomial, legendre or chebyshev (stable fits of orders 15+), the printed and returned coefficients [a_pq,p,q] are always monomial [default %default]",type="string")
+   parser.add_option('--chunk_size','--chunk',dest="chunk_size",default=0, help="Read input file in chunks of this number of lines and fit with out-of-core streaming fitter, <=0 reads the whole file [default %default]",type="int")
+   parser.add_option('--no_cache',action="store_false",dest="use_cache",default=True, help="Do not cache parsed input file in a .npy file next to it [default %default]")
+   parser.add_option('--workers','--n_workers',dest="workers",default=1, help="Number of processes used to build the normal equations [default %default]",type="int")
+   parser.add_option('--zcols','--value_columns',dest="zcols",default=None, help="Comma separated list of value columns fitted at once with the same X Y (e.g. 2,3,9), default only column 2 is fitted [default %default]",type="string")
+   parser.add_option('--grid_step','--step',dest="grid_step",default=10, help="Step in pixels of the grid of the fitted surface saved to fitted_orderNN.txt [default %default]",type="int")
+   parser.add_option('--grid_region','--region',dest="grid_region",default=None, help="Region of the fitted surface grid x_start,x_end,y_start,y_end [default whole image]",type="string")
+   parser.add_option('--grid_npy','--grid_outfile',dest="grid_npy",default=None, help="Save fitted surface grid to this memory-mapped .npy file instead of fitted_orderNN.txt [default %default]",type="string")
+   parser.add_option('--threads','--n_threads',dest="threads",default=1, help="Number of threads used to evaluate the fitted surface grid [default %default]",type="int")
+   parser.add_option('--order_sweep','--sweep',dest="order_sweep",default=None, help="Fit all orders in the range MIN:MAX using moments calculated once and report chi2, AIC, BIC and cross-validation error (e.g. 1:9) [default %default]",type="string")
+   parser.add_option('--kfold','--n_folds',dest="kfold",default=5, help="Number of folds of cross-validation in the --order_sweep mode, <=1 disables cross-validation [default %default]",type="int")
+   parser.add_option('--diagnostics','--check',action="store_true",dest="diagnostics",default=False, help="Check the solution : gradient of chi2 and condition number of the normal equations [default %default]")
+   parser.add_option('--robust',dest="robust",default=None, help="Robust fitting method : sigma_clip, huber or tukey [default %default - not robust]",type="string")
+   parser.add_option('--robust_threshold','--clip_threshold',dest="robust_threshold",default=3.00, help="Threshold of the robust fit in units of sigma of the residuals [default %default]",type="float")
+   parser.add_option('--robust_iter','--clip_iter',dest="robust_iter",default=10, help="Maximum number of iterations of the robust fit [default %default]",type="int")
+   parser.add_option('--save_surface','--surface_file',dest="surface_file",default=None, help="Save fitted surface (coefficients, centre and scale) to .npz or .json file, which can be loaded with FittedSurface.load [default %default]",type="string")
+   parser.add_option('--cache_dir',dest="cache_dir",default=None, help="Directory of the cache of fits (normal equations and coefficients keyed by the hash of the input data), inspect or clear it with fit_cache.py [default %default - not used]",type="string")
+   parser.add_option('--cache_max_mb',dest="cache_max_mb",default=fit_cache.DEFAULT_MAX_BYTES//(1024*1024), help="Size limit of the cache of fits in MB, least recently used entries are removed [default %default]",type="int")
+   parser.add_option('--stats_file','--timing_file',dest="stats_file",default=None, help="Append wall time, CPU time, peak RSS and number of points of every stage of the fit as a JSON line to this file [default %default]",type="string")
+   parser.add_option('--output_format','--fitted_vs_data_format',dest="output_format",default="txt", help="Format of the fitted_vs_data_orderNN file : txt, npy (binary, columns X Y FIT DATA DATA-FIT in rows, readable by plot_scatter_3d.py) or none (not written, e.g. with --residual_bins) [default %default]",type="string")
+   parser.add_option('--residual_bins','--residual_maps',dest="residual_bins",default=0, help="Calculate count, mean, RMS, median and MAD of the residuals in N x N cells of the image during the evaluation of the fit and save them to residual_stats_orderNN.npz (see residual_maps.py) [default %default - not calculated]",type="int")
+   parser.add_option('--residual_file',dest="residual_file",default=None, help="Output file of the binned residual statistics [default residual_stats_orderNN.npz]",type="string")
+   parser.add_option('--tiles','--n_tiles',dest="n_tiles",default=0, help="Fit polynomials of order --order to N x N overlapping tiles of the image in parallel (--workers, default all cores) and blend them smoothly, the map is saved to --grid_npy (default fitted_tiles_orderNN.npy) [default %default - single polynomial]",type="int")
+   parser.add_option('--tile_overlap','--overlap',dest="tile_overlap",default=tiled_fit.DEFAULT_OVERLAP, help="Extension of every tile on each side in units of the tile size, 0 < overlap <= 0.5 [default %default]",type="float")
+   parser.add_option('--subsample','--coreset',dest="subsample",default=0, help="Fit a weighted subsample of about this number of points drawn without reading the whole file (see coreset.py), for very large inputs [default %default - all points]",type="int")
+   parser.add_option('--subsample_method',dest="subsample_method",default="stratified", help="Subsampling method : stratified (spatially balanced over the image), leverage or uniform [default %default]",type="string")
+   parser.add_option('--subsample_tolerance','--tolerance',dest="subsample_tolerance",default=None, help="Required maximum error of the fitted surface with respect to the fit of all the points, the subsample is enlarged until the error bound (--subsample_confidence standard errors) is below it [default %default - single subsample]",type="float")
+   parser.add_option('--subsample_confidence',dest="subsample_confidence",default=coreset.DEFAULT_CONFIDENCE, help="Confidence factor k - the error bound k*(maximum standard error of the surface) is compared with --subsample_tolerance [default %default]",type="float")
+   parser.add_option('--validate','--holdout',dest="validate",default=0, help="Validate the subsample fit on an independent held-out sample of this number of points [default %default]",type="int")
+   parser.add_option('--no_grid',action="store_false",dest="detect_grid",default=True, help="Do not detect data on a rectangular grid of X and Y (fitted with separable sums along the axes) [default detected]")
    parser.add_option('--no_files','--no_savefiles','--dont_save_files','--no_outputfiles',action="store_false",dest="save_files",default=True, help="Do not save results to text files just return then from the function [default %]")
    
    (options, args) = parser.parse_args()
@@ -63,40 +132,30 @@ def parse_options():
 
 
 
-def read_text_file( filename , verbose=0, ncols=10 ) :
-   x_list = []
-   y_list = []
-   calconst_list = []
-
-   if os.path.exists(filename) and os.stat(filename).st_size > 0 :
-      file=open(filename,'r')
-      data=file.readlines()
-      for line in data :
-         if line[0] != "#" :
-#            words = line.split(' ')
-            words = re.split( '\s+' , line )
-         
-            if verbose > 0 : 
-               print("DEBUG : line = %s -> |%s|%s|" % (line,words[0+0],words[1+0]))
-
-            x = float(words[0+0])
-            y = float(words[1+0])
-            calconst = float(words[2+0])
-         
-            x_list.append(x)
-            y_list.append(y)
-            calconst_list.append(calconst)
-            
-      file.close()      
-   else :
-      print("WARNING : empty or non-existing file %s" % (filename))
+########################################################################################################################################
+# Reads X Y Z (first 3 columns) from a text file, parsed columns are cached in a .npy file (see data_reader.py)
+# RETURNS : tuple of arrays (x,y,z)
+########################################################################################################################################
+def read_text_file( filename , verbose=0, ncols=10, use_cache=True ) :
+   (x_list,y_list,calconst_list) = data_reader.read_columns( filename, columns=(0,1,2), use_cache=use_cache, verbose=verbose )
 
    print("READ %d values from file %s" % (len(x_list),filename))
    
    return (x_list,y_list,calconst_list)
 
-def plot_scatter( filename , vmin=0.00, vmax=20.00 ) :   
+########################################################################################################################################
+# 2D scatter plot of file with columns X Y Z, more than max_scatter_points points are binned to an image (see plot_scatter_3d.py)
+#   outfile : the plot is saved to this file with the Agg backend (no display required) instead of being shown
+########################################################################################################################################
+def plot_scatter( filename , vmin=0.00, vmax=20.00, mode="auto", n_bins=512, statistic="mean", max_scatter_points=plot_scatter_3d.DEFAULT_MAX_SCATTER_POINTS, outfile=None ) :   
    (x_list,y_list,calconst_list) = read_text_file( filename )
+   if mode == "auto" :
+      mode = ( "scatter" if len(x_list) <= max_scatter_points else "image" )
+   if mode != "scatter" :
+      plot_scatter_3d.plot_binned( x_list, y_list, calconst_list, vmin=vmin, vmax=vmax, n_bins=n_bins, statistic=statistic, mode=mode, outfile=outfile )
+      return
+
+   (m,plt) = plot_scatter_3d.import_matplotlib( backend=( "Agg" if outfile is not None else None ) )
    # rng = np.random.RandomState(0)
    x = x_list # rng.randn(100)
    y = y_list # rng.randn(100)
@@ -124,7 +183,7 @@ def plot_scatter( filename , vmin=0.00, vmax=20.00 ) :
    # plt.scatter(x, y, c=colors, s=sizes, alpha=0.3, cmap=cm )
    plt.scatter(x, y, c=colors, s=sizes, alpha=1.0, cmap='rainbow', vmin=vmin, vmax=vmax ) # cmap='viridis')
    plt.colorbar();  # show color scale   
-   plt.show()
+   plot_scatter_3d.show_or_save( plt, outfile )
 
 ########################################################################################################################################
 # Calculates polynomial value for list of points x,y using coefficients in poly_coeff (order of polynomial is n)
@@ -191,258 +250,771 @@ def calc_polynonial_list( x , y , poly_coeff ) :
 
 
 ########################################################################################################################################
-# calculate derivatives (to check if they are indeed = 0 )
+# calculate derivatives (to check if they are indeed = 0 ) : dChi2/da_pq / 2 = Sum_k ( p(x_k,y_k) - z_k )*x_k^p*y_k^q , i.e. the 
+# gradient X^T (Xa - z) calculated in one pass over the data (in chunks of the design matrix)
 ########################################################################################################################################
-def calc_derivatives( x_list, y_list, z_list, poly_coeff, n ) :      
-   len_data = len(z_list)
-   n_params = len( poly_coeff )
-   param_index = 0
+def calc_derivatives( x_list, y_list, z_list, poly_coeff, n, basis="monomial" ) :      
+   gradient = fit_engine.calc_gradient( x_list, y_list, z_list, poly_coeff, n, basis=basis )
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
 
    print("Calculating derivatives by a_pq:")
-   for p in range(0,n+1) :   
-      # for q in range(0,p+1) : # q goes from 0 to p   
-      for q in range(0,n-p+1) :
-         if param_index >= n_params :
-            print("ERROR in code : trying to print parameter %d when there are only %d" % (param_index,n_params))
-          
-         # calculate derivative over a_pq
-         deriv_value = 0.00            
-         for k in range(0,len_data) :
-             xk = x_list[k]
-             yk = y_list[k]
-             
-             param_index2 = 0                          
-             sum = 0.00
-             for i in range(0,n+1) :
-                for j in range(0,n-i+1) :
-                   if param_index >= n_params :
-                      print("ERROR in code : trying to print parameter %d when there are only %d" % (param_index,n_params))
-                   
-                   sum += poly_coeff[param_index]*(xk**(i))*(yk**(j))
-                   
-             deriv_value += ( sum - z_list[k] )*(xk**(p))*(yk**(q))
-             
-         
-         print("dChi2/da_%d%d = %.8f" % (p,q,deriv_value))
-                   
+   for param_index in range(0,len(p_exp)) :
+      print("dChi2/da_%d%d = %.8f" % (p_exp[param_index],q_exp[param_index],gradient[param_index]))
+
+   return gradient
+
+########################################################################################################################################
+# Diagnostics of the solution (optional, not calculated by default) : gradient of chi2 (should be = 0), its maximum absolute value and
+# condition number of the normal equations. The gradient is calculated from the data (x_list,y_list,z_list) if provided, otherwise
+# from the accumulated normal equations as gram*a - rhs
+# RETURNS : dictionary with keys gradient, max_abs_gradient, condition_number
+########################################################################################################################################
+def check_solution( gram, rhs, a, n, x_list=None, y_list=None, z_list=None, basis="monomial" ) :
+   if x_list is not None :
+      gradient = calc_derivatives( x_list, y_list, z_list, a, n, basis=basis )
+   else :
+      gradient = np.dot( gram, a ) - rhs
+      (p_exp,q_exp) = fit_engine.get_exponents( n )
+      print("Calculating derivatives by a_pq (from normal equations):")
+      for param_index in range(0,len(p_exp)) :
+         print("dChi2/da_%d%d = %.8f" % (p_exp[param_index],q_exp[param_index],gradient[param_index]))
+
+   max_abs_gradient = np.max( np.abs( gradient ) )
+   condition_number = np.linalg.cond( gram )
+   print("Diagnostics : max |dChi2/da_pq| = %.8e , condition number of normal equations = %.4e" % (max_abs_gradient,condition_number))
+
+   return { "gradient" : gradient, "max_abs_gradient" : max_abs_gradient, "condition_number" : condition_number }
+
+################################################################################################################################################
+# RETURNS centre of the image (x_c,y_c) used to normalise coordinates to [-1,1] : image_size/2 or, when image_size <= 0, the centre of the data
+################################################################################################################################################
+def calc_image_centre( x_list, y_list, image_size ) :
+   if image_size is None or image_size <= 0 :
+      x_c = ( float( np.min(x_list) ) + float( np.max(x_list) ) ) / 2.00
+      y_c = ( float( np.min(y_list) ) + float( np.max(y_list) ) ) / 2.00
+   else :
+      x_c = image_size / 2.00
+      y_c = image_size / 2.00
+
+   return (x_c,y_c)
+
+################################################################################################################################################
+# Prints fitted coefficients and the fitted polynomial, coefficients in the legendre or chebyshev basis are also converted to monomials
+################################################################################################################################################
+def print_polynomial( a, n, basis="monomial" ) :
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   if basis != "monomial" :
+      print("Coefficients in the %s basis :" % (basis))
+      for param_index in range(0,len(p_exp)) :
+         print("\t c_%d%d = %.8f" % (p_exp[param_index],q_exp[param_index],a[param_index]))
+      a = fit_engine.to_monomial( a, n, basis=basis )
+
+   print("Polynomial coefficients :")
+   polynomial_string = ""
+   for param_index in range(0,len(p_exp)) :
+      p = p_exp[param_index]
+      q = q_exp[param_index]
+      print("\t a_%d%d = %.8f" % (p,q,a[param_index]))
+      polynomial_string += (" %.8f*(x**%d)*(y**%d) + " % (a[param_index],p,q))
+
+   print("\n\nFitted polynomial p_n(x,y) = %s" % (polynomial_string))
+
+################################################################################################################################################
+# Opens fitted_vs_data file of n order fit :
+#   output_format = "txt" : text file fitted_vs_data_order%02d.txt with lines X Y FIT DATA DATA-FIT [MASK]
+#   output_format = "npy" : memory-mapped binary file fitted_vs_data_order%02d.npy with columns X Y FIT DATA DATA-FIT [MASK] in rows,
+#                           i.e. shape (5 or 6,n_points), which can be read directly by plot_scatter_3d.py (e.g. --plotcol=4 for residuals)
+#   output_format = "none" : file is not written (RETURNS None)
+# RETURNS : opened text file or memory-mapped array to be passed to save_fitted_vs_data and close_fitted_vs_data
+################################################################################################################################################
+def open_fitted_vs_data( n, n_points, with_mask=False, output_format="txt" ) :
+   if output_format == "none" :
+      print("WARNING : fitted values and residuals are not saved (output format none)")
+      return None
+   if output_format == "npy" :
+      outfile = ("fitted_vs_data_order%02d.npy" % n)
+      out_f = np.lib.format.open_memmap( outfile, mode="w+", dtype=np.float64, shape=( (6 if with_mask else 5), n_points ) )
+   elif output_format == "txt" :
+      outfile = ("fitted_vs_data_order%02d.txt" % n)
+      out_f = open(outfile,"w")
+      if with_mask :
+         out_f.write("# X  Y  FIT   DATA  DATA-FIT  MASK(1-used,0-rejected)\n")
+      else :
+         out_f.write("# X  Y  FIT   DATA  DATA-FIT\n")
+   else :
+      raise ValueError("Unknown output format %s (expected txt, npy or none)" % (output_format))
+
+   print("Saving fitted values and residuals to file %s" % (outfile))
+   return out_f
+
+def close_fitted_vs_data( out_f ) :
+   if isinstance( out_f, np.ndarray ) :
+      out_f.flush()
+   else :
+      out_f.close()
+
+################################################################################################################################################
+# Writes X Y FIT DATA DATA-FIT to fitted_vs_data file opened with open_fitted_vs_data, all columns are calculated as arrays and text is
+# formatted in large blocks (see text_writer.py)
+#   mask  : optional mask of points used in the (robust) fit, written as an additional column (1-used,0-rejected)
+#   start : index of the first point in the memory-mapped .npy file (when it is written in chunks)
+################################################################################################################################################
+def save_fitted_vs_data( out_f, x_list, y_list, fitted_values, z_list, mask=None, start=0 ) :
+   columns = [ x_list, y_list, fitted_values, z_list, ( np.asarray(z_list) - fitted_values ) ]
+   if mask is not None :
+      columns.append( mask )
+
+   if isinstance( out_f, np.ndarray ) :
+      for (i,column) in enumerate( columns ) :
+         out_f[i,start:start+len(fitted_values)] = column
+   else :
+      text_writer.write_columns( out_f, columns, [3,3,8,8,8,0][0:len(columns)] )
+
+################################################################################################################################################
+# Creates accumulator of binned residual statistics (see residual_maps.py) with n_bins x n_bins cells covering the image (or the range of
+# the data x_range,y_range when image_size <= 0)
+################################################################################################################################################
+def open_residual_maps( n_bins, n_points, image_size=8192, x_range=None, y_range=None ) :
+   extent = (0,image_size,0,image_size)
+   if image_size is None or image_size <= 0 :
+      extent = tuple( x_range ) + tuple( y_range )
+
+   return residual_maps.ResidualMaps( n_bins=n_bins, extent=extent, n_points=n_points )
+
+################################################################################################################################################
+# Prints summary of binned residual statistics and saves them to residual_file (default residual_stats_order%02d.npz)
+################################################################################################################################################
+def save_residual_maps( maps, n, residual_file=None, save_files=True ) :
+   maps.print_summary()
+   if residual_file is None and save_files :
+      residual_file = ("residual_stats_order%02d.npz" % (n))
+   if residual_file is not None :
+      maps.save( residual_file )
+
+################################################################################################################################################
+# Saves fitted surface to text file fitted_order%02d.txt with columns X Y FIT calculated with a step of step pixels
+#   region   : (x_start,x_end,y_start,y_end) in pixels, default whole image (0,size,0,size)
+#   npy_file : if set the fitted surface is streamed to a memory-mapped .npy file (2D array of shape (n_y,n_x)) instead of the text file
+#   threads  : number of threads used to evaluate the surface (see grid_eval.py)
+#   basis    : basis of the coefficients a (see orthogonal_basis.py)
+################################################################################################################################################
+def save_fitted_surface( a, n, x_c, y_c, size=8192, step=10, verbose=0, region=None, npy_file=None, threads=1, basis="monomial" ) :
+   print("Saving fitted surface")   
+   
+   if npy_file is not None :
+      grid_eval.evaluate_grid( a, n, x_c, y_c, size=size, step=step, region=region, outfile=npy_file, threads=threads, verbose=verbose, basis=basis )
+      return
+
+   outfile2 = ("fitted_order%02d.txt" % (n))
+   out_f = open(outfile2,"w")
+   out_f.write("# X  Y  FIT \n")
+   out_f.write("# X,Y steps %d pixels\n" % step)
+   # blocks of grid rows are evaluated and written one by one (the whole grid is never in memory), lines of many rows formatted at once :
+   (x_axis,y_axis) = grid_eval.get_grid_axes( size=size, step=step, region=region )
+   block_rows = max( 1, text_writer.DEFAULT_BLOCK_ROWS // max( 1, len(x_axis) ) )
+   for (iy,values) in grid_eval.iterate_grid_tiles( a, n, x_c, y_c, x_axis, y_axis, tile_rows=block_rows, threads=threads, verbose=verbose, basis=basis ) :
+      y_block = y_axis[iy:iy+len(values)]
+      x_column = np.tile( x_axis, len(y_block) )
+      y_column = np.repeat( y_block, len(x_axis) )
+      text_writer.write_columns( out_f, [ x_column, y_column, np.ravel( values ) ], [3,3,8] )
+       
+   out_f.close()   
 
 ################################################################################################################################################
 # Wrapper function reading a specified text file and calling the main fitting function 
 # Chi2 = Sum_k=0^N { (p(x_k,y_k) - D_k ) ^ 2 }            
+#   chunk_size > 0 : file is read in chunks of chunk_size lines and fitted with the streaming fitter (see fit_poly_stream)
+#   workers > 1    : normal equations are built by a pool of workers processes (see parallel_fit.py)
+#   cache_dir      : directory of the cache of fits (see fit_cache.py), when the normal equations of the same data and image_size are
+#                    found there (for the same or a higher order) the data are not read at all if output files are not required
+#   stats_callback : function called as stats_callback( stage_name, stage_dict ) at the end of every stage of the fit (see fit_stats.py)
+#   stats_file     : wall time, CPU time, peak RSS and number of points of the stages are appended to this file as a JSON line
+#   output_format  : format of the fitted_vs_data file - txt (text) or npy (binary, see open_fitted_vs_data)
+#   basis          : basis of the polynomial monomial, legendre or chebyshev (see orthogonal_basis.py), in all the modes (streaming,
+#                    workers > 1, robust)
+#   detect_grid    : data on a rectangular grid of X and Y are detected and fitted with separable sums along the axes (see grid_fit.py)
+#   subsample      : > 0 - weighted subsample of about this number of points is fitted instead of all the points (see fit_poly_coreset),
+#                    subsample_method, subsample_tolerance, subsample_confidence and validate are the parameters of fit_poly_coreset
+#   residual_bins  : > 0 - count, mean, RMS, median and MAD of the residuals in residual_bins x residual_bins cells are calculated during
+#                    the evaluation of the fit and saved to residual_file (default residual_stats_orderNN.npz, see residual_maps.py),
+#                    they are in the attribute residual_maps of the result. With output_format="none" fitted_vs_data is not written.
+# RETURNS : fit_stats.FitResult - tuple (ok,coeff_list,a) with statistics of the stages in the attribute stats (or FittedSurface with
+#           the attribute stats if return_surface=True), coeff_list are always monomial coefficients and a coefficients in the basis
 ################################################################################################################################################
-def fit_poly( filename , ncols=10, image_size=8192, polynomial_order=7, save_files=True, verbose=0 ) :
-   (x_list,y_list,z_list) = read_text_file( filename, ncols=ncols )
+def fit_poly( filename , ncols=10, image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", chunk_size=0, use_cache=True, workers=1, grid_step=10, grid_region=None, grid_npy=None, threads=1, diagnostics=False, robust=None, robust_threshold=3.00, robust_iter=10, return_surface=False, cache_dir=None, cache_max_bytes=fit_cache.DEFAULT_MAX_BYTES, stats_callback=None, stats_file=None, output_format="txt", basis="monomial", detect_grid=True, subsample=0, subsample_method="stratified", subsample_tolerance=None, subsample_confidence=coreset.DEFAULT_CONFIDENCE, validate=0, residual_bins=0, residual_file=None ) :
+   orthogonal_basis.check_basis( basis )
+   stats = fit_stats.FitStats( callback=stats_callback, filename=filename, order=polynomial_order, solver=solver, workers=workers, basis=basis )
+   if subsample is not None and subsample > 0 :
+      return fit_poly_coreset( filename, sample_size=subsample, method=subsample_method, tolerance=subsample_tolerance, confidence=subsample_confidence, validate=validate, image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose, solver=solver, grid_step=grid_step, grid_region=grid_region, grid_npy=grid_npy, threads=threads, return_surface=return_surface, stats=stats, stats_file=stats_file, basis=basis )
+
+   cache = None
+   cache_key = None
+   cached_fit = None
+   if cache_dir is not None :
+      if robust is not None :
+         print("WARNING : robust fits are not cached")
+      else :
+         with stats.stage( "cache_lookup" ) :
+            cache = fit_cache.FitCache( cache_dir, max_bytes=cache_max_bytes, verbose=verbose )
+            cache_key = cache.get_key( cache.get_file_hash( filename ), columns=(0,1,2), image_size=image_size, basis=basis )
+            cached_fit = cache.load( cache_key, polynomial_order, solver=solver )
+         if cached_fit is not None and not save_files and not diagnostics and residual_bins <= 0 :
+            return fit_poly_cached( cached_fit, solver=solver, return_surface=return_surface, verbose=verbose, stats=stats, stats_file=stats_file, basis=basis )
+
+   if chunk_size is not None and chunk_size > 0 :
+      if robust is not None :
+         print("WARNING : robust fitting requires all data in memory and is not available in the streaming (chunk_size > 0) mode")
+      return fit_poly_stream( filename, image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose, solver=solver, chunk_size=chunk_size, workers=workers, grid_step=grid_step, grid_region=grid_region, grid_npy=grid_npy, threads=threads, diagnostics=diagnostics, return_surface=return_surface, cached_fit=cached_fit, cache=cache, cache_key=cache_key, stats=stats, stats_file=stats_file, output_format=output_format, residual_bins=residual_bins, residual_file=residual_file, basis=basis )
+
+   with stats.stage( "read" ) as stage :
+      (x_list,y_list,z_list) = read_text_file( filename, ncols=ncols, use_cache=use_cache )
+      stage["n_points"] = len(x_list)
    print("Read %d data points from file %s" % (len(x_list),filename))
          
-   return fit_poly_base( x_list, y_list, z_list, image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose )
+   return fit_poly_base( x_list, y_list, z_list, image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose, solver=solver, workers=workers, grid_step=grid_step, grid_region=grid_region, grid_npy=grid_npy, threads=threads, diagnostics=diagnostics, robust=robust, robust_threshold=robust_threshold, robust_iter=robust_iter, return_surface=return_surface, cached_fit=cached_fit, cache=cache, cache_key=cache_key, stats=stats, stats_file=stats_file, output_format=output_format, basis=basis, detect_grid=detect_grid, residual_bins=residual_bins, residual_file=residual_file )
+
+################################################################################################################################################
+# Fits polynomial to a 2D array (image) z_image[iy,ix] of values at positions x_axis[ix], y_axis[iy] using the separable normal
+# equations (see grid_fit.py)
+#   x_axis, y_axis : coordinates of the columns and rows in pixels (default 0,1,2,...)
+#   mask           : optional boolean array of the shape of z_image, pixels with mask=False (and NaN values) are excluded from the fit
+#   other parameters as in fit_poly_base, output files contain all the pixels (masked ones with NaN values)
+# RETURNS : as fit_poly
+################################################################################################################################################
+def fit_poly_grid( z_image, x_axis=None, y_axis=None, mask=None, image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", grid_step=10, grid_region=None, grid_npy=None, threads=1, diagnostics=False, return_surface=False, stats_callback=None, stats_file=None, output_format="txt", basis="monomial" ) :
+   z_image = np.asarray( z_image, dtype=np.float64 )
+   (ny,nx) = z_image.shape
+   if x_axis is None :
+      x_axis = np.arange( 0, nx, dtype=np.float64 )
+   if y_axis is None :
+      y_axis = np.arange( 0, ny, dtype=np.float64 )
+   if len(x_axis) != nx or len(y_axis) != ny :
+      print("ERROR : axes of lengths %d x %d do not match the image of shape %s" % (len(x_axis),len(y_axis),z_image.shape))
+      raise ValueError("Axes do not match the image shape %s" % (z_image.shape,))
+
+   # points in the order of image pixels (copy, masked pixels set to NaN) :
+   z_list = np.ravel( z_image ).copy()
+   if mask is not None :
+      z_list[ ~np.ravel( np.asarray( mask, dtype=bool ) ) ] = np.nan
+   x_list = np.tile( np.asarray( x_axis, dtype=np.float64 ), ny )
+   y_list = np.repeat( np.asarray( y_axis, dtype=np.float64 ), nx )
+
+   return fit_poly_base( x_list, y_list, z_list, image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose, solver=solver, grid_step=grid_step, grid_region=grid_region, grid_npy=grid_npy, threads=threads, diagnostics=diagnostics, return_surface=return_surface, stats_callback=stats_callback, stats_file=stats_file, output_format=output_format, basis=basis, grid=(x_axis,y_axis,z_list.reshape( (ny,nx) )) )
+
+################################################################################################################################################
+# Tiled fit : polynomials of order polynomial_order are fitted to n_tiles x n_tiles overlapping tiles of the image by workers processes
+# (default all CPU cores) and blended smoothly (see tiled_fit.py). The blended map on the grid with step grid_step is streamed to the
+# memory-mapped file grid_npy (default fitted_tiles_orderNN.npy, grid_step=1 gives full resolution map)
+# RETURNS : tiled_fit.MosaicSurface with statistics of the stages in the attribute stats
+################################################################################################################################################
+def fit_poly_tiles( filename, n_tiles=tiled_fit.DEFAULT_N_TILES, overlap=tiled_fit.DEFAULT_OVERLAP, image_size=8192, polynomial_order=tiled_fit.DEFAULT_TILE_ORDER, save_files=True, verbose=0, solver="cholesky", use_cache=True, workers=None, grid_step=10, grid_region=None, grid_npy=None, threads=1, stats_callback=None, stats_file=None, basis="monomial" ) :
+   stats = fit_stats.FitStats( callback=stats_callback, filename=filename, order=polynomial_order, solver=solver, workers=workers, basis=basis, n_tiles=n_tiles )
+   with stats.stage( "read" ) as stage :
+      (x_list,y_list,z_list) = read_text_file( filename, use_cache=use_cache )
+      stage["n_points"] = len(x_list)
+   if image_size is None or image_size <= 0 :
+      image_size = max( np.max(x_list), np.max(y_list) ) + 1
+
+   with stats.stage( "fit_tiles", n_points=len(x_list) ) :
+      mosaic = tiled_fit.fit_tiles( x_list, y_list, z_list, size=image_size, n_tiles=n_tiles, overlap=overlap, polynomial_order=polynomial_order, solver=solver, basis=basis, workers=workers, verbose=verbose )
+   print("Fitted %d out of %d tiles" % (mosaic.n_fitted,n_tiles*n_tiles))
+
+   if save_files :
+      if grid_npy is None :
+         grid_npy = ("fitted_tiles_order%02d.npy" % (polynomial_order))
+      with stats.stage( "write_fitted_surface" ) :
+         mosaic.evaluate_map( outfile=grid_npy, step=grid_step, region=grid_region, threads=threads, verbose=verbose )
+   else :
+      print("WARNING : saving output files is not required")
+
+   stats.finish( n_points=len(x_list), order=polynomial_order )
+   if stats_file is not None :
+      stats.save_json_line( stats_file )
+   if verbose > 0 :
+      stats.print_summary()
+   mosaic.stats = stats
+
+   return mosaic
+
+################################################################################################################################################
+# Coreset fit : polynomial is fitted to a spatially stratified (or leverage score) weighted subsample of about sample_size points drawn
+# from the file (or tuple of arrays x,y,z) without reading all of it (see coreset.py)
+#   tolerance  : required maximum error of the fitted surface with respect to the fit of all the points, the subsample is enlarged
+#                until the error bound confidence*(maximum standard error of the surface) is below it (None - single subsample)
+#   confidence : confidence factor k of the error bound (k standard errors, default coreset.DEFAULT_CONFIDENCE)
+#   validate  : number of points of an independent held-out sample used to validate the fit
+#   full_pass : also fit all the points and report the true difference (reads all the data, for testing the tolerance)
+# Only the fitted surface grid is saved (fitted_vs_data requires all the points).
+# RETURNS : as fit_poly, the report of coreset.fit_coreset is in the attribute coreset
+################################################################################################################################################
+def fit_poly_coreset( filename, sample_size=coreset.DEFAULT_SAMPLE_SIZE, method="stratified", tolerance=None, confidence=coreset.DEFAULT_CONFIDENCE, validate=0, full_pass=False, image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", grid_step=10, grid_region=None, grid_npy=None, threads=1, return_surface=False, seed=None, stats=None, stats_callback=None, stats_file=None, basis="monomial" ) :
+   if stats is None :
+      stats = fit_stats.FitStats( callback=stats_callback, filename=( filename if isinstance( filename, str ) else None ), order=polynomial_order, solver=solver, basis=basis )
+   n = polynomial_order
+
+   report = coreset.fit_coreset( filename, n=n, sample_size=sample_size, method=method, tolerance=tolerance, confidence=confidence, n_validate=validate, full_pass=full_pass, image_size=image_size, solver=solver, basis=basis, seed=seed, stats=stats, verbose=verbose )
+   (a,x_c,y_c) = (report["a"],report["x_c"],report["y_c"])
+   coreset.print_report( report, n )
+   print_polynomial( a, n, basis=basis )
+   stats.info.update( { "subsample_method" : method, "n_sample" : int( report["n_sample"] ), "surface_error" : float( report["surface_error"] ), "error_bound" : float( report["error_bound"] ) } )
+
+   if save_files :
+      with stats.stage( "write_fitted_surface" ) :
+         save_fitted_surface( a, n, x_c, y_c, size=( image_size if image_size is not None and image_size > 0 else int( 2*max( x_c, y_c ) ) ), step=grid_step, verbose=verbose, region=grid_region, npy_file=grid_npy, threads=threads, basis=basis )
+   else :
+      print("WARNING : saving output files is not required")
+
+   result = get_fit_result( True, a, n, x_c, y_c, stats, report["n_total"], return_surface=return_surface, verbose=verbose, stats_file=stats_file, basis=basis )
+   result.coreset = report
+
+   return result
+
+################################################################################################################################################
+# Final step of all the fitting functions : records total time of the fit (see fit_stats.py), optionally saves it as a JSON line to
+# stats_file and RETURNS fit_stats.FitResult (ok,coeff_list,a) or FittedSurface (return_surface=True), both with the attribute stats
+################################################################################################################################################
+def get_fit_result( ok, a, n, x_c, y_c, stats, n_points, return_surface=False, verbose=0, stats_file=None, basis="monomial" ) :
+   stats.finish( n_points=int(n_points), order=n )
+   if stats_file is not None :
+      stats.save_json_line( stats_file )
+   if verbose > 0 :
+      stats.print_summary()
+
+   if return_surface :
+      surface = fitted_surface.FittedSurface.from_fit( a, n, x_c, y_c, basis=basis )
+      surface.stats = stats
+      return surface
+
+   return fit_stats.FitResult( (ok,get_polynonial( fit_engine.to_monomial( a, n, basis=basis ), n ),a), stats=stats )
+
+################################################################################################################################################
+# Fit served from the cache of fits (see fit_cache.py) without reading the data
+#   cached_fit : dictionary returned by FitCache.load
+################################################################################################################################################
+def fit_poly_cached( cached_fit, solver="cholesky", return_surface=False, verbose=0, stats=None, stats_file=None, basis="monomial" ) :
+   if stats is None :
+      stats = fit_stats.FitStats()
+   n = cached_fit["order"]
+   (gram,rhs,a) = (cached_fit["gram"],cached_fit["rhs"],cached_fit["a"])
+   print("Fit of %d order polynomial to %d data points read from the cache" % (n,cached_fit["n_points"]))
+
+   if a is None :
+      with stats.stage( "solve" ) :
+         a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+   print_polynomial( a, n, basis=basis )
+   print("\n\nchi2 = %.8f\n" % order_sweep.calc_chi2( a, gram, rhs, cached_fit["sum_z2"] ))
+
+   return get_fit_result( True, a, n, cached_fit["x_c"], cached_fit["y_c"], stats, cached_fit["n_points"], return_surface=return_surface, verbose=verbose, stats_file=stats_file, basis=basis )
    
       
 ################################################################################################################################################
-# Main fitting function :
-#   Input : lists of x , y , z values 
+# Out-of-core fitting of a (plain or gzip-compressed) text file, which is read in chunks of chunk_size lines.
+# Only normal equations are kept in memory (see streaming_fit.py), output files are written in a second pass over the file.
+# When image_size <= 0 an additional first pass is required to find the range of X and Y. Binned residual statistics (residual_bins > 0)
+# are accumulated in the second pass. The polynomial is fitted in the basis monomial, legendre or chebyshev (see orthogonal_basis.py).
 ################################################################################################################################################
-def fit_poly_base( x_list, y_list, z_list , image_size=8192, polynomial_order=7, save_files=True, verbose=0 ) :
-   # (x_list,y_list,z_list) = read_text_file( filename, ncols=options.ncols )
-   x_list_original = copy.copy(x_list)
-   y_list_original = copy.copy(y_list)
-   
-   
-   image_size_x = image_size
-   image_size_y = image_size
-   x_c = image_size_x / 2.00
-   y_c = image_size_y / 2.00
+def fit_poly_stream( filename, image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", chunk_size=streaming_fit.DEFAULT_CHUNK_SIZE, workers=1, grid_step=10, grid_region=None, grid_npy=None, threads=1, diagnostics=False, return_surface=False, cached_fit=None, cache=None, cache_key=None, stats=None, stats_callback=None, stats_file=None, output_format="txt", residual_bins=0, residual_file=None, basis="monomial" ) :
+   if stats is None :
+      stats = fit_stats.FitStats( callback=stats_callback, filename=filename, order=polynomial_order, solver=solver, workers=workers, basis=basis )
+   n = polynomial_order
+   x_c = image_size / 2.00
+   y_c = image_size / 2.00
+   (x_range,y_range) = ((0.00,image_size),(0.00,image_size))
 
-   if image_size is None or image_size <= 0 :
-      image_size_x = max(x_list) 
-      image_size_y = max(y_list)
+   if cached_fit is not None and cached_fit.get( "x_range" ) is not None :
+      (x_range,y_range) = (cached_fit["x_range"],cached_fit["y_range"])
+   elif ( image_size is None or image_size <= 0 ) and ( cached_fit is None or ( residual_bins is not None and residual_bins > 0 ) ) :
+      # range of the data is also needed for the residual maps of a fit served from a cache entry saved without it :
+      with stats.stage( "read_centre" ) :
+         (min_x,max_x,min_y,max_y) = (np.inf,-np.inf,np.inf,-np.inf)
+         for chunk in streaming_fit.read_text_chunks( filename, chunk_size=chunk_size, columns=(0,1) ) :
+            min_x = min( min_x, chunk[:,0].min() )
+            max_x = max( max_x, chunk[:,0].max() )
+            min_y = min( min_y, chunk[:,1].min() )
+            max_y = max( max_y, chunk[:,1].max() )
+
+         x_c = ( min_x + max_x ) / 2.00
+         y_c = ( min_y + max_y ) / 2.00
+         (x_range,y_range) = ((min_x,max_x),(min_y,max_y))
+
+   if cached_fit is not None :
+      # normal equations from the cache of fits (see fit_cache.py), the file is read only to save the output files :
+      (x_c,y_c) = (cached_fit["x_c"],cached_fit["y_c"])
+      fitter = streaming_fit.StreamingFitter( polynomial_order=n, x_c=x_c, y_c=y_c, solver=solver, basis=basis )
+      (fitter.gram,fitter.rhs,fitter.sum_z2,fitter.n_points) = (cached_fit["gram"],cached_fit["rhs"],cached_fit["sum_z2"],cached_fit["n_points"])
+      print("Normal equations of %d data points read from the cache" % (fitter.n_points))
+   elif workers > 1 and not streaming_fit.is_gzip_file( filename ) :
+      # every worker reads its own byte range of the file :
+      with stats.stage( "read_assemble" ) as stage :
+         fitter = parallel_fit.accumulate_file( filename, n, x_c, y_c, workers=workers, verbose=verbose, basis=basis )
+         stage["n_points"] = fitter.n_points
+      fitter.solver = solver
+      print("Read %d data points from file %s using %d workers" % (fitter.n_points,filename,workers))
+   else :
+      if workers > 1 :
+         print("WARNING : gzip-compressed file %s cannot be split between workers -> reading it in a single process" % (filename))
+      with stats.stage( "read_assemble" ) as stage :
+         fitter = streaming_fit.StreamingFitter( polynomial_order=n, x_c=x_c, y_c=y_c, solver=solver, basis=basis )
+         for chunk in streaming_fit.read_text_chunks( filename, chunk_size=chunk_size, verbose=verbose ) :
+            fitter.partial_fit( chunk )
+         stage["n_points"] = fitter.n_points
+      print("Read %d data points from file %s in chunks of %d lines" % (fitter.n_points,filename,chunk_size))
+
+   print("Fitting %d order polynomial -> %d parameters and %d equations (solver = %s)" % (n,fitter.n_params,fitter.n_params,solver))
+   with stats.stage( "solve" ) :
+      (ok,coeff_out,a) = fitter.solve()
+   if cache is not None and cached_fit is None :
+      cache.save( cache_key, n, fitter.gram, fitter.rhs, fitter.sum_z2, fitter.n_points, x_c, y_c, a, solver, x_range=x_range, y_range=y_range )
+   print_polynomial( a, n, basis=basis )
+   print("Solution ok = %s" % (ok))
+   if diagnostics :
+      with stats.stage( "diagnostics" ) :
+         check_solution( fitter.gram, fitter.rhs, a, n )
+   print("\n\nchi2 = %.8f\n" % fitter.calc_chi2( a ))
+
+   maps = None
+   if residual_bins is not None and residual_bins > 0 :
+      maps = open_residual_maps( residual_bins, fitter.n_points, image_size=image_size, x_range=x_range, y_range=y_range )
+   out_f = None
+   if save_files :
+      out_f = open_fitted_vs_data( n, fitter.n_points, output_format=output_format )
+   if out_f is not None or maps is not None :
+      with stats.stage( "write_fitted_vs_data", n_points=fitter.n_points ) :
+         start = 0
+         for chunk in streaming_fit.read_text_chunks( filename, chunk_size=chunk_size ) :
+            fitted_values = fit_engine.calc_poly_values( (chunk[:,0] - x_c) / x_c, (chunk[:,1] - y_c) / y_c, a, n, basis=basis )
+            if out_f is not None :
+               save_fitted_vs_data( out_f, chunk[:,0], chunk[:,1], fitted_values, chunk[:,2], start=start )
+            if maps is not None :
+               maps.add( chunk[:,0], chunk[:,1], chunk[:,2] - fitted_values )
+            start += len(chunk)
+         if out_f is not None :
+            close_fitted_vs_data( out_f )
+   if maps is not None :
+      save_residual_maps( maps, n, residual_file=residual_file, save_files=save_files )
+
+   if save_files :
+      with stats.stage( "write_fitted_surface" ) :
+         save_fitted_surface( a, n, x_c, y_c, size=image_size, step=grid_step, verbose=verbose, region=grid_region, npy_file=grid_npy, threads=threads, basis=basis )
+   else :
+      print("WARNING : saving output files is not required")
+
+   result = get_fit_result( True, a, n, x_c, y_c, stats, fitter.n_points, return_surface=return_surface, verbose=verbose, stats_file=stats_file, basis=basis )
+   result.residual_maps = maps
+
+   return result
+
+################################################################################################################################################
+# Fits polynomials to many value columns sharing the same X Y positions (e.g. columns of the GLEAM calibration file, see plot_scatter_3d.py)
+#   zcols : list of columns with values to be fitted
+# RETURNS : (ok,coeff_matrix) , where coeff_matrix has shape (len(zcols),n_params) and every row is in the order of get_polynonial
+################################################################################################################################################
+def fit_poly_multi( filename, zcols=[2], image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", use_cache=True, workers=1 ) :
+   columns = data_reader.read_columns( filename, columns=[0,1]+list(zcols), use_cache=use_cache, verbose=verbose )
+   print("Read %d data points with %d value columns from file %s" % (len(columns[0]),len(zcols),filename))
+
+   return fit_poly_base_multi( columns[0], columns[1], np.column_stack( columns[2:] ), image_size=image_size, polynomial_order=polynomial_order, save_files=save_files, verbose=verbose, solver=solver, workers=workers, column_names=zcols )
+
+################################################################################################################################################
+# Fits polynomials to all the columns of z_columns (array of shape (N,n_columns)) at the same positions x_list,y_list.
+# The design/Gram matrix is built and factorised only once and solved for all the columns in a single call.
+#   column_names : names (or numbers) of the columns used in the output file fitted_multi_order%02d.txt
+# RETURNS : (ok,coeff_matrix) , where coeff_matrix has shape (n_columns,n_params)
+################################################################################################################################################
+def fit_poly_base_multi( x_list, y_list, z_columns, image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", workers=1, column_names=None ) :
+   n = polynomial_order
+   z_columns = np.asarray( z_columns, dtype=np.float64 )
+   if z_columns.ndim == 1 :
+      z_columns = z_columns.reshape( (len(z_columns),1) )
+   n_columns = z_columns.shape[1]
+   if column_names is None :
+      column_names = list( range(0,n_columns) )
+
+   (x_c,y_c) = calc_image_centre( x_list, y_list, image_size )
+   print("Fitting %d order polynomial -> %d parameters to %d columns of %d data points (solver = %s)" % (n,fit_engine.get_n_params(n),n_columns,len(x_list),solver))
+
+   if workers > 1 and solver != "lstsq" :
+      fitter = parallel_fit.accumulate_arrays( x_list, y_list, z_columns, n, x_c, y_c, workers=workers, verbose=verbose )
+      (gram,rhs) = (fitter.gram,fitter.rhs)
+      a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+      ok = np.allclose( np.dot(gram, a), rhs )
+   else :
+      x_norm = ( np.asarray( x_list, dtype=np.float64 ) - x_c ) / x_c
+      y_norm = ( np.asarray( y_list, dtype=np.float64 ) - y_c ) / y_c
+      (ok,a,gram,rhs) = fit_engine.fit_normalised( x_norm, y_norm, z_columns, n, solver=solver )
+
+   # chi2 of every column from the normal equations (no need to evaluate the polynomials) :
+   sum_z2 = np.sum( z_columns*z_columns, axis=0 )
+   chi2 = sum_z2 - 2.00*np.sum( a*rhs, axis=0 ) + np.sum( a*np.dot( gram, a ), axis=0 )
+   print("Solution ok = %s" % (ok))
+
+   coeff_matrix = a.T
+   for col in range(0,n_columns) :
+      print("Column %s : chi2 = %.8f" % (column_names[col],chi2[col]))
+      if verbose > 0 :
+         print_polynomial( coeff_matrix[col], n )
+
+   if save_files :
+      (p_exp,q_exp) = fit_engine.get_exponents( n )
+      outfile = ("fitted_multi_order%02d.txt" % n)
+      out_f = open(outfile,"w")
+      out_f.write("# COLUMN CHI2 %s\n" % (" ".join( [ ("a_%d%d" % (p_exp[m],q_exp[m])) for m in range(0,len(p_exp)) ] )))
+      for col in range(0,n_columns) :
+         out_f.write("%s %.8f %s\n" % (column_names[col],chi2[col]," ".join( [ ("%.8f" % val) for val in coeff_matrix[col] ] )))
+      out_f.close()
+      print("Coefficients of %d columns saved to file %s" % (n_columns,outfile))
+   else :
+      print("WARNING : saving output files is not required")
 
-      x_c = ( min(x_list) + max(x_list) ) / 2.00
-      y_c = ( min(y_list) + max(y_list) ) / 2.00
+   return (ok,coeff_matrix)
 
+################################################################################################################################################
+# Order selection : fits all polynomial orders from the list orders using moments of the data calculated once (see order_sweep.py)
+# and reports chi2, AIC, BIC and k-fold cross-validation error for every order (saved to order_sweep.txt)
+# RETURNS : (best_order,results) , results is a list of dictionaries (one per order)
+################################################################################################################################################
+def fit_poly_order_sweep( filename, orders=range(1,10), image_size=8192, kfold=5, save_files=True, verbose=0, solver="cholesky", use_cache=True ) :
+   (x_list,y_list,z_list) = read_text_file( filename, use_cache=use_cache )
+   (x_c,y_c) = calc_image_centre( x_list, y_list, image_size )
+   x_norm = ( np.asarray( x_list, dtype=np.float64 ) - x_c ) / x_c
+   y_norm = ( np.asarray( y_list, dtype=np.float64 ) - y_c ) / y_c
+
+   print("Order sweep : fitting orders %s to %d data points (%d-fold cross-validation)" % (list(orders),len(z_list),kfold))
+   results = order_sweep.sweep_orders( x_norm, y_norm, z_list, orders, kfold=kfold, solver=solver, verbose=verbose )
+
+   outfile = None
+   if save_files :
+      outfile = "order_sweep.txt"
+   best_order = order_sweep.print_sweep( results, outfile=outfile )
+
+   return (best_order,results)
+
+################################################################################################################################################
+# Main fitting function :
+#   Input : lists or array-likes of x , y , z values (NumPy arrays of any float type, e.g. float32, or memory-mapped arrays are used
+#           without copying and are never modified, normalised coordinates are calculated in chunks - extra memory is O(chunk) except
+#           the robust fit, lstsq solver and the grid mode)
+#   solver : cholesky (default), solve or lstsq - see fit_engine.py
+#   workers > 1 : normal equations are built by a pool of workers processes (not used for solver=lstsq)
+#   grid_step, grid_region, grid_npy, threads : parameters of the saved fitted surface grid (see save_fitted_surface)
+#   diagnostics : calculate gradient of chi2 and condition number of the normal equations (see check_solution)
+#   robust : robust fitting method sigma_clip, huber or tukey with robust_threshold (in sigma) and robust_iter iterations (see robust_fit.py)
+#   return_surface : return FittedSurface object (see fitted_surface.py) instead of the tuple (ok,coeff_list,a)
+#   cached_fit : normal equations read from the cache of fits (dictionary returned by fit_cache.FitCache.load) used instead of building
+#                them from the data, otherwise the normal equations are saved to cache (fit_cache.FitCache) under the key cache_key
+#   stats, stats_callback, stats_file : statistics of the stages of the fit (fit_stats.FitStats, created if not provided), see fit_poly
+#   verbose >= 1 : prints the normal equations and data and fitted values of all the points
+#   basis : monomial (default), legendre or chebyshev (see orthogonal_basis.py) - the normal equations of orthogonal bases are well
+#           conditioned and can be solved with cholesky (also in the robust mode and with workers > 1), solver qr factorises the
+#           design matrix (more accurate but ~50x slower, single process, not available in the robust mode)
+#   grid  : (x_axis,y_axis) sorted axes of data on a rectangular grid (see grid_fit.detect_grid) or (x_axis,y_axis,z_image) with the
+#           image z_image[iy,ix] of the values (see fit_poly_grid), the normal equations are then calculated with 1D sums along the
+#           axes (see grid_fit.py) and NaN values are excluded from the fit.
+#           When not provided and detect_grid=True the grid is detected automatically (not with the robust fit). The lstsq and qr
+#           solvers fit the design matrix of the points directly and only exclude NaN values of gridded data.
+#   residual_bins, residual_file : binned residual statistics accumulated while the fitted values are evaluated (see fit_poly)
+################################################################################################################################################
+def fit_poly_base( x_list, y_list, z_list , image_size=8192, polynomial_order=7, save_files=True, verbose=0, solver="cholesky", workers=1, grid_step=10, grid_region=None, grid_npy=None, threads=1, diagnostics=False, robust=None, robust_threshold=3.00, robust_iter=10, return_surface=False, cached_fit=None, cache=None, cache_key=None, stats=None, stats_callback=None, stats_file=None, output_format="txt", basis="monomial", grid=None, detect_grid=True, residual_bins=0, residual_file=None ) :
+   orthogonal_basis.check_basis( basis )
+   if stats is None :
+      stats = fit_stats.FitStats( callback=stats_callback, order=polynomial_order, solver=solver, workers=workers, basis=basis )
+   # (x_list,y_list,z_list) = read_text_file( filename, ncols=options.ncols )
+   # arrays of any float type and memory-mapped arrays are used without copying (lists are converted to arrays once) :
+   x_list_original = np.asarray( x_list )
+   y_list_original = np.asarray( y_list )
+   z_list = np.asarray( z_list )
    
-   len_data = len(x_list)
+   len_data = len(x_list_original)
+   with stats.stage( "normalise", n_points=len_data ) :
+      (x_c,y_c) = calc_image_centre( x_list_original, y_list_original, image_size )
 
-   # shift to be around the image centre :   
-   for i in range(0,len_data) :
-      x_list[i] = ( x_list[i] - x_c ) / ( x_c )
-      y_list[i] = ( y_list[i] - y_c ) / ( y_c )
+      # shift to be around the image centre : normalised float64 values are calculated chunk by chunk when used (see
+      # fit_engine.NormalisedArray), the input arrays are never modified :
+      x_list = fit_engine.NormalisedArray( x_list_original, x_c, x_c )
+      y_list = fit_engine.NormalisedArray( y_list_original, y_c, y_c )
    
    print("Fitting 3D surface to %d data points" % (len_data))
    
    n = polynomial_order   
-   n_equations = 0 
-   n_params = 0
-   for p in range(0,n+1) :   
-      for q in range(0,n-p+1) :
-         print("%d : a_%d%d x^%d * y^%d" % (n_params,p,q,p,q))
-         n_equations += 1
-         n_params += 1
+   n_params = fit_engine.get_n_params( n )
+   n_equations = n_params
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   for param_index in range(0,n_params) :
+      if basis != "monomial" :
+         print("%d : c_%d%d B_%d(x) * B_%d(y) (%s)" % (param_index,p_exp[param_index],q_exp[param_index],p_exp[param_index],q_exp[param_index],basis))
+      else :
+         print("%d : a_%d%d x^%d * y^%d" % (param_index,p_exp[param_index],q_exp[param_index],p_exp[param_index],q_exp[param_index]))
 
    
    # n_equations = (n+1)*(n+2)/2
    # n_params = (n+1)*(n+2)/2
    # example for n=3 (x^3 etc) it will be 4*5/2 = 10 parameters and equations 
-   rhs = np.zeros(n_equations)
-   lhs = {} # will have coeffients for n_equations 
+   print("Fitting %d order polynomial -> %d parameters and %d equations (solver = %s)" % (n,n_params,n_equations,solver))
    
-   print("Fitting %d order polynomial -> %d parameters and %d equations" % (n,n_params,n_equations))
-   
-   # calculate derivatives by a_pq
-   eq_index = 0 
-   for p in range(0,n+1) :   
-      # for q in range(0,p+1) : # q goes from 0 to p 
-      for q in range(0,n-p+1) :
-         if eq_index >= n_equations :
-            print("ERROR in code : trying to calculate derivatives for equation %d whilst number of equations is %d" % (eq_index,n_equations))
-            sys.exit(-1)
-      
-         # RHS :
-         for k in range(0,len_data) :
-            rhs[eq_index] = rhs[eq_index] + z_list[k]*(x_list[k])**(p)*(y_list[k])**(q)
-
-         # LHS :
-         coeff = np.zeros(n_params)   
-         param_index = 0 
-         for i in range(0,n+1) :
-            # for j in range(0,i+1) :
-            for j in range(0,n-i+1):
-               if param_index >= n_params :
-                  print("ERROR in code : trying to calculate coefficient at parameter %d whilst number of parameters is %d" % (param_index,n_params))
-                  sys.exit(-1)
- 
-               # calculate coefficient at a_ij :           
-               for k in range(0,len_data) :
-                  coeff[param_index] = coeff[param_index] + (x_list[k])**(i+p)*(y_list[k])**(j+q)
-
-               param_index += 1
-
-         key = "a_%d%d" % (p,q)   
-         lhs[eq_index] = copy.copy(coeff)
-         eq_index += 1 
-  
-   print("\n\nEquations:")
-#   for j in range(0,n_equations) :
-   eq_index = 0 
-   for p in range(0,n+1) :   
-      # for q in range(0,p+1) : # q goes from 0 to p   
-      for q in range(0,n-p+1):
-         if eq_index >= n_equations :
-             print("ERROR in code : trying to print equation %d whilst number of equations is %d" % (eq_index,n_equations))
-             sys.exit(-1)
+   # build normal equations (derivatives by a_pq equal to zero) and solve them :
+   robust_result = None
+   grid_fitted = False
+   if robust is not None :
+      if solver in ("lstsq","qr") :
+         print("WARNING : robust fitting uses normal equations -> solver %s replaced by cholesky" % (solver))
+         solver = "cholesky"
+      with stats.stage( "robust_fit", n_points=len_data ) :
+         # iterations of the robust fit require all the normalised values in memory :
+         robust_result = robust_fit.fit_robust( np.asarray( x_list ), np.asarray( y_list ), np.asarray( z_list, dtype=np.float64 ), n, method=robust, threshold=robust_threshold, n_iter=robust_iter, solver=solver, verbose=verbose, basis=basis )
+      (a,lhs_eq,rhs) = (robust_result["a"],robust_result["gram"],robust_result["rhs"])
+      ok = np.allclose( np.dot(lhs_eq, a), rhs )
+      print("Robust fit : %d out of %d points rejected, chi2 of iterations = %s" % (np.sum(~robust_result["mask"]),len_data,robust_result["chi2"]))
+   elif cached_fit is not None :
+      (lhs_eq,rhs) = (cached_fit["gram"],cached_fit["rhs"])
+      a = cached_fit["a"]
+      if a is None :
+         with stats.stage( "solve" ) :
+            a = fit_engine.solve_normal_equations( lhs_eq, rhs, solver=solver )
+      ok = np.allclose( np.dot(lhs_eq, a), rhs )
+      print("Normal equations read from the cache")
+   elif solver in ("lstsq","qr") :
+      if grid is None and detect_grid :
+         with stats.stage( "detect_grid", n_points=len_data ) :
+            grid = grid_fit.detect_grid( x_list_original, y_list_original )
+      # design matrix is solved directly (assembly and solution in a single stage) :
+      with stats.stage( "solve", n_points=len_data ) :
+         if grid is not None :
+            # NaN values (masked pixels) of gridded data are excluded from the fit :
+            valid = np.nonzero( np.isfinite( z_list ) )[0]
+            (ok,a,lhs_eq,rhs) = fit_engine.fit_normalised( x_list[valid], y_list[valid], np.asarray( z_list[valid], dtype=np.float64 ), n, solver=solver, basis=basis )
+         else :
+            (ok,a,lhs_eq,rhs) = fit_engine.fit_normalised( x_list, y_list, z_list, n, solver=solver, basis=basis )
+   else :
+      if grid is None and detect_grid :
+         with stats.stage( "detect_grid", n_points=len_data ) :
+            grid = grid_fit.detect_grid( x_list_original, y_list_original )
+      with stats.stage( "assemble", n_points=len_data ) :
+         if grid is not None :
+            # separable normal equations of the data on a rectangular grid, nodes without data and NaN values are masked :
+            (x_axis,y_axis) = grid[0:2]
+            if len(grid) > 2 :
+               (z_image,overwrite) = (grid[2],False)
+            else :
+               # image of the values filled chunk by chunk (only its masked pixels are modified by calc_normal_equations_grid) :
+               (z_image,overwrite) = (grid_fit.get_grid_image( x_list_original, y_list_original, z_list, x_axis, y_axis ),True)
+            (lhs_eq,rhs,n_fitted,sum_z2) = grid_fit.calc_normal_equations_grid( (np.asarray( x_axis, dtype=np.float64 ) - x_c)/x_c, (np.asarray( y_axis, dtype=np.float64 ) - y_c)/y_c, z_image, n, basis=basis, overwrite=overwrite )
+            grid_fitted = True
+            print("Data on a grid of %d x %d nodes -> separable normal equations (%d points fitted, %d masked)" % (len(x_axis),len(y_axis),n_fitted,z_image.size - n_fitted))
+         elif workers > 1 :
+            fitter = parallel_fit.accumulate_arrays( x_list_original, y_list_original, z_list, n, x_c, y_c, workers=workers, verbose=verbose, basis=basis )
+            (lhs_eq,rhs) = (fitter.gram,fitter.rhs)
+         else :
+            (lhs_eq,rhs) = fit_engine.calc_normal_equations( x_list, y_list, z_list, n, basis=basis )
+      with stats.stage( "solve" ) :
+         a = fit_engine.solve_normal_equations( lhs_eq, rhs, solver=solver )
+         ok = np.allclose( np.dot(lhs_eq, a), rhs )
 
-      
-         key = "a_%d%d" % (p,q)
+   if cache is not None and cached_fit is None and robust_result is None :
+      (x_range,y_range) = ((0.00,image_size),(0.00,image_size))
+      if image_size is None or image_size <= 0 :
+         (x_range,y_range) = ((np.min(x_list_original),np.max(x_list_original)),(np.min(y_list_original),np.max(y_list_original)))
+      if grid_fitted :
+         cache.save( cache_key, n, lhs_eq, rhs, sum_z2, n_fitted, x_c, y_c, a, solver, x_range=x_range, y_range=y_range )
+      else :
+         cache.save( cache_key, n, lhs_eq, rhs, fit_engine.calc_sum_squares( z_list ), len_data, x_c, y_c, a, solver, x_range=x_range, y_range=y_range )
+  
+   # dump of the normal equations only for verbose >= 1 (formatting of P^2 numbers is not free) :
+   if verbose >= 1 :
+      print("\n\nEquations:")
+      for eq_index in range(0,n_equations) :
+         key = "a_%d%d" % (p_exp[eq_index],q_exp[eq_index])
          line = ("dChi^2/d%s : " % key)
-         
-         param_index = 0
-         for i in range(0,n+1) :
-            for j in range(0,n-i+1):
-               if param_index >= n_params :
-                  print("ERROR in code : trying to calculate coefficient at parameter %d whilst number of parameters is %d" % (param_index,n_params))
-                  sys.exit(-1)
-
-               sign = "+"
-               if lhs[eq_index][param_index] < 0 or i==0:
-                  sign = ""
-               line += ("%s%.8f*a_%d%d " % (sign,lhs[eq_index][param_index],i,j))
-               
-               param_index += 1
-#         if lhs[j][i] < 0 :
-#            prev_sign = -1
-#         if i < (n+2) :
-#            line += "+ "
-         
-         print("%s = %.8f" % (line,rhs[j]))
-         eq_index += 1
-      
-      
             
-   # solve equations :
-   arrays = []
-   for a in lhs.keys() :
-      arrays.append( lhs[a] )
-   lhs_eq = np.stack( arrays )
-   print("%s" % (lhs_eq))
+         for param_index in range(0,n_params) :
+            sign = "+"
+            if lhs_eq[eq_index][param_index] < 0 or p_exp[param_index]==0:
+               sign = ""
+            line += ("%s%.8f*a_%d%d " % (sign,lhs_eq[eq_index][param_index],p_exp[param_index],q_exp[param_index]))
+            
+         print("%s = %.8f" % (line,rhs[eq_index]))
+         
+      print("%s" % (lhs_eq))
    
-   a = np.linalg.solve(lhs_eq, rhs)
-   print("Polynomial coefficients :")
-   param_index = 0
-   polynomial_string = ""
-   for p in range(0,n+1) :   
-      # for q in range(0,p+1) : # q goes from 0 to p   
-      for q in range(0,n-p+1) :
-         if param_index >= n_params :         
-            print("ERROR in code : trying to print parameter %d when there are only %d" % (param_index,n_params))
-            sys.exit(-1)
-      
-         print("\t a_%d%d = %.8f" % (p,q,a[param_index]))
-         polynomial_string += (" %.8f*(x**%d)*(y**%d) + " % (a[param_index],p,q))
-         param_index += 1 
-
-   print("\n\nFitted polynomial p_n(x,y) = %s" % (polynomial_string))
+   print_polynomial( a, n, basis=basis )
    
    # check if ok solution :
-   ok = np.allclose(np.dot(lhs_eq, a), rhs)
    print("Solution ok = %s" % (ok))
 
    out_f = None
    if save_files :
-      outfile = ("fitted_vs_data_order%02d.txt" % n)   
-      out_f = open(outfile,"w")
-      out_f.write("# X  Y  FIT   DATA  DATA-FIT\n")
+      out_f = open_fitted_vs_data( n, len_data, with_mask=(robust_result is not None), output_format=output_format )
    else :
       print("WARNING : saving output files is not required")
+   maps = None
+   if residual_bins is not None and residual_bins > 0 :
+      (x_range,y_range) = (None,None)
+      if image_size is None or image_size <= 0 :
+         (x_range,y_range) = ((np.min(x_list_original),np.max(x_list_original)),(np.min(y_list_original),np.max(y_list_original)))
+      maps = open_residual_maps( residual_bins, len_data, image_size=image_size, x_range=x_range, y_range=y_range )
       
    print("\n\nFitted values:")
-   chi2 = 0 
-   for i in range(0,len_data) :
-      # calc_polynonial
-      val = calc_polynonial( x_list[i] , y_list[i] , a, n )
+   (mask,weights) = (None,None)
+   if robust_result is not None :
+      (mask,weights) = (robust_result["mask"],robust_result["weights"])
+   # fitted values are calculated and written in blocks of points (memory does not depend on the number of points) :
+   # (after a robust fit chi2 is weighted with the final weights, i.e. the rejected points are excluded, chi2_all is over all the points)
+   (chi2,chi2_all) = (0.00,0.00)
+   # (stages of the blocks are completed once after the loop, see fit_stats.FitStats.block) :
+   memory = stats.start_blocks()
+   for start in range(0,len_data,EVAL_BLOCK_SIZE) :
+      end = min( start + EVAL_BLOCK_SIZE, len_data )
+      with stats.block( "evaluate", n_points=len_data ) :
+         fitted_values = fit_engine.calc_poly_values( x_list[start:end], y_list[start:end], a, n, basis=basis )
+         z_block = np.asarray( z_list[start:end], dtype=np.float64 )
+         # (NaN values are excluded from the fits of gridded data) :
+         residuals2 = (fitted_values - z_block)**2
+         chi2_all += np.nansum( residuals2 )
+         if weights is not None :
+            chi2 += np.nansum( weights[start:end]*residuals2 )
       if verbose > 0 :
-         print("%.3f %.3f  %.8f  vs. %.8f" % (x_list[i],y_list[i],z_list[i],val))
-      
+         (x_block,y_block) = (x_list[start:end],y_list[start:end])
+         for i in range(0,end-start) :
+            print("%.3f %.3f  %.8f  vs. %.8f" % (x_block[i],y_block[i],z_block[i],fitted_values[i]))
+
+      if maps is not None :
+         with stats.block( "residual_stats", n_points=len_data ) :
+            maps.add( x_list_original[start:end], y_list_original[start:end], z_block - fitted_values )
       if out_f is not None :
-         line = "%.3f %.3f %.8f %.8f %.8f\n" % (x_list_original[i],y_list_original[i],val,z_list[i],(z_list[i]-val))
-         out_f.write( line )
+         with stats.block( "write_fitted_vs_data", n_points=len_data ) :
+            save_fitted_vs_data( out_f, x_list_original[start:end], y_list_original[start:end], fitted_values, z_block, mask=( mask[start:end] if mask is not None else None ), start=start )
+   stats.end_blocks( memory, ["evaluate","residual_stats","write_fitted_vs_data"] )
       
-      chi2 += (val - z_list[i])**2 
-   
-   print("\n\nchi2 = %.8f\n" % chi2)
+   if weights is not None :
+      print("\n\nchi2 = %.8f (robust %s fit : weighted with the final weights, %d of %d points used)" % (chi2,robust,np.count_nonzero( mask ),len_data))
+      print("unweighted chi2 of all points (including rejected) = %.8f\n" % chi2_all)
+   else :
+      print("\n\nchi2 = %.8f\n" % chi2_all)
    if out_f is not None :
-      out_f.close()
+      close_fitted_vs_data( out_f )
+   if maps is not None :
+      save_residual_maps( maps, n, residual_file=residual_file, save_files=save_files )
 
    if save_files :
-      print("Saving fitted surface")   
-      size = image_size
-      step = 10
-   
-      outfile2 = ("fitted_order%02d.txt" % (n))
-      out_f = open(outfile2,"w")
-      out_f.write("# X  Y  FIT \n")
-      out_f.write("# X,Y steps %d pixels\n" % step)
-      for y in range(0,size,step) :
-         if verbose > 0 :
-            print("Progress y = %d" % (y))
-         for x in range(0,size,step) :
-            yp = ( y - y_c ) / y_c 
-            xp = ( x - x_c ) / x_c 
-         
-            val = calc_polynonial( xp, yp, a , n )
-            line = "%.3f %.3f %.8f\n" % (x,y,val)
-            out_f.write( line )
-         
-          
-      out_f.close()   
+      with stats.stage( "write_fitted_surface" ) :
+         save_fitted_surface( a, n, x_c, y_c, size=image_size, step=grid_step, verbose=verbose, region=grid_region, npy_file=grid_npy, threads=threads, basis=basis )
    else :
       print("WARNING : saving output files is not required")
 
-   # calculate and show derivatives :
-   calc_derivatives( x_list, y_list, z_list, a, n )
+   # calculate and show derivatives (only if diagnostics are required) :
+   if diagnostics :
+      with stats.stage( "diagnostics", n_points=len_data ) :
+         if robust_result is not None or grid is not None :
+            # gradient of the (weighted) chi2 from the final normal equations, which exclude rejected points and NaN values of
+            # gridded data :
+            check_solution( lhs_eq, rhs, a, n )
+         else :
+            check_solution( lhs_eq, rhs, a, n, x_list=x_list, y_list=y_list, z_list=z_list, basis=basis )
 
-   # format coefficients into a list and return
-   coeff_out = get_polynonial( a, n )
-   
-   return (True,coeff_out,a)
+   # format coefficients into a list and return (with statistics of the stages)
+   result = get_fit_result( True, a, n, x_c, y_c, stats, len_data, return_surface=return_surface, verbose=verbose, stats_file=stats_file, basis=basis )
+   result.residual_maps = maps
+
+   return result
 
 if __name__ == '__main__':
    filename = "mean_stokes_I_2axis_gleamcal.txt"
@@ -450,6 +1022,9 @@ if __name__ == '__main__':
       filename = sys.argv[1]
 
    (options, args) = parse_options()
+   grid_region = None
+   if options.grid_region is not None :
+      grid_region = [ int(val) for val in options.grid_region.split(",") ]
 
    print("#################################################################")
    print("PARAMETERS :")
@@ -458,10 +1033,24 @@ if __name__ == '__main__':
    print("vmin - vmax = %.4f - %.4f" % (options.vmin,options.vmax))
    print("Polynomial order = %d" % (options.polynomial_order))
    print("N columns in input file = %d" % (options.ncols))
+   print("Solver = %s" % (options.solver))
    print("#################################################################")
       
    # (x_list,y_list,z_list) = read_text_file( filename )
-   (fit_ok,polynomial_coeff_list,coeff_only_list) = fit_poly( filename, ncols=options.ncols, image_size=options.image_size, polynomial_order=options.polynomial_order, save_files=options.save_files, verbose=options.verbose )
+   if options.order_sweep is not None :
+      (min_order,max_order) = [ int(val) for val in options.order_sweep.split(":") ]
+      (best_order,sweep_results) = fit_poly_order_sweep( filename, orders=range(min_order,max_order+1), image_size=options.image_size, kfold=options.kfold, save_files=options.save_files, verbose=options.verbose, solver=options.solver, use_cache=options.use_cache )
+   elif options.n_tiles > 0 :
+      mosaic = fit_poly_tiles( filename, n_tiles=options.n_tiles, overlap=options.tile_overlap, image_size=options.image_size, polynomial_order=options.polynomial_order, save_files=options.save_files, verbose=options.verbose, solver=options.solver, use_cache=options.use_cache, workers=( options.workers if options.workers > 1 else None ), grid_step=options.grid_step, grid_region=grid_region, grid_npy=options.grid_npy, threads=options.threads, stats_file=options.stats_file, basis=options.basis )
+      if options.surface_file is not None :
+         mosaic.save( options.surface_file )
+   elif options.zcols is not None :
+      zcols = [ int(col) for col in options.zcols.split(",") ]
+      (fit_ok,coeff_matrix) = fit_poly_multi( filename, zcols=zcols, image_size=options.image_size, polynomial_order=options.polynomial_order, save_files=options.save_files, verbose=options.verbose, solver=options.solver, use_cache=options.use_cache, workers=options.workers )
+   else :
+      fit_result = fit_poly( filename, ncols=options.ncols, image_size=options.image_size, polynomial_order=options.polynomial_order, save_files=options.save_files, verbose=options.verbose, solver=options.solver, chunk_size=options.chunk_size, use_cache=options.use_cache, workers=options.workers, grid_step=options.grid_step, grid_region=grid_region, grid_npy=options.grid_npy, threads=options.threads, diagnostics=options.diagnostics, robust=options.robust, robust_threshold=options.robust_threshold, robust_iter=options.robust_iter, return_surface=(options.surface_file is not None), cache_dir=options.cache_dir, cache_max_bytes=options.cache_max_mb*1024*1024, stats_file=options.stats_file, output_format=options.output_format, basis=options.basis, detect_grid=options.detect_grid, residual_bins=options.residual_bins, residual_file=options.residual_file, subsample=options.subsample, subsample_method=options.subsample_method, subsample_tolerance=options.subsample_tolerance, subsample_confidence=options.subsample_confidence, validate=options.validate )
+      if options.surface_file is not None :
+         fit_result.save( options.surface_file )
      
 #   plot_scatter( filename , vmin=options.vmin, vmax=options.vmax )   
       
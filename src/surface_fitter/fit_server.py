@@ -0,0 +1,385 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Long-lived fitting service : jobs (JSON) are received on a local Unix socket or localhost TCP port by an asyncio front end
+# and executed by a pool of processes, so that the interpreter startup, imports and parsing of the input files are paid only
+# once. Input files are parsed once into the .npy cache of data_reader.py (next to the input file), which every worker memory-maps, so
+# a repeated file is read from the shared page cache whichever worker gets the job (workers keep the mapped arrays in an LRU cache
+# keyed by path, size and modification time). The server keeps fitted surfaces in an LRU cache (keyed by the input file version and
+# parameters of the fit) and identical fits submitted while the first one is running wait for its result instead of being run again :
+#
+#    python ./fit_server.py --socket=/tmp/fitter.sock --workers=4          # or --port=8765 (localhost only)
+#    python ./fit_server.py --socket=/tmp/fitter.sock --submit='{"type" : "fit", "filename" : "test.txt", "order" : 3}'
+#    curl -s -X POST --data '{"type" : "fit", "filename" : "test.txt", "order" : 3}' http://127.0.0.1:8765/
+#
+# Requests are single JSON lines (a connection can send many of them) or HTTP POST requests with the JSON job in the body
+# (GET returns the metrics of the server). Jobs :
+#    fit       : {"type" : "fit", "filename" : FILE or "x","y","z" : lists, "order" : 3, "image_size" : 8192, "solver" : "cholesky",
+#                 "basis" : "monomial", "robust" : null}  -> coeff_list, surface (FittedSurface.to_dict), surface_key
+#    evaluate  : {"type" : "evaluate", "surface_key" : KEY or "surface" : dict or parameters of a fit, "x" : [...], "y" : [...]} -> values
+#    batch_fit : {"type" : "batch_fit", "jobs" : [fit jobs]} -> results (fits are executed in parallel)
+#    metrics   : server metrics ; shutdown : stops the server
+# Every response contains "id" of the job (if provided), "status" (ok or error) and "metrics" of the job : latency_s (from receiving
+# the job to the response), queue_wait_s (waiting for a worker), run_s, queue_depth (jobs submitted to the pool and not finished when
+# the job was received), cache hits (surface_cache_hit, input_cache_hit) and inflight_hit (result of an identical running fit).
+#
+########################################################################################################################
+import asyncio
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import time
+from optparse import OptionParser
+import numpy as np
+
+try :
+   from . import data_reader
+   from . import fit_poly_3d
+   from . import fitted_surface
+except ImportError :
+   import data_reader
+   import fit_poly_3d
+   import fitted_surface
+
+DEFAULT_PORT = 8765
+DEFAULT_INPUT_CACHE_SIZE = 16        # memory-mapped input files per worker
+DEFAULT_SURFACE_CACHE_SIZE = 1024    # fitted surfaces kept by the server
+MAX_REQUEST_BYTES = 1024*1024*1024
+
+JOB_TYPES = ["fit","evaluate","batch_fit","metrics","shutdown"]
+
+class LRUCache :
+   def __init__( self, max_size ) :
+      self.max_size = max_size
+      self.entries = collections.OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   def get( self, key ) :
+      if key in self.entries :
+         self.entries.move_to_end( key )
+         self.hits += 1
+         return self.entries[key]
+      self.misses += 1
+
+      return None
+
+   def put( self, key, value ) :
+      self.entries[key] = value
+      self.entries.move_to_end( key )
+      while len(self.entries) > self.max_size :
+         self.entries.popitem( last=False )
+
+   def __len__( self ) :
+      return len(self.entries)
+
+   def to_dict( self ) :
+      return { "size" : len(self.entries), "max_size" : self.max_size, "hits" : self.hits, "misses" : self.misses }
+
+# memory-mapped input files of the worker process (created by init_worker) :
+_input_cache = None
+
+def init_worker( input_cache_size ) :
+   global _input_cache
+   _input_cache = LRUCache( input_cache_size )
+
+########################################################################################################################################
+# RETURNS key of the version of the input file (absolute path, size and modification time)
+########################################################################################################################################
+def get_file_version( filename ) :
+   stat = os.stat( filename )
+
+   return (os.path.abspath( filename ),stat.st_size,stat.st_mtime_ns)
+
+########################################################################################################################################
+# RETURNS key of the fitted surface : hash of the version of the input file (or of the data of inline jobs) and parameters of the fit
+########################################################################################################################################
+def get_surface_key( job ) :
+   params = [ job.get( "order", 3 ), job.get( "image_size", 8192 ), job.get( "solver", "cholesky" ), job.get( "basis", "monomial" ), job.get( "robust" ) ]
+   digest = hashlib.sha1()
+   if "filename" in job :
+      digest.update( json.dumps( [ list( get_file_version( job["filename"] ) ) ] + params ).encode() )
+   else :
+      digest.update( json.dumps( params ).encode() )
+      for name in ("x","y","z") :
+         digest.update( np.asarray( job[name], dtype=np.float64 ).tobytes() )
+
+   return digest.hexdigest()
+
+########################################################################################################################################
+# Worker function : RETURNS arrays (x,y,z) of the input file and flag if they were already parsed (in the LRU cache of the worker or in
+# the .npy cache file shared by all workers, see data_reader.read_columns). The arrays are memory-mapped (not copied to the worker).
+########################################################################################################################################
+def get_input( filename ) :
+   global _input_cache
+   if _input_cache is None :
+      _input_cache = LRUCache( DEFAULT_INPUT_CACHE_SIZE )
+
+   key = get_file_version( filename )
+   arrays = _input_cache.get( key )
+   if arrays is not None :
+      return (arrays,True)
+
+   parsed = filename.endswith(".npy") or os.path.exists( data_reader.get_cache_filename( filename, (0,1,2) ) )
+   with contextlib.redirect_stdout( io.StringIO() ) :
+      arrays = data_reader.read_columns( filename, columns=(0,1,2), use_cache=True )
+   _input_cache.put( key, arrays )
+
+   return (arrays,parsed)
+
+########################################################################################################################################
+# Worker function : fits the job (output files are not saved and the output of the fit is not printed)
+#   submit_time : time when the job was submitted to the pool (to calculate the time spent in the queue)
+# RETURNS : dictionary with the fitted surface and timings
+########################################################################################################################################
+def run_fit_job( job, submit_time ) :
+   start_time = time.time()
+   input_cache_hit = False
+   if "filename" in job :
+      ((x,y,z),input_cache_hit) = get_input( job["filename"] )
+   else :
+      (x,y,z) = [ np.asarray( job[name], dtype=np.float64 ) for name in ("x","y","z") ]
+
+   with contextlib.redirect_stdout( io.StringIO() ) :
+      surface = fit_poly_3d.fit_poly_base( x, y, z, image_size=job.get( "image_size", 8192 ), polynomial_order=job.get( "order", 3 ), save_files=False, solver=job.get( "solver", "cholesky" ), basis=job.get( "basis", "monomial" ), robust=job.get( "robust" ), return_surface=True )
+
+   return { "surface" : surface.to_dict(), "coeff_list" : [ [float(a_pq),p,q] for (a_pq,p,q) in surface.to_coeff_list() ], "n_points" : len(z),
+            "input_cache_hit" : input_cache_hit, "queue_wait_s" : start_time - submit_time, "run_s" : time.time() - start_time, "pid" : os.getpid() }
+
+class FitServer :
+   def __init__( self, workers=None, input_cache_size=DEFAULT_INPUT_CACHE_SIZE, surface_cache_size=DEFAULT_SURFACE_CACHE_SIZE, verbose=0 ) :
+      if workers is None or workers <= 0 :
+         workers = os.cpu_count() or 1
+      self.workers = workers
+      self.input_cache_size = input_cache_size
+      self.surfaces = LRUCache( surface_cache_size )
+      self.inflight = {}  # surface_key -> future of the running fit
+      self.verbose = verbose
+      self.pool = None
+      self.stop_event = None
+
+      # metrics :
+      self.queue_depth = 0
+      self.n_jobs = collections.Counter()
+      self.n_errors = 0
+      self.total_latency = 0.00
+      self.max_latency = 0.00
+      self.start_time = time.time()
+
+   def get_metrics( self ) :
+      n_completed = sum( self.n_jobs.values() )
+      return { "uptime_s" : time.time() - self.start_time, "workers" : self.workers, "queue_depth" : self.queue_depth, "jobs" : dict( self.n_jobs ),
+               "errors" : self.n_errors, "mean_latency_s" : ( self.total_latency / n_completed if n_completed > 0 else 0.00 ), "max_latency_s" : self.max_latency,
+               "surface_cache" : self.surfaces.to_dict() }
+
+   #####################################################################################################################################
+   # Executes fit job in the process pool, fitted surfaces are served from the LRU cache and identical jobs arriving while the fit is
+   # running await the same future
+   #####################################################################################################################################
+   async def fit( self, job, metrics ) :
+      key = get_surface_key( job )
+      result = self.surfaces.get( key )
+      metrics["surface_cache_hit"] = result is not None
+      metrics["inflight_hit"] = result is None and key in self.inflight
+      if metrics["inflight_hit"] :
+         # shield : cancelled waiter does not cancel the fit of the other waiters
+         result = await asyncio.shield( self.inflight[key] )
+      elif result is None :
+         future = asyncio.get_running_loop().run_in_executor( self.pool, run_fit_job, job, time.time() )
+         self.inflight[key] = future
+         self.queue_depth += 1
+         try :
+            result = await asyncio.shield( future )
+            result["surface_key"] = key
+            self.surfaces.put( key, result )
+         finally :
+            self.queue_depth -= 1
+            del self.inflight[key]
+         for name in ("queue_wait_s","run_s","input_cache_hit","pid") :
+            metrics[name] = result[name]
+
+      return { "surface_key" : key, "surface" : result["surface"], "coeff_list" : result["coeff_list"], "n_points" : result["n_points"] }
+
+   #####################################################################################################################################
+   # Evaluates surface (from the cache, provided as a dictionary or fitted first) at points x,y in a thread of the event loop
+   #####################################################################################################################################
+   async def evaluate( self, job, metrics ) :
+      if "surface" in job :
+         surface_dict = job["surface"]
+      elif "surface_key" in job :
+         result = self.surfaces.get( job["surface_key"] )
+         metrics["surface_cache_hit"] = result is not None
+         if result is None :
+            raise KeyError("surface %s not in the cache" % (job["surface_key"]))
+         surface_dict = result["surface"]
+      else :
+         surface_dict = (await self.fit( job, metrics ))["surface"]
+
+      surface = fitted_surface.FittedSurface.from_dict( surface_dict )
+      values = await asyncio.get_running_loop().run_in_executor( None, surface, np.asarray( job["x"], dtype=np.float64 ), np.asarray( job["y"], dtype=np.float64 ) )
+
+      return { "values" : np.asarray( values ).tolist() }
+
+   #####################################################################################################################################
+   # Executes job and RETURNS response dictionary (errors are returned in the response)
+   #####################################################################################################################################
+   async def handle_job( self, job ) :
+      start_time = time.time()
+      job_type = job.get( "type", "fit" )
+      metrics = { "queue_depth" : self.queue_depth }
+      response = { "id" : job.get( "id" ), "type" : job_type, "status" : "ok" }
+
+      try :
+         if job_type == "fit" :
+            response.update( await self.fit( job, metrics ) )
+         elif job_type == "evaluate" :
+            response.update( await self.evaluate( job, metrics ) )
+         elif job_type == "batch_fit" :
+            response["results"] = await asyncio.gather( *[ self.handle_job( dict( sub_job, type="fit" ) ) for sub_job in job["jobs"] ] )
+         elif job_type == "metrics" :
+            response["server"] = self.get_metrics()
+         elif job_type == "shutdown" :
+            self.stop_event.set()
+         else :
+            raise ValueError("Unknown job type %s, allowed are : %s" % (job_type,JOB_TYPES))
+      except Exception as error :
+         self.n_errors += 1
+         response["status"] = "error"
+         response["error"] = "%s : %s" % (type(error).__name__,error)
+
+      metrics["latency_s"] = time.time() - start_time
+      response["metrics"] = metrics
+      self.n_jobs[job_type] += 1
+      self.total_latency += metrics["latency_s"]
+      self.max_latency = max( self.max_latency, metrics["latency_s"] )
+      if self.verbose > 0 :
+         print("Job %s (%s) : %s in %.6f s" % (response["id"],job_type,response["status"],metrics["latency_s"]))
+
+      return response
+
+   async def handle_request( self, data ) :
+      try :
+         job = json.loads( data )
+      except ValueError as error :
+         return { "status" : "error", "error" : "invalid JSON : %s" % (error) }
+
+      return await self.handle_job( job )
+
+   #####################################################################################################################################
+   # Connection : HTTP request (first line GET or POST) or any number of JSON lines (one response line per job)
+   #####################################################################################################################################
+   async def handle_connection( self, reader, writer ) :
+      try :
+         line = await reader.readline()
+         if line.startswith( b"GET " ) or line.startswith( b"POST " ) :
+            content_length = 0
+            while True :
+               header = await reader.readline()
+               if header in (b"\r\n",b"\n",b"") :
+                  break
+               (name,_,value) = header.decode().partition( ":" )
+               if name.strip().lower() == "content-length" :
+                  content_length = int( value )
+            if line.startswith( b"GET " ) :
+               response = await self.handle_job( { "type" : "metrics" } )
+            else :
+               response = await self.handle_request( await reader.readexactly( content_length ) )
+            body = json.dumps( response ).encode()
+            status = "200 OK" if response["status"] == "ok" else "400 Bad Request"
+            writer.write( ("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status,len(body))).encode() + body )
+            await writer.drain()
+         else :
+            while line :
+               if line.strip() :
+                  response = await self.handle_request( line )
+                  writer.write( json.dumps( response ).encode() + b"\n" )
+                  await writer.drain()
+               if self.stop_event.is_set() :
+                  break
+               line = await reader.readline()
+      except (ConnectionError,asyncio.IncompleteReadError) :
+         pass
+      finally :
+         writer.close()
+
+   #####################################################################################################################################
+   # Runs the server on the Unix socket socket_path or localhost port until a shutdown job is received
+   #####################################################################################################################################
+   async def serve( self, socket_path=None, port=DEFAULT_PORT, host="127.0.0.1" ) :
+      from concurrent.futures import ProcessPoolExecutor # imported only when required (fast import of the package)
+
+      self.stop_event = asyncio.Event()
+      self.pool = ProcessPoolExecutor( max_workers=self.workers, initializer=init_worker, initargs=(self.input_cache_size,) )
+      try :
+         if socket_path is not None :
+            if os.path.exists( socket_path ) :
+               os.remove( socket_path )
+            server = await asyncio.start_unix_server( self.handle_connection, path=socket_path, limit=MAX_REQUEST_BYTES )
+            print("Fitting server listening on Unix socket %s with %d workers" % (socket_path,self.workers))
+         else :
+            server = await asyncio.start_server( self.handle_connection, host=host, port=port, limit=MAX_REQUEST_BYTES )
+            print("Fitting server listening on %s:%d with %d workers" % (host,port,self.workers))
+         sys.stdout.flush()
+
+         async with server :
+            await self.stop_event.wait()
+      finally :
+         self.pool.shutdown( wait=True )
+         if socket_path is not None and os.path.exists( socket_path ) :
+            os.remove( socket_path )
+      print("Fitting server stopped : %s" % (json.dumps( self.get_metrics() )))
+
+   def run( self, socket_path=None, port=DEFAULT_PORT, host="127.0.0.1" ) :
+      asyncio.run( self.serve( socket_path=socket_path, port=port, host=host ) )
+
+########################################################################################################################################
+# Client : sends job (dictionary) as a JSON line to the server at the Unix socket socket_path or localhost port
+# RETURNS : response dictionary
+########################################################################################################################################
+def submit( job, socket_path=None, port=DEFAULT_PORT, host="127.0.0.1", timeout=None ) :
+   if socket_path is not None :
+      sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+      address = socket_path
+   else :
+      sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      address = (host,port)
+   sock.settimeout( timeout )
+
+   with sock :
+      sock.connect( address )
+      with sock.makefile( "rwb" ) as stream :
+         stream.write( json.dumps( job ).encode() + b"\n" )
+         stream.flush()
+         line = stream.readline()
+
+   return json.loads( line )
+
+def parse_options():
+   usage="Usage: %prog [options]\n"
+   usage+='\tLong-lived fitting service receiving JSON jobs on a Unix socket or localhost TCP port\n'
+   parser = OptionParser(usage=usage,version=1.00)
+   parser.add_option('--socket','--socket_path',dest="socket_path",default=None, help="Unix socket of the server [default %default - TCP port]",type="string")
+   parser.add_option('--port',dest="port",default=DEFAULT_PORT, help="TCP port on localhost (JSON lines or HTTP POST) when --socket is not set [default %default]",type="int")
+   parser.add_option('--workers','--n_workers',dest="workers",default=0, help="Number of worker processes, <=0 - number of CPU cores [default %default]",type="int")
+   parser.add_option('--input_cache','--input_cache_size',dest="input_cache_size",default=DEFAULT_INPUT_CACHE_SIZE, help="Number of memory-mapped input files kept open by every worker (parsed once into the .npy cache next to the file) [default %default]",type="int")
+   parser.add_option('--surface_cache','--surface_cache_size',dest="surface_cache_size",default=DEFAULT_SURFACE_CACHE_SIZE, help="Number of fitted surfaces kept in memory [default %default]",type="int")
+   parser.add_option('--submit','--job',dest="submit",default=None, help="Client mode : send this JSON job to the running server and print the response [default %default]",type="string")
+   parser.add_option('--verb','--verbose','--debug_level',dest="verbose",default=0, help="Verbosity level [default %default]",type="int")
+
+   (options, args) = parser.parse_args()
+
+   return (options, args)
+
+if __name__ == '__main__':
+   (options, args) = parse_options()
+
+   if options.submit is not None :
+      print(json.dumps( submit( json.loads( options.submit ), socket_path=options.socket_path, port=options.port ), indent=1 ))
+   else :
+      server = FitServer( workers=options.workers, input_cache_size=options.input_cache_size, surface_cache_size=options.surface_cache_size, verbose=options.verbose )
+      server.run( socket_path=options.socket_path, port=options.port )
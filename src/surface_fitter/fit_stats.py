@@ -0,0 +1,267 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Lightweight instrumentation of the stages of the fit (read, assemble, solve, evaluate, write ...). For every stage
+# the wall time, CPU time, memory and the number of points are recorded. Memory of a stage :
+#    peak_rss_mb          : peak RSS of the process during the stage (maximum over the calls of the stage) - the peak RSS (VmHWM) is
+#                           reset through /proc/self/clear_refs at the start of the stage (Linux >= 4.0, None elsewhere), so that also
+#                           transient allocations inside the stage are included. Peaks of nested stages are propagated to the outer ones.
+#    peak_delta_mb        : peak_rss_mb above the RSS at the start of the stage (memory used by the stage)
+#    rss_mb               : current RSS of the process at the end of the stage (/proc/self/status)
+#    process_peak_rss_mb  : peak RSS of the process since its start (ru_maxrss, cumulative - the same for all the stages after the
+#                           largest one and, in a long-lived process such as fit_server.py, the all-time high of the process)
+#    children_peak_rss_mb : peak RSS of the largest terminated child process (e.g. pool workers of parallel_fit.py and tiled_fit.py,
+#                           whose memory is not included in the RSS of the process), children_cpu_s is their CPU time in the stage
+#
+#    stats = FitStats( callback=my_callback )     # callback( stage_name, stage_dict ) called at the end of every stage
+#    with stats.stage( "assemble", n_points=len(z) ) :
+#       ...
+#    stats.finish()
+#    stats.save_json_line( "fits.jsonl" )          # one JSON line per fit
+#
+# Functions registered with add_hook are called like the callback for all the fits (e.g. to export metrics).
+# fit_poly returns FitResult - the usual tuple (ok,coeff_list,a) with the additional attribute stats.
+#
+########################################################################################################################
+import contextlib
+import json
+import os
+import sys
+import time
+
+# functions called at the end of every stage of every fit as hook( stage_name, stage_dict ) :
+HOOKS = []
+
+# peak RSS (MB) of every open measurement of the peak (see start_peak_rss), the innermost is the last one :
+OPEN_PEAKS = []
+
+# peak RSS (MB) of the process before the last reset of VmHWM (ru_maxrss is reset together with VmHWM) :
+RESET_PEAK_MB = 0.00
+
+def add_hook( hook ) :
+   if hook not in HOOKS :
+      HOOKS.append( hook )
+
+def remove_hook( hook ) :
+   if hook in HOOKS :
+      HOOKS.remove( hook )
+
+########################################################################################################################################
+# RETURNS peak resident set size in MB since the start of the process (children=False, also over resets of VmHWM by reset_peak_rss)
+# or of its largest terminated child process (children=True), None if not available on the platform
+########################################################################################################################################
+def get_peak_rss_mb( children=False ) :
+   try :
+      import resource
+   except ImportError :
+      return None
+
+   max_rss = resource.getrusage( resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF ).ru_maxrss
+   if sys.platform == "darwin" :
+      return max_rss / (1024.00*1024.00) # bytes
+   if children :
+      return max_rss / 1024.00 # kB
+   return max( max_rss / 1024.00, RESET_PEAK_MB )
+
+########################################################################################################################################
+# RETURNS CPU time (user + system) of the terminated child processes in seconds (0 if not available on the platform)
+########################################################################################################################################
+def get_children_cpu_s() :
+   try :
+      import resource
+   except ImportError :
+      return 0.00
+
+   usage = resource.getrusage( resource.RUSAGE_CHILDREN )
+   return usage.ru_utime + usage.ru_stime
+
+########################################################################################################################################
+# RETURNS dictionary with the current (VmRSS) and peak (VmHWM) resident set size of the process in MB read from /proc/self/status,
+# empty dictionary if not available on the platform
+########################################################################################################################################
+def read_rss_mb() :
+   rss = {}
+   try :
+      with open("/proc/self/status","r") as in_f :
+         for line in in_f :
+            if line.startswith("VmRSS:") or line.startswith("VmHWM:") :
+               (key,value) = line.split(":")
+               rss[key] = int( value.split()[0] ) / 1024.00 # kB
+   except (OSError,ValueError) :
+      return {}
+
+   return rss
+
+########################################################################################################################################
+# RETURNS current resident set size of the process in MB (None if /proc/self/status is not available)
+########################################################################################################################################
+def get_rss_mb() :
+   return read_rss_mb().get( "VmRSS" )
+
+########################################################################################################################################
+# Resets the peak resident set size (VmHWM) of the process to the current RSS (Linux >= 4.0), RETURNS False if not possible
+########################################################################################################################################
+def reset_peak_rss() :
+   global RESET_PEAK_MB
+   RESET_PEAK_MB = max( RESET_PEAK_MB, get_peak_rss_mb() or 0.00 )
+   try :
+      with open("/proc/self/clear_refs","w") as out_f :
+         out_f.write("5")
+   except OSError :
+      return False
+
+   return True
+
+########################################################################################################################################
+# Starts measurement of the peak RSS of the process : RETURNS dictionary with keys rss_start_mb and peak_rss_mb (set by
+# stop_peak_rss, None if the peak RSS cannot be reset). Measurements can be nested (stopped in the reverse order) : VmHWM is reset at
+# the start of every measurement, so the peak reached so far is first passed to the open (outer) measurements.
+########################################################################################################################################
+def start_peak_rss() :
+   rss = read_rss_mb()
+   for i in range(0,len(OPEN_PEAKS)) :
+      OPEN_PEAKS[i] = max( OPEN_PEAKS[i], rss.get( "VmHWM", 0.00 ) )
+   memory = { "rss_start_mb" : rss.get( "VmRSS" ), "peak_rss_mb" : None, "open" : False, "level" : len(OPEN_PEAKS) }
+   if "VmHWM" in rss and reset_peak_rss() :
+      OPEN_PEAKS.append( 0.00 )
+      memory["open"] = True
+
+   return memory
+
+########################################################################################################################################
+# Stops measurement started by start_peak_rss and sets peak_rss_mb of memory, RETURNS peak RSS in MB (None if not measured).
+# Inner measurements which were not stopped (e.g. after an exception) are closed too.
+########################################################################################################################################
+def stop_peak_rss( memory ) :
+   if memory["open"] :
+      level = memory["level"]
+      memory["peak_rss_mb"] = max( OPEN_PEAKS[level:] + [ read_rss_mb().get( "VmHWM", 0.00 ) ] )
+      del OPEN_PEAKS[level:]
+      memory["open"] = False
+      for i in range(0,len(OPEN_PEAKS)) :
+         OPEN_PEAKS[i] = max( OPEN_PEAKS[i], memory["peak_rss_mb"] )
+
+   return memory["peak_rss_mb"]
+
+class FitStats :
+   def __init__( self, callback=None, **info ) :
+      self.callback = callback
+      self.info = dict( info )   # parameters of the fit (e.g. filename, order, solver)
+      self.stages = {}           # stage name -> dictionary with keys wall_s, cpu_s, children_cpu_s, peak_rss_mb, peak_delta_mb, rss_mb, process_peak_rss_mb, children_peak_rss_mb, n_points, calls
+      self.total = None
+      self.t_start = time.perf_counter()
+      self.cpu_start = time.process_time()
+      self.children_cpu_start = get_children_cpu_s()
+
+   #####################################################################################################################################
+   # Context manager measuring a stage, yields dictionary of the stage (e.g. to set n_points when it is known only inside the stage).
+   # Times of stages with the same name are added.
+   #####################################################################################################################################
+   @contextlib.contextmanager
+   def stage( self, name, n_points=0 ) :
+      record = self.get_record( name )
+      current = { "n_points" : n_points }
+      memory = start_peak_rss()
+      t_start = time.perf_counter()
+      cpu_start = time.process_time()
+      children_cpu_start = get_children_cpu_s()
+      try :
+         yield current
+      finally :
+         record["wall_s"] += time.perf_counter() - t_start
+         record["cpu_s"] += time.process_time() - cpu_start
+         record["children_cpu_s"] += get_children_cpu_s() - children_cpu_start
+         record["n_points"] = max( record["n_points"], int( current["n_points"] ) )
+         stop_peak_rss( memory )
+         self.complete_stage( name, memory )
+
+   def get_record( self, name ) :
+      return self.stages.setdefault( name, { "wall_s" : 0.00, "cpu_s" : 0.00, "children_cpu_s" : 0.00, "peak_rss_mb" : None, "peak_delta_mb" : None, "rss_mb" : None, "process_peak_rss_mb" : None, "children_peak_rss_mb" : None, "n_points" : 0, "calls" : 0 } )
+
+   #####################################################################################################################################
+   # Records memory of a stage measured by start_peak_rss (stopped) and calls the callback and the hooks
+   #####################################################################################################################################
+   def complete_stage( self, name, memory ) :
+      record = self.get_record( name )
+      if memory["peak_rss_mb"] is not None :
+         record["peak_rss_mb"] = max( record["peak_rss_mb"] or 0.00, memory["peak_rss_mb"] )
+         record["peak_delta_mb"] = max( record["peak_delta_mb"] or 0.00, memory["peak_rss_mb"] - memory["rss_start_mb"] )
+      record["rss_mb"] = get_rss_mb()
+      record["process_peak_rss_mb"] = get_peak_rss_mb()
+      record["children_peak_rss_mb"] = get_peak_rss_mb( children=True )
+      record["calls"] += 1
+
+      if self.callback is not None :
+         self.callback( name, record )
+      for hook in HOOKS :
+         hook( name, record )
+
+   #####################################################################################################################################
+   # Stages interleaved in a loop over blocks of points (e.g. evaluate and write every block) : only wall and CPU time of every block
+   # are added by the context manager block (no system calls, no callbacks), the stages are completed once after the loop :
+   #    memory = stats.start_blocks()
+   #    for every block :
+   #       with stats.block( "evaluate", n_points=N ) :
+   #          ...
+   #    stats.end_blocks( memory, ["evaluate","write_fitted_vs_data"] )   # peak RSS of the whole loop is recorded for all the stages
+   #####################################################################################################################################
+   def start_blocks( self ) :
+      return start_peak_rss()
+
+   @contextlib.contextmanager
+   def block( self, name, n_points=0 ) :
+      record = self.get_record( name )
+      t_start = time.perf_counter()
+      cpu_start = time.process_time()
+      try :
+         yield record
+      finally :
+         record["wall_s"] += time.perf_counter() - t_start
+         record["cpu_s"] += time.process_time() - cpu_start
+         record["n_points"] = max( record["n_points"], int( n_points ) )
+
+   def end_blocks( self, memory, names ) :
+      stop_peak_rss( memory )
+      for name in names :
+         if name in self.stages :
+            self.complete_stage( name, memory )
+
+   #####################################################################################################################################
+   # Records total wall and CPU time of the fit and additional information (e.g. n_points, order)
+   #####################################################################################################################################
+   def finish( self, **info ) :
+      self.info.update( info )
+      self.total = { "wall_s" : time.perf_counter() - self.t_start, "cpu_s" : time.process_time() - self.cpu_start, "children_cpu_s" : get_children_cpu_s() - self.children_cpu_start,
+                     "rss_mb" : get_rss_mb(), "process_peak_rss_mb" : get_peak_rss_mb(), "children_peak_rss_mb" : get_peak_rss_mb( children=True ) }
+
+      return self
+
+   def to_dict( self ) :
+      return { "time" : time.strftime( "%Y-%m-%dT%H:%M:%S" ), "pid" : os.getpid(), "info" : self.info, "stages" : self.stages, "total" : self.total }
+
+   def to_json( self ) :
+      return json.dumps( self.to_dict(), default=float )
+
+   #####################################################################################################################################
+   # Appends statistics of the fit as a single JSON line to a file
+   #####################################################################################################################################
+   def save_json_line( self, filename ) :
+      with open(filename,"a") as out_f :
+         out_f.write( self.to_json() + "\n" )
+
+   def print_summary( self ) :
+      print("# STAGE WALL[s] CPU[s] CHILDREN_CPU[s] PEAK_RSS[MB] PEAK_DELTA[MB] RSS[MB] PROCESS_PEAK_RSS[MB] CHILDREN_PEAK_RSS[MB] N_POINTS")
+      for (name,record) in self.stages.items() :
+         print("%s %.6f %.6f %.6f %s %s %s %s %s %d" % (name,record["wall_s"],record["cpu_s"],record["children_cpu_s"],record["peak_rss_mb"],record["peak_delta_mb"],record["rss_mb"],record["process_peak_rss_mb"],record["children_peak_rss_mb"],record["n_points"]))
+      if self.total is not None :
+         print("total %.6f %.6f %.6f - - %s %s %s -" % (self.total["wall_s"],self.total["cpu_s"],self.total["children_cpu_s"],self.total["rss_mb"],self.total["process_peak_rss_mb"],self.total["children_peak_rss_mb"]))
+
+########################################################################################################################################
+# Result of fit_poly : tuple (ok,coeff_list,a) as returned before, with statistics of the stages of the fit in the attribute stats
+########################################################################################################################################
+class FitResult( tuple ) :
+   def __new__( cls, values, stats=None ) :
+      result = tuple.__new__( cls, values )
+      result.stats = stats
+
+      return result
@@ -0,0 +1,187 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Result of the fit as a self-contained object which can be evaluated, saved and loaded without refitting and without
+# importing matplotlib (only NumPy is required) :
+#
+#    surface = fit_poly( "test.txt", polynomial_order=3, return_surface=True )
+#    values = surface( x, y )           # arrays of any shape in pixel coordinates
+#    (dz_dx,dz_dy) = surface.gradient( x, y )
+#    surface.save( "fit.npz" )          # or fit.json
+#    surface = FittedSurface.load( "fit.npz" )
+#
+# The polynomial is p(x,y) = Sum a_pq * xn^p * yn^q with normalised coordinates xn = (x - x_c)/x_scale , yn = (y - y_c)/y_scale
+# (in fit_poly x_scale = x_c and y_scale = y_c). For basis=legendre or chebyshev xn^p * yn^q are replaced by the basis functions
+# B_p(xn) * B_q(yn) evaluated with the Clenshaw recurrence (see orthogonal_basis.py), to_coeff_list always returns the monomial
+# coefficients.
+#
+########################################################################################################################
+import json
+import numpy as np
+
+try :
+   from . import fit_engine
+   from . import orthogonal_basis
+except ImportError :
+   import fit_engine
+   import orthogonal_basis
+
+class FittedSurface :
+   def __init__( self, coeffs, p_exp, q_exp, x_c, y_c, x_scale=None, y_scale=None, basis="monomial" ) :
+      orthogonal_basis.check_basis( basis )
+      if x_scale is None :
+         x_scale = x_c
+      if y_scale is None :
+         y_scale = y_c
+
+      self.coeffs = np.asarray( coeffs, dtype=np.float64 )
+      self.p_exp  = np.asarray( p_exp, dtype=int )
+      self.q_exp  = np.asarray( q_exp, dtype=int )
+      self.x_c = float(x_c)
+      self.y_c = float(y_c)
+      self.x_scale = float(x_scale)
+      self.y_scale = float(y_scale)
+      self.basis = basis
+
+      # coefficients as matrix A[p,q] = a_pq used for the vectorised evaluation :
+      self.coeff_matrix = self.get_coeff_matrix( self.coeffs, self.p_exp, self.q_exp )
+
+      # statistics of the stages of the fit (fit_stats.FitStats), set by fit_poly :
+      self.stats = None
+
+   #####################################################################################################################################
+   # Creates FittedSurface from coefficients a (order of fit_engine.get_exponents) of polynomial of order n
+   #####################################################################################################################################
+   @classmethod
+   def from_fit( cls, a, n, x_c, y_c, x_scale=None, y_scale=None, basis="monomial" ) :
+      (p_exp,q_exp) = fit_engine.get_exponents( n )
+
+      return cls( a, p_exp, q_exp, x_c, y_c, x_scale=x_scale, y_scale=y_scale, basis=basis )
+
+   #####################################################################################################################################
+   # Creates FittedSurface from list of [a_pq,p,q] (format of get_polynonial and of the list returned by fit_poly)
+   #####################################################################################################################################
+   @classmethod
+   def from_coeff_list( cls, coeff_list, x_c, y_c, x_scale=None, y_scale=None ) :
+      coeff_array = np.array( coeff_list, dtype=np.float64 ).reshape( (-1,3) )
+
+      return cls( coeff_array[:,0], coeff_array[:,1].astype(int), coeff_array[:,2].astype(int), x_c, y_c, x_scale=x_scale, y_scale=y_scale )
+
+   @staticmethod
+   def get_coeff_matrix( coeffs, p_exp, q_exp ) :
+      coeff_matrix = np.zeros( (np.max(p_exp)+1,np.max(q_exp)+1) )
+      np.add.at( coeff_matrix, (p_exp,q_exp), coeffs )
+
+      return coeff_matrix
+
+   @property
+   def order( self ) :
+      return int( np.max( self.p_exp + self.q_exp ) )
+
+   #####################################################################################################################################
+   # RETURNS list of [a_pq,p,q] (format of get_polynonial) with monomial coefficients (converted from the orthogonal basis)
+   #####################################################################################################################################
+   def to_coeff_list( self ) :
+      coeffs = self.coeffs
+      if self.basis != "monomial" :
+         coeffs = orthogonal_basis.to_monomial( self.coeffs, self.p_exp, self.q_exp, basis=self.basis )
+
+      return [ [coeffs[m],int(self.p_exp[m]),int(self.q_exp[m])] for m in range(0,len(coeffs)) ]
+
+   #####################################################################################################################################
+   # RETURNS the same surface with monomial coefficients
+   #####################################################################################################################################
+   def to_monomial( self ) :
+      return FittedSurface.from_coeff_list( self.to_coeff_list(), self.x_c, self.y_c, x_scale=self.x_scale, y_scale=self.y_scale )
+
+   #####################################################################################################################################
+   # Evaluates matrix of coefficients for pixel coordinates x,y (arrays of any shape, or scalars)
+   #####################################################################################################################################
+   def evaluate_matrix( self, coeff_matrix, x, y ) :
+      (x,y) = np.broadcast_arrays( np.asarray( x, dtype=np.float64 ), np.asarray( y, dtype=np.float64 ) )
+      x_norm = ( x.ravel() - self.x_c ) / self.x_scale
+      y_norm = ( y.ravel() - self.y_c ) / self.y_scale
+
+      values = fit_engine.calc_poly_values_matrix( x_norm, y_norm, coeff_matrix, basis=self.basis )
+      if x.ndim == 0 :
+         return values[0]
+
+      return values.reshape( x.shape )
+
+   def __call__( self, x, y ) :
+      return self.evaluate_matrix( self.coeff_matrix, x, y )
+
+   #####################################################################################################################################
+   # Evaluates surface on the grid of pixel coordinates x_axis (columns) and y_axis (rows) as a matrix product of the row coefficients
+   # c_p(y) and the table of B_p(x) (see grid_eval.py), RETURNS array of shape (len(y_axis),len(x_axis))
+   #####################################################################################################################################
+   def evaluate_grid( self, x_axis, y_axis ) :
+      x_norm = ( np.asarray( x_axis, dtype=np.float64 ) - self.x_c ) / self.x_scale
+      y_norm = ( np.asarray( y_axis, dtype=np.float64 ) - self.y_c ) / self.y_scale
+      (n_x,n_y) = self.coeff_matrix.shape
+
+      if self.basis == "monomial" :
+         row_coeffs = np.dot( self.coeff_matrix, np.array( fit_engine.calc_powers( y_norm, n_y-1 ) ) )
+      else :
+         row_coeffs = orthogonal_basis.calc_row_coeffs( self.coeff_matrix, y_norm, basis=self.basis )
+      x_basis = np.array( fit_engine.calc_basis_powers( x_norm, n_x-1, basis=self.basis ) )
+
+      return np.dot( row_coeffs.T, x_basis )
+
+   #####################################################################################################################################
+   # RETURNS gradient (dz/dx,dz/dy) in units of value per pixel at pixel coordinates x,y (arrays of any shape)
+   #####################################################################################################################################
+   def gradient( self, x, y ) :
+      if self.basis != "monomial" :
+         deriv_x = orthogonal_basis.derivative_matrix( self.coeff_matrix, basis=self.basis, axis=0 ) / self.x_scale
+         deriv_y = orthogonal_basis.derivative_matrix( self.coeff_matrix, basis=self.basis, axis=1 ) / self.y_scale
+         return (self.evaluate_matrix( deriv_x, x, y ),self.evaluate_matrix( deriv_y, x, y ))
+
+      (n_x,n_y) = self.coeff_matrix.shape
+      p = np.arange( 0, n_x )[:,None]
+      q = np.arange( 0, n_y )[None,:]
+
+      deriv_x = np.zeros( (max(n_x-1,1),n_y) )
+      deriv_x[0:n_x-1,:] = ( p*self.coeff_matrix )[1:,:] / self.x_scale
+      deriv_y = np.zeros( (n_x,max(n_y-1,1)) )
+      deriv_y[:,0:n_y-1] = ( q*self.coeff_matrix )[:,1:] / self.y_scale
+
+      return (self.evaluate_matrix( deriv_x, x, y ),self.evaluate_matrix( deriv_y, x, y ))
+
+   #####################################################################################################################################
+   # RETURNS parameters of the surface as a dictionary (JSON serialisable)
+   #####################################################################################################################################
+   def to_dict( self ) :
+      return { "format" : "surface_fitter.FittedSurface", "coeffs" : self.coeffs.tolist(), "p" : self.p_exp.tolist(), "q" : self.q_exp.tolist(),
+               "x_c" : self.x_c, "y_c" : self.y_c, "x_scale" : self.x_scale, "y_scale" : self.y_scale, "basis" : self.basis }
+
+   #####################################################################################################################################
+   # Saves surface to .npz (binary) or .json (text) file, format recognised by the extension
+   #####################################################################################################################################
+   def save( self, filename ) :
+      if filename.endswith(".json") :
+         with open(filename,"w") as out_f :
+            json.dump( self.to_dict(), out_f, indent=1 )
+      else :
+         np.savez( filename, coeffs=self.coeffs, p=self.p_exp, q=self.q_exp, centre=np.array([self.x_c,self.y_c]), scale=np.array([self.x_scale,self.y_scale]), basis=self.basis )
+      print("Fitted surface saved to file %s" % (filename))
+
+   @classmethod
+   def from_dict( cls, params ) :
+      return cls( params["coeffs"], params["p"], params["q"], params["x_c"], params["y_c"], x_scale=params["x_scale"], y_scale=params["y_scale"], basis=params.get( "basis", "monomial" ) )
+
+   #####################################################################################################################################
+   # Loads surface from .npz or .json file saved by save
+   #####################################################################################################################################
+   @classmethod
+   def load( cls, filename ) :
+      if filename.endswith(".json") :
+         with open(filename,"r") as in_f :
+            return cls.from_dict( json.load( in_f ) )
+
+      with np.load( filename ) as data :
+         basis = ( str( data["basis"] ) if "basis" in data else "monomial" ) # files saved before the orthogonal bases
+         return cls( data["coeffs"], data["p"], data["q"], data["centre"][0], data["centre"][1], x_scale=data["scale"][0], y_scale=data["scale"][1], basis=basis )
+
+   def __repr__( self ) :
+      return ("FittedSurface(order=%d, n_params=%d, centre=(%.3f,%.3f), scale=(%.3f,%.3f), basis=%s)" % (self.order,len(self.coeffs),self.x_c,self.y_c,self.x_scale,self.y_scale,self.basis))
@@ -0,0 +1,121 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Vectorised evaluation of the fitted polynomial on a regular grid of pixels (e.g. full resolution 8192 x 8192 map).
+# For every row of a tile the coefficients c_p(y) = Sum_q a_pq y^q are calculated with the Horner scheme and the
+# values in the tile are obtained as a matrix product (outer-product evaluation) :
+#    value[y,x] = Sum_p c_p(y) * x^p
+# Tiles of tile_rows rows are evaluated independently (optionally by a pool of threads, NumPy releases the GIL) and
+# can be streamed to a memory-mapped .npy file, so the memory used does not depend on the size of the grid.
+# For the Legendre and Chebyshev bases (see orthogonal_basis.py) c_p(y) are calculated with the Clenshaw recurrence and
+# x^p are replaced by the basis functions B_p(x).
+#
+########################################################################################################################
+import collections
+import numpy as np
+
+try :
+   from . import fit_engine
+   from . import orthogonal_basis
+except ImportError :
+   import fit_engine
+   import orthogonal_basis
+
+# number of grid rows evaluated at once :
+DEFAULT_TILE_ROWS = 256
+
+########################################################################################################################################
+# RETURNS matrix of coefficients c[p,k] = Sum_q a_pq * y_k^q (Horner scheme in y) for normalised y values
+########################################################################################################################################
+def calc_row_coeffs( a, n, y ) :
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   y = np.asarray( y, dtype=np.float64 )
+
+   coeffs = np.zeros( (n+1,len(y)) )
+   for p in range(0,n+1) :
+      indexes = np.where( p_exp == p )[0]  # a_p0, a_p1, ... a_p(n-p)
+      for m in indexes[::-1] :
+         coeffs[p] = coeffs[p]*y + a[m]
+
+   return coeffs
+
+########################################################################################################################################
+# Evaluates polynomial on a grid of normalised coordinates x (columns) and y (rows), RETURNS array of shape (len(y),len(x))
+########################################################################################################################################
+def eval_grid_tile( a, n, x, y, basis="monomial" ) :
+   if basis == "monomial" :
+      coeffs = calc_row_coeffs( a, n, y )
+   else :
+      coeffs = orthogonal_basis.calc_row_coeffs( fit_engine.get_coeff_matrix( a, n ), y, basis=basis )
+   x_powers = np.array( fit_engine.calc_basis_powers( np.asarray( x, dtype=np.float64 ), n, basis=basis ) )
+
+   return np.dot( coeffs.T, x_powers )
+
+########################################################################################################################################
+# RETURNS pixel coordinates of the grid columns and rows for region (x_start,x_end,y_start,y_end) and step
+########################################################################################################################################
+def get_grid_axes( size=8192, step=10, region=None ) :
+   if region is None :
+      region = (0,size,0,size)
+   (x_start,x_end,y_start,y_end) = region
+
+   return (np.arange(x_start,x_end,step,dtype=np.float64),np.arange(y_start,y_end,step,dtype=np.float64))
+
+########################################################################################################################################
+# Generator of tiles of the polynomial on the grid x_axis x y_axis (pixel coordinates normalised with x_c,y_c) in the order of rows :
+# (start,values) where values of shape (n_rows,len(x_axis)) are rows start:start+n_rows of the grid. With threads > 1 tiles are
+# evaluated by a pool of threads at most threads tiles ahead of the consumer, so the memory used does not depend on the size of the grid.
+########################################################################################################################################
+def iterate_grid_tiles( a, n, x_c, y_c, x_axis, y_axis, tile_rows=DEFAULT_TILE_ROWS, threads=1, verbose=0, basis="monomial" ) :
+   x_norm = ( x_axis - x_c ) / x_c
+   y_norm = ( y_axis - y_c ) / y_c
+
+   def eval_tile( start ) :
+      values = eval_grid_tile( a, n, x_norm, y_norm[start:start+tile_rows], basis=basis )
+      if verbose > 0 :
+         print("Progress y = %d" % (y_axis[start]))
+      return values
+
+   starts = range(0,len(y_axis),tile_rows)
+   if threads > 1 :
+      from concurrent.futures import ThreadPoolExecutor # imported only when required (fast import of the package)
+      with ThreadPoolExecutor( max_workers=threads ) as pool :
+         pending = collections.deque()
+         for start in starts :
+            pending.append( (start,pool.submit( eval_tile, start )) )
+            if len(pending) >= threads :
+               (first,future) = pending.popleft()
+               yield (first,future.result())
+         while len(pending) > 0 :
+            (first,future) = pending.popleft()
+            yield (first,future.result())
+   else :
+      for start in starts :
+         yield (start,eval_tile( start ))
+
+########################################################################################################################################
+# Evaluates polynomial with coefficients a (order of get_exponents) on a grid of pixels :
+#   x_c , y_c  : image centre used in the fit to normalise coordinates
+#   size, step : grid covers pixels 0,step,2*step,... < size in X and Y (region=(x_start,x_end,y_start,y_end) can be used instead)
+#   outfile    : if set, the map is streamed (tile by tile) to a memory-mapped .npy file of shape (n_rows,n_columns)
+#   threads    : number of threads evaluating tiles in parallel
+#   basis      : basis of the coefficients a - monomial, legendre or chebyshev (see orthogonal_basis.py)
+# RETURNS : (x_axis,y_axis,values) where values is a 2D array (or memory-mapped array) with rows corresponding to y_axis
+########################################################################################################################################
+def evaluate_grid( a, n, x_c, y_c, size=8192, step=10, region=None, outfile=None, tile_rows=DEFAULT_TILE_ROWS, threads=1, verbose=0, basis="monomial" ) :
+   (x_axis,y_axis) = get_grid_axes( size=size, step=step, region=region )
+   shape = (len(y_axis),len(x_axis))
+
+   if outfile is not None :
+      values = np.lib.format.open_memmap( outfile, mode="w+", dtype=np.float64, shape=shape )
+   else :
+      values = np.empty( shape )
+
+   for (start,tile) in iterate_grid_tiles( a, n, x_c, y_c, x_axis, y_axis, tile_rows=tile_rows, threads=threads, verbose=verbose, basis=basis ) :
+      values[start:start+len(tile),:] = tile
+
+   if outfile is not None :
+      values.flush()
+      print("Fitted surface on a grid of %d x %d pixels saved to file %s" % (shape[1],shape[0],outfile))
+
+   return (x_axis,y_axis,values)
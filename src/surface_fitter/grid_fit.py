@@ -0,0 +1,143 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Separable normal equations for data sampled on a full rectangular grid x_axis x y_axis (images, surface_generator.py output).
+# The basis functions are products B_p(x)*B_q(y), so for all the pixels of the grid the moments factorise :
+#    gram[i,j] = Sum_x Sum_y B_pi(x) B_pj(x) B_qi(y) B_qj(y) = Gx[pi,pj] * Gy[qi,qj] , where Gx = Bx^T Bx , Gy = By^T By
+#    rhs[i]    = Sum_x Sum_y B_pi(x) B_qi(y) Z[y,x]         = (By^T Z Bx)[qi,pi]
+# Bx (nx,n+1) and By (ny,n+1) are tables of the basis functions on the axes. This requires O(nx*n^2 + ny*n^2) operations for the
+# gram matrix and O(nx*ny*n) for the rhs instead of O(N*P^2) of fit_engine.calc_normal_equations.
+# Masked pixels (mask=False or NaN values) are excluded by subtracting their contribution from the gram matrix of the full grid
+# (or, when most pixels are masked, by building it from the valid pixels only), so that cost is O(min(n_masked,n_valid)*P^2).
+#
+########################################################################################################################
+import numpy as np
+
+try :
+   from . import fit_engine
+except ImportError :
+   import fit_engine
+
+# minimum fraction of the grid nodes present in the data for the input to be treated as gridded (missing nodes are masked) :
+DEFAULT_MIN_FILL = 0.50
+
+# number of first points used for the quick rejection of scattered data :
+DETECT_SAMPLE_SIZE = 65536
+
+# number of points processed at once while the axes of the grid are collected :
+DETECT_CHUNK_SIZE = 1000000
+
+########################################################################################################################################
+# Checks if points (x,y) lie on a rectangular grid x_axis x y_axis (axes do not need to be equally spaced), each node at most once and
+# at least min_fill of the nodes present. Scattered data are rejected cheaply : first on the first DETECT_SAMPLE_SIZE points (too many
+# distinct coordinates or any repeated (x,y) pair), then while the axes are collected chunk by chunk (chunk_size points at a time, so
+# memory-mapped inputs are never read completely into memory) as soon as the grid of the axes has too many nodes. Repeated nodes are
+# found with a boolean image of the nodes (1 byte per node), indexes of the nodes are kept only for a chunk of points.
+# RETURNS : (x_axis,y_axis) - sorted axes of the grid (see get_grid_image), or None if the points are not on a grid
+########################################################################################################################################
+def detect_grid( x, y, min_fill=DEFAULT_MIN_FILL, chunk_size=DETECT_CHUNK_SIZE ) :
+   len_data = len(x)
+   if len_data == 0 :
+      return None
+   max_nodes = len_data / min_fill
+
+   # scattered data have (almost) all coordinates different or (integer pixel coordinates) repeated positions - quick check on the
+   # first points :
+   n_sample = min( len_data, DETECT_SAMPLE_SIZE )
+   (x_sample,y_sample) = (np.asarray( x[:n_sample] ),np.asarray( y[:n_sample] ))
+   if float( len(np.unique( x_sample )) ) * len(np.unique( y_sample )) > max_nodes :
+      return None
+   if len(np.unique( np.stack( (x_sample,y_sample), axis=1 ), axis=0 )) < n_sample :
+      return None
+
+   # axes collected in chunks with early exit :
+   (x_axis,y_axis) = (np.unique( x_sample ),np.unique( y_sample ))
+   for start in range(n_sample,len_data,chunk_size) :
+      x_axis = np.union1d( x_axis, x[start:start+chunk_size] )
+      y_axis = np.union1d( y_axis, y[start:start+chunk_size] )
+      if float( len(x_axis) ) * len(y_axis) > max_nodes :
+         return None
+
+   seen = np.zeros( len(x_axis)*len(y_axis), dtype=bool )
+   for start in range(0,len_data,chunk_size) :
+      seen[ get_node_index( x_axis, y_axis, x[start:start+chunk_size], y[start:start+chunk_size] ) ] = True
+   if np.count_nonzero( seen ) < len_data :
+      # repeated measurements of the same position
+      return None
+
+   return (x_axis,y_axis)
+
+########################################################################################################################################
+# RETURNS index iy*len(x_axis) + ix of the grid nodes of points (x,y) (x = x_axis[ix], y = y_axis[iy], sorted axes)
+########################################################################################################################################
+def get_node_index( x_axis, y_axis, x, y ) :
+   return np.searchsorted( y_axis, y )*len(x_axis) + np.searchsorted( x_axis, x )
+
+########################################################################################################################################
+# RETURNS image Z[iy,ix] of shape (len(y_axis),len(x_axis)) of values z of points (x,y) on the grid of sorted axes x_axis, y_axis
+# (see detect_grid) filled chunk by chunk, nodes without data are NaN
+########################################################################################################################################
+def get_grid_image( x, y, z, x_axis, y_axis, chunk_size=DETECT_CHUNK_SIZE ) :
+   image = np.full( (len(y_axis),len(x_axis)), np.nan )
+   image_flat = image.reshape( -1 )
+   for start in range(0,len(z),chunk_size) :
+      image_flat[ get_node_index( x_axis, y_axis, x[start:start+chunk_size], y[start:start+chunk_size] ) ] = z[start:start+chunk_size]
+
+   return image
+
+########################################################################################################################################
+# RETURNS gram matrix X^T X of the points (x,y) accumulated in chunks (as fit_engine.calc_normal_equations without the values)
+########################################################################################################################################
+def calc_gram( x, y, n, basis="monomial", chunk_size=fit_engine.DEFAULT_CHUNK_SIZE ) :
+   n_params = fit_engine.get_n_params( n )
+   gram = np.zeros( (n_params,n_params) )
+   for start in range(0,len(x),chunk_size) :
+      design = fit_engine.calc_design_matrix( x[start:start+chunk_size], y[start:start+chunk_size], n, basis=basis )
+      gram += np.dot( design.T, design )
+
+   return gram
+
+########################################################################################################################################
+# Builds normal equations of the fit of polynomial of order n to the image z_image[iy,ix] on the grid of (normalised) coordinates
+# x_axis x y_axis
+#   mask  : optional boolean image, pixels with mask=False are excluded from the fit (as well as pixels with NaN values)
+#   basis : monomial (default), legendre or chebyshev (see orthogonal_basis.py)
+#   overwrite : excluded pixels of z_image (float64 array) are set to 0 in place instead of in a copy of the image
+# RETURNS : (gram,rhs,n_valid,sum_z2) - normal equations, number of fitted pixels and sum of their squared values
+########################################################################################################################################
+def calc_normal_equations_grid( x_axis, y_axis, z_image, n, mask=None, basis="monomial", overwrite=False ) :
+   x_axis = np.asarray( x_axis, dtype=np.float64 )
+   y_axis = np.asarray( y_axis, dtype=np.float64 )
+   z_image = np.asarray( z_image, dtype=np.float64 )
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+
+   valid = np.isfinite( z_image )
+   if mask is not None :
+      valid &= np.asarray( mask, dtype=bool )
+   n_valid = int( np.count_nonzero( valid ) )
+   n_masked = valid.size - n_valid
+
+   # O(nx*ny) copy with zeros in the masked pixels (the input image is not modified unless overwrite=True) :
+   if overwrite :
+      z_valid = z_image
+      z_valid[~valid] = 0.00
+   else :
+      z_valid = np.where( valid, z_image, 0.00 )
+   sum_z2 = np.dot( z_valid.ravel(), z_valid.ravel() )
+
+   x_basis = np.array( fit_engine.calc_basis_powers( x_axis, n, basis=basis ) ).T
+   y_basis = np.array( fit_engine.calc_basis_powers( y_axis, n, basis=basis ) ).T
+   rhs = np.dot( y_basis.T, np.dot( z_valid, x_basis ) )[q_exp,p_exp]
+
+   if n_masked <= n_valid :
+      gram_x = np.dot( x_basis.T, x_basis )
+      gram_y = np.dot( y_basis.T, y_basis )
+      gram = gram_x[p_exp[:,None],p_exp[None,:]] * gram_y[q_exp[:,None],q_exp[None,:]]
+      if n_masked > 0 :
+         (iy,ix) = np.nonzero( ~valid )
+         gram -= calc_gram( x_axis[ix], y_axis[iy], n, basis=basis )
+   else :
+      (iy,ix) = np.nonzero( valid )
+      gram = calc_gram( x_axis[ix], y_axis[iy], n, basis=basis )
+
+   return (gram,rhs,n_valid,sum_z2)
@@ -0,0 +1,161 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Selection of the polynomial order from a single pass over the data.
+# Every element of the normal equations of the order n fit is a moment of the data :
+#    gram[(p,q),(i,j)] = Sum x^(p+i) y^(q+j)    rhs[(p,q)] = Sum z x^p y^q
+# so the moments M[a,b] = Sum x^a y^b (a,b <= 2*n_max) and Mz[a,b] = Sum z x^a y^b (a,b <= n_max) are calculated once
+# and the normal equations of every order n <= n_max are built from this table.
+# Data are split into k folds (point index modulo k) with separate moment tables, so the k-fold cross-validation is
+# done by subtracting moments of a fold from the total (no refitting) and the error on the fold is also calculated
+# from its moments : Sum_fold (z - Xa)^2 = Sum z^2 - 2 a^T rhs_fold + a^T gram_fold a
+#
+########################################################################################################################
+import numpy as np
+
+try :
+   from . import fit_engine
+except ImportError :
+   import fit_engine
+
+########################################################################################################################################
+# Moments of the data required to fit polynomials of order up to max_order, separately for each of n_folds folds
+########################################################################################################################################
+class MomentTable :
+   def __init__( self, max_order, n_folds=1 ) :
+      self.max_order = max_order
+      self.n_folds = max( 1, n_folds )
+      size_xy = 2*max_order + 1
+      size_z  = max_order + 1
+
+      self.mom_xy = np.zeros( (self.n_folds,size_xy,size_xy) ) # Sum x^a y^b
+      self.mom_z  = np.zeros( (self.n_folds,size_z,size_z) )   # Sum z x^a y^b
+      self.sum_z2 = np.zeros( self.n_folds )
+      self.n_points = np.zeros( self.n_folds, dtype=np.int64 )
+
+   #####################################################################################################################################
+   # Adds moments of normalised coordinates x,y and values z, first_index is the index of the first point (used to assign folds)
+   #####################################################################################################################################
+   def add( self, x, y, z, first_index=0, chunk_size=fit_engine.DEFAULT_CHUNK_SIZE ) :
+      len_data = len(z)
+      for start in range(0,len_data,chunk_size) :
+         end = min( start + chunk_size, len_data )
+         x_powers = np.array( fit_engine.calc_powers( np.asarray( x[start:end], dtype=np.float64 ), 2*self.max_order ) )
+         y_powers = np.array( fit_engine.calc_powers( np.asarray( y[start:end], dtype=np.float64 ), 2*self.max_order ) )
+         z_chunk  = np.asarray( z[start:end], dtype=np.float64 )
+         folds = ( np.arange( first_index+start, first_index+end ) % self.n_folds )
+
+         for fold in range(0,self.n_folds) :
+            if self.n_folds > 1 :
+               mask = ( folds == fold )
+               (xp,yp,zf) = (x_powers[:,mask],y_powers[:,mask],z_chunk[mask])
+            else :
+               (xp,yp,zf) = (x_powers,y_powers,z_chunk)
+
+            self.mom_xy[fold] += np.dot( xp, yp.T )
+            self.mom_z[fold]  += np.dot( xp[0:self.max_order+1]*zf, yp[0:self.max_order+1].T )
+            self.sum_z2[fold] += np.dot( zf, zf )
+            self.n_points[fold] += len(zf)
+
+      return self
+
+   #####################################################################################################################################
+   # RETURNS normal equations (gram,rhs,sum_z2,n_points) of order n built from the moments of all the data (fold=None),
+   # of a single fold or of all the data except a fold (exclude_fold)
+   #####################################################################################################################################
+   def get_normal_equations( self, n, fold=None, exclude_fold=None ) :
+      if n > self.max_order :
+         print("ERROR : moments calculated up to order %d cannot be used for order %d" % (self.max_order,n))
+         raise ValueError("Polynomial order %d higher than the order of moments %d" % (n,self.max_order))
+
+      if fold is not None :
+         (mom_xy,mom_z,sum_z2,n_points) = (self.mom_xy[fold],self.mom_z[fold],self.sum_z2[fold],self.n_points[fold])
+      else :
+         (mom_xy,mom_z,sum_z2,n_points) = (self.mom_xy.sum(axis=0),self.mom_z.sum(axis=0),self.sum_z2.sum(),self.n_points.sum())
+         if exclude_fold is not None :
+            mom_xy = mom_xy - self.mom_xy[exclude_fold]
+            mom_z  = mom_z - self.mom_z[exclude_fold]
+            sum_z2 = sum_z2 - self.sum_z2[exclude_fold]
+            n_points = n_points - self.n_points[exclude_fold]
+
+      (p_exp,q_exp) = fit_engine.get_exponents( n )
+      gram = mom_xy[ p_exp[:,None] + p_exp[None,:], q_exp[:,None] + q_exp[None,:] ]
+      rhs  = mom_z[ p_exp, q_exp ]
+
+      return (gram,rhs,sum_z2,n_points)
+
+########################################################################################################################################
+# chi2 = Sum (z - Xa)^2 calculated from the normal equations
+########################################################################################################################################
+def calc_chi2( a, gram, rhs, sum_z2 ) :
+   return sum_z2 - 2.00*np.dot( a, rhs ) + np.dot( a, np.dot( gram, a ) )
+
+########################################################################################################################################
+# Fits all the orders from the list orders using moments (normalised coordinates x,y and values z) calculated only once
+#   kfold : number of folds for cross-validation (<=1 - no cross-validation)
+# RETURNS : list of dictionaries (one per order) with keys : order, n_params, a, chi2, rms, aic, bic, cv_mse
+########################################################################################################################################
+def sweep_orders( x, y, z, orders, kfold=5, solver="cholesky", verbose=0 ) :
+   orders = sorted( orders )
+   moments = MomentTable( max(orders), n_folds=kfold ).add( x, y, z )
+   n_points = moments.n_points.sum()
+
+   results = []
+   for n in orders :
+      n_params = fit_engine.get_n_params( n )
+      (gram,rhs,sum_z2,n_total) = moments.get_normal_equations( n )
+      a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+      chi2 = max( calc_chi2( a, gram, rhs, sum_z2 ), 0.00 )
+
+      # information criteria for Gaussian errors with unknown variance :
+      log_likelihood_term = n_points*np.log( max( chi2/n_points, np.finfo(float).tiny ) )
+      aic = log_likelihood_term + 2.00*n_params
+      bic = log_likelihood_term + n_params*np.log( n_points )
+
+      cv_mse = np.nan
+      if kfold > 1 :
+         cv_chi2 = 0.00
+         for fold in range(0,kfold) :
+            (gram_train,rhs_train,sum_z2_train,n_train) = moments.get_normal_equations( n, exclude_fold=fold )
+            a_train = fit_engine.solve_normal_equations( gram_train, rhs_train, solver=solver )
+            (gram_test,rhs_test,sum_z2_test,n_test) = moments.get_normal_equations( n, fold=fold )
+            cv_chi2 += max( calc_chi2( a_train, gram_test, rhs_test, sum_z2_test ), 0.00 )
+         cv_mse = cv_chi2 / n_points
+
+      result = { "order" : n, "n_params" : n_params, "a" : a, "chi2" : chi2, "rms" : np.sqrt( chi2/n_points ), "aic" : aic, "bic" : bic, "cv_mse" : cv_mse }
+      results.append( result )
+      if verbose > 0 :
+         print("DEBUG : order = %d -> chi2 = %.8f , BIC = %.4f , CV MSE = %.8e" % (n,chi2,bic,cv_mse))
+
+   return results
+
+########################################################################################################################################
+# Prints (and optionally saves to a text file) table of results of sweep_orders
+# RETURNS : best order according to the cross-validation error (or BIC if cross-validation was not done)
+########################################################################################################################################
+def print_sweep( results, outfile=None ) :
+   header = "# ORDER N_PARAMS CHI2 RMS AIC BIC CV_MSE"
+   lines = []
+   for result in results :
+      lines.append( "%d %d %.8f %.8f %.4f %.4f %.8e" % (result["order"],result["n_params"],result["chi2"],result["rms"],result["aic"],result["bic"],result["cv_mse"]) )
+
+   print( header )
+   for line in lines :
+      print( line )
+
+   if np.isnan( results[0]["cv_mse"] ) :
+      best = min( results, key=lambda result : result["bic"] )
+      print("Best order = %d (minimum BIC)" % (best["order"]))
+   else :
+      best = min( results, key=lambda result : result["cv_mse"] )
+      print("Best order = %d (minimum cross-validation error)" % (best["order"]))
+
+   if outfile is not None :
+      out_f = open(outfile,"w")
+      out_f.write( header + "\n" )
+      for line in lines :
+         out_f.write( line + "\n" )
+      out_f.close()
+      print("Order sweep results saved to file %s" % (outfile))
+
+   return best["order"]
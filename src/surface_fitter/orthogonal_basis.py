@@ -0,0 +1,178 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Orthogonal polynomial bases of the total degree n on [-1,1] x [-1,1] : p(x,y) = Sum c_pq * B_p(x) * B_q(y) for p+q <= n,
+# with coefficients in the same (p,q) order as the monomials (fit_engine.get_exponents). The functions B_k satisfy the
+# three-term recurrence :
+#    B_0(x) = 1 , B_1(x) = alpha_0 * x , B_k+1(x) = alpha_k * x * B_k(x) + beta_k * B_k-1(x)
+#    monomial  : alpha_k = 1 , beta_k = 0                        (B_k = x^k)
+#    legendre  : alpha_k = (2k+1)/(k+1) , beta_k = -k/(k+1)
+#    chebyshev : alpha_0 = 1 , alpha_k = 2 , beta_k = -1         (first kind)
+# Columns of the design matrix of Legendre/Chebyshev polynomials are nearly orthogonal for data covering the whole image,
+# so the normal equations stay well conditioned up to order 15-20 (monomials become ill-conditioned above order 7-8).
+# Values are calculated from the table of B_q(y) (row coefficients c_p(y) = Sum_q C[p,q] B_q(y) as a single matrix product, as for
+# the monomials in fit_engine.calc_poly_values_matrix) and the Clenshaw recurrence in x, so the cost per point is O(n^2) as for the
+# monomials. The coefficients can be converted to the monomial [a_pq,p,q] format (get_polynonial in fit_poly_3d.py) with to_monomial.
+#
+########################################################################################################################
+import numpy as np
+
+BASES = ["monomial","legendre","chebyshev"]
+
+# number of data points evaluated at once :
+DEFAULT_CHUNK_SIZE = 65536
+
+def check_basis( basis ) :
+   if basis not in BASES :
+      print("ERROR : unknown basis %s, allowed are : %s" % (basis,BASES))
+      raise ValueError("Unknown basis %s" % (basis))
+
+########################################################################################################################################
+# RETURNS arrays (alpha,beta) of coefficients of the recurrence B_k+1 = alpha_k * x * B_k + beta_k * B_k-1 for k = 0 ... n
+########################################################################################################################################
+def get_recurrence( basis, n ) :
+   check_basis( basis )
+   k = np.arange( 0, n+1, dtype=np.float64 )
+
+   if basis == "legendre" :
+      return ((2.00*k + 1.00)/(k + 1.00),-k/(k + 1.00))
+   if basis == "chebyshev" :
+      alpha = np.full( n+1, 2.00 )
+      alpha[0] = 1.00
+      beta = np.full( n+1, -1.00 )
+      beta[0] = 0.00
+      return (alpha,beta)
+
+   return (np.ones( n+1 ),np.zeros( n+1 ))
+
+########################################################################################################################################
+# Calculates table of basis functions [B_0(x), B_1(x), ... , B_n(x)] (the equivalent of fit_engine.calc_powers)
+########################################################################################################################################
+def calc_basis_values( x, n, basis="legendre" ) :
+   return list( calc_basis_table( x, n, basis=basis ) )
+
+########################################################################################################################################
+# RETURNS table of basis functions B_k(x) for k = 0 ... n as array of shape (n+1,len(x)) (calculated in place, no temporary arrays)
+########################################################################################################################################
+def calc_basis_table( x, n, basis="legendre" ) :
+   (alpha,beta) = get_recurrence( basis, n )
+   x = np.asarray( x, dtype=np.float64 )
+   table = np.empty( (n+1,) + x.shape )
+   table[0] = 1.00
+   if n >= 1 :
+      np.multiply( x, alpha[0], out=table[1] )
+   for k in range(1,n) :
+      np.multiply( x, table[k], out=table[k+1] )
+      table[k+1] *= alpha[k]
+      if beta[k] != 0.00 :
+         table[k+1] += beta[k]*table[k-1]
+
+   return table
+
+########################################################################################################################################
+# Clenshaw recurrence for coefficients c[k,i] of points x[i] : RETURNS Sum_k c[k,i] * B_k(x[i]) (operations in place as in the
+# Horner scheme of fit_engine.calc_poly_values_matrix)
+########################################################################################################################################
+def clenshaw( row_coeffs, x, basis="legendre" ) :
+   n = row_coeffs.shape[0] - 1
+   (alpha,beta) = get_recurrence( basis, n+1 )
+
+   b_1 = np.zeros( len(x) )
+   b_2 = np.zeros( len(x) )
+   b_0 = np.empty( len(x) )
+   for k in range(n,0,-1) :
+      # b_0 = c_k + alpha_k * x * b_1 + beta_k+1 * b_2 :
+      np.multiply( x, b_1, out=b_0 )
+      b_0 *= alpha[k]
+      b_0 += row_coeffs[k]
+      b_2 *= beta[k+1]
+      b_0 += b_2
+      (b_0,b_1,b_2) = (b_2,b_0,b_1)
+
+   np.multiply( x, b_1, out=b_0 )
+   b_0 *= alpha[0]
+   b_0 += row_coeffs[0]
+   b_2 *= beta[1]
+   b_0 += b_2
+
+   return b_0
+
+########################################################################################################################################
+# RETURNS matrix of row coefficients c[p,k] = Sum_q C[p,q] * B_q(y_k) for coefficients in the matrix form C[p,q] (matrix product with
+# the table of B_q(y), no temporary arrays of shape (n+1,n+1,len(y)))
+########################################################################################################################################
+def calc_row_coeffs( coeff_matrix, y, basis="legendre" ) :
+   y_basis = calc_basis_table( y, coeff_matrix.shape[1]-1, basis=basis )
+
+   return np.dot( coeff_matrix, y_basis )
+
+########################################################################################################################################
+# Calculates values of Sum C[p,q] * B_p(x) * B_q(y) for 1D arrays of normalised coordinates x,y (in chunks) from the row coefficients
+# c_p(y) (see calc_row_coeffs) and the Clenshaw recurrence in x, coeff_matrix can be rectangular (e.g. derivatives)
+########################################################################################################################################
+def calc_values_matrix( x, y, coeff_matrix, basis="legendre", chunk_size=DEFAULT_CHUNK_SIZE ) :
+   len_data = len(x)
+   out = np.empty( len_data )
+
+   for start in range(0,len_data,chunk_size) :
+      end = min( start + chunk_size, len_data )
+      row_coeffs = calc_row_coeffs( coeff_matrix, y[start:end], basis=basis )
+      out[start:end] = clenshaw( row_coeffs, np.asarray( x[start:end], dtype=np.float64 ), basis=basis )
+
+   return out
+
+########################################################################################################################################
+# RETURNS matrix M[k,j] = coefficient of x^j in B_k(x) for k,j = 0 ... n
+########################################################################################################################################
+def get_monomial_matrix( n, basis="legendre" ) :
+   (alpha,beta) = get_recurrence( basis, n )
+   matrix = np.zeros( (n+1,n+1) )
+   matrix[0,0] = 1.00
+   if n >= 1 :
+      matrix[1,1] = alpha[0]
+   for k in range(1,n) :
+      matrix[k+1,1:] = alpha[k]*matrix[k,:-1]
+      matrix[k+1,:] += beta[k]*matrix[k-1,:]
+
+   return matrix
+
+########################################################################################################################################
+# Converts coefficients in the matrix form C[p,q] of basis functions to monomial coefficients A[i,j] (of x^i * y^j) :
+#    A = M_x^T * C * M_y
+# Note that the monomial coefficients of high orders (>10) can be large and cancel each other (they are exact only up to rounding
+# errors), so the evaluation in the orthogonal basis is more accurate
+########################################################################################################################################
+def to_monomial_matrix( coeff_matrix, basis="legendre" ) :
+   (n_x,n_y) = coeff_matrix.shape
+   m_x = get_monomial_matrix( n_x-1, basis=basis )
+   m_y = get_monomial_matrix( n_y-1, basis=basis )
+
+   return np.dot( m_x.T, np.dot( coeff_matrix, m_y ) )
+
+########################################################################################################################################
+# Converts coefficients c of basis functions B_p(x)*B_q(y) with exponents p_exp,q_exp (e.g. fit_engine.get_exponents) to monomial
+# coefficients in the same order (B_p(x)*B_q(y) contains only monomials x^i*y^j with i <= p and j <= q)
+########################################################################################################################################
+def to_monomial( c, p_exp, q_exp, basis="legendre" ) :
+   coeff_matrix = np.zeros( (np.max(p_exp)+1,np.max(q_exp)+1) )
+   np.add.at( coeff_matrix, (p_exp,q_exp), np.asarray( c, dtype=np.float64 ) )
+
+   return to_monomial_matrix( coeff_matrix, basis=basis )[p_exp,q_exp]
+
+########################################################################################################################################
+# RETURNS derivative of Sum C[p,q] * B_p(x) * B_q(y) by x (axis=0) or y (axis=1) as matrix of coefficients in the same basis
+########################################################################################################################################
+def derivative_matrix( coeff_matrix, basis="legendre", axis=0 ) :
+   if basis == "legendre" :
+      deriv = np.polynomial.legendre.legder( coeff_matrix, axis=axis )
+   elif basis == "chebyshev" :
+      deriv = np.polynomial.chebyshev.chebder( coeff_matrix, axis=axis )
+   else :
+      deriv = np.polynomial.polynomial.polyder( coeff_matrix, axis=axis )
+
+   if deriv.shape[axis] == 0 :
+      shape = list( coeff_matrix.shape )
+      shape[axis] = 1
+      return np.zeros( shape )
+
+   return deriv
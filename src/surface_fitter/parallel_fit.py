@@ -0,0 +1,169 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Multi-core assembly of the normal equations of the polynomial fit.
+# The input is split into row ranges (arrays) or byte ranges aligned to line boundaries (text files) and every worker
+# of a process pool accumulates its own partial Gram matrix X^T X and RHS X^T z (see streaming_fit.StreamingFitter).
+# The partial sums are added in a fixed order before the system is solved, so the result is the same as in the serial
+# path to within round-off.
+#    Arrays (including memory-mapped ones) are inherited by the workers (fork) without copying, on platforms without
+#    fork the row ranges are sent to the workers.
+#
+########################################################################################################################
+import os
+import numpy as np
+
+try :
+   from . import streaming_fit
+except ImportError :
+   import streaming_fit
+
+# size of blocks read by a worker from its byte range of a text file :
+DEFAULT_BLOCK_BYTES = 32*1024*1024
+
+# arrays (x,y,z) shared with forked workers :
+_shared_arrays = None
+
+########################################################################################################################################
+# RETURNS list of (start,end) row ranges splitting n_rows rows into n_parts parts
+########################################################################################################################################
+def split_rows( n_rows, n_parts ) :
+   bounds = np.linspace( 0, n_rows, n_parts+1 ).astype(np.int64)
+
+   return [ (int(bounds[i]),int(bounds[i+1])) for i in range(0,n_parts) if bounds[i+1] > bounds[i] ]
+
+########################################################################################################################################
+# RETURNS list of (start,end) byte ranges of a text file, every range starts at the beginning of a line
+########################################################################################################################################
+def split_file( filename, n_parts ) :
+   file_size = os.stat(filename).st_size
+   starts = [0]
+   with open(filename,'rb') as f :
+      for i in range(1,n_parts) :
+         pos = (file_size*i) // n_parts
+         if pos <= starts[-1] :
+            continue
+         f.seek( pos - 1 )
+         f.readline() # move to the beginning of the next line
+         pos = f.tell()
+         if pos < file_size and pos > starts[-1] :
+            starts.append( pos )
+
+   starts.append( file_size )
+
+   return [ (starts[i],starts[i+1]) for i in range(0,len(starts)-1) ]
+
+########################################################################################################################################
+# Worker function : accumulates normal equations for rows start:end of the arrays shared by the parent process
+########################################################################################################################################
+def accumulate_shared_rows( args ) :
+   (start,end,n,x_c,y_c,basis) = args
+   (x,y,z) = _shared_arrays
+
+   return accumulate_rows( (x[start:end],y[start:end],z[start:end],n,x_c,y_c,basis) )
+
+########################################################################################################################################
+# Worker function : accumulates normal equations for arrays x,y,z (z can be 2D array (N,n_columns) with many value columns)
+########################################################################################################################################
+def accumulate_rows( args ) :
+   (x,y,z,n,x_c,y_c,basis) = args
+   n_columns = 1
+   if np.ndim(z) > 1 :
+      n_columns = np.shape(z)[1]
+   fitter = streaming_fit.StreamingFitter( polynomial_order=n, x_c=x_c, y_c=y_c, n_columns=n_columns, basis=basis )
+
+   for (start,end) in split_rows( len(z), max( 1, len(z) // streaming_fit.DEFAULT_CHUNK_SIZE ) ) :
+      fitter.partial_fit( (x[start:end],y[start:end],z[start:end]) )
+
+   return fitter
+
+########################################################################################################################################
+# Worker function : accumulates normal equations for lines in the byte range start:end of a plain text file (columns X Y Z)
+########################################################################################################################################
+def accumulate_byte_range( args ) :
+   (filename,start,end,n,x_c,y_c,block_bytes,basis) = args
+   fitter = streaming_fit.StreamingFitter( polynomial_order=n, x_c=x_c, y_c=y_c, basis=basis )
+
+   with open(filename,'rb') as f :
+      f.seek( start )
+      pos = start
+      remainder = b''
+      while pos < end :
+         buf = f.read( min( block_bytes, end - pos ) )
+         if len(buf) <= 0 :
+            break
+         pos += len(buf)
+
+         buf = remainder + buf
+         if pos < end :
+            # keep incomplete last line for the next block :
+            last_newline = buf.rfind( b'\n' )
+            remainder = buf[last_newline+1:]
+            buf = buf[:last_newline+1]
+         else :
+            remainder = b''
+
+         if len(buf) > 0 :
+            chunk = np.loadtxt( buf.decode().splitlines(), comments="#", usecols=(0,1,2), ndmin=2 )
+            if chunk.shape[0] > 0 :
+               fitter.partial_fit( chunk )
+
+   return fitter
+
+########################################################################################################################################
+# Runs tasks in a process pool and merges the returned fitters (in the order of tasks)
+########################################################################################################################################
+def run_tasks( func, tasks, workers, mp_context=None ) :
+   from concurrent.futures import ProcessPoolExecutor # imported only when required (fast import of the package)
+
+   with ProcessPoolExecutor( max_workers=workers, mp_context=mp_context ) as pool :
+      fitters = list( pool.map( func, tasks ) )
+
+   fitter = fitters[0]
+   for other in fitters[1:] :
+      fitter.merge( other )
+
+   return fitter
+
+########################################################################################################################################
+# Accumulates normal equations for arrays x,y,z (in pixel coordinates, normalised with x_c,y_c) using workers processes
+# (basis of the polynomial monomial, legendre or chebyshev)
+# RETURNS : streaming_fit.StreamingFitter with the summed normal equations
+########################################################################################################################################
+def accumulate_arrays( x, y, z, n, x_c, y_c, workers=2, verbose=0, basis="monomial" ) :
+   global _shared_arrays
+
+   ranges = split_rows( len(z), workers )
+   if verbose > 0 :
+      print("DEBUG : accumulating normal equations for %d data points in %d row ranges using %d workers" % (len(z),len(ranges),workers))
+
+   if len(ranges) <= 1 :
+      return accumulate_rows( (x,y,z,n,x_c,y_c,basis) )
+
+   import multiprocessing
+   if "fork" in multiprocessing.get_all_start_methods() :
+      _shared_arrays = (x,y,z)
+      try :
+         tasks = [ (start,end,n,x_c,y_c,basis) for (start,end) in ranges ]
+         return run_tasks( accumulate_shared_rows, tasks, workers, mp_context=multiprocessing.get_context("fork") )
+      finally :
+         _shared_arrays = None
+
+   tasks = [ (x[start:end],y[start:end],z[start:end],n,x_c,y_c,basis) for (start,end) in ranges ]
+   return run_tasks( accumulate_rows, tasks, workers )
+
+########################################################################################################################################
+# Accumulates normal equations for a plain text file with columns X Y Z, every worker reads its own byte range of the file
+# (basis of the polynomial monomial, legendre or chebyshev)
+# RETURNS : streaming_fit.StreamingFitter with the summed normal equations
+########################################################################################################################################
+def accumulate_file( filename, n, x_c, y_c, workers=2, block_bytes=DEFAULT_BLOCK_BYTES, verbose=0, basis="monomial" ) :
+   ranges = split_file( filename, workers )
+   if verbose > 0 :
+      print("DEBUG : accumulating normal equations for file %s in %d byte ranges using %d workers" % (filename,len(ranges),workers))
+
+   tasks = [ (filename,start,end,n,x_c,y_c,block_bytes,basis) for (start,end) in ranges ]
+   if len(tasks) <= 1 :
+      return accumulate_byte_range( tasks[0] )
+
+   return run_tasks( accumulate_byte_range, tasks, workers )
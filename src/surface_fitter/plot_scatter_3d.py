@@ -3,19 +3,55 @@ from __future__ import print_function
 #
 # Developed by Marcin Sokolowski (marcin.sokolowski@curtin.edu.au) , version 1.00 , 2021-11
 # Plots 3 column file and creates a 3D plot 
+#
+# Files with more than max_scatter_points points (default 200000) are not plotted point by point (scatter plots of millions
+# of points hang or exhaust memory), but points are binned to an image of n_bins x n_bins pixels (mean, median or count
+# of the values in every pixel, see bin_points) shown with imshow (mode=image) or as a 3D surface (mode=surface) :
+#
+#    python ./plot_scatter_3d.py fitted_vs_data_order03.npy --plotcol=4 --vmin=-4 --vmax=4 --mode=image --outfile=residuals.png
+#
+# When outfile is given the plot is made with the Agg backend (no display required) and saved to the file.
 ########################################################################################################################
 import numpy as np
 import os
 import sys
-from mpl_toolkits.mplot3d import Axes3D
 import copy
 from optparse import OptionParser,OptionGroup
 
 import re
 
-import matplotlib as m
-import matplotlib.pyplot as plt
-plt.style.use('seaborn-v0_8-whitegrid') # in python2 was : seaborn-whitegrid')
+
+try :
+   from . import data_reader
+except ImportError :
+   # when executed as a script (python ./plot_scatter_3d.py) and not as a part of the package :
+   import data_reader
+
+########################################################################################################################################
+# Imports matplotlib only when a plot is made (importing the package and fitting require only NumPy)
+#   backend : matplotlib backend (e.g. Agg to save plots without display), has to be set before the first plot
+# RETURNS : (matplotlib,matplotlib.pyplot)
+########################################################################################################################################
+def import_matplotlib( backend=None ) :
+   import matplotlib as m
+   if backend is not None :
+      m.use( backend )
+   import matplotlib.pyplot as plt
+
+   if not getattr( import_matplotlib, "style_set", False ) :
+      plt.style.use('seaborn-v0_8-whitegrid') # in python2 was : seaborn-whitegrid')
+      import_matplotlib.style_set = True
+
+   return (m,plt)
+
+# maximum number of points plotted point by point in the auto mode :
+DEFAULT_MAX_SCATTER_POINTS = 200000
+
+# bins are filled in chunks of this number of points (bounded memory for memory-mapped inputs) :
+BIN_CHUNK_SIZE = 10000000
+
+# median is calculated from at most this number of randomly selected points :
+MAX_MEDIAN_POINTS = 5000000
 
 def parse_options():
    usage="Usage: %prog [options]\n"
@@ -25,6 +61,11 @@ def parse_options():
    parser.add_option('--vmax','--max_z','--max_value',dest="vmax",default=20.00, help="Vmax value for colorbar [default %]",type="float")
    parser.add_option('--ncols','--n_columns','--num_columns',dest="ncols",default=10, help="Number of columns in a file [default %]",type="int")
    parser.add_option('--plotcol','--plot_column','--plot_col',dest="plotcol",default=2, help="Plot column when ncols != 10 [default %]",type="int")
+   parser.add_option('--mode','--plot_mode',dest="mode",default="auto", help="Plot mode : scatter (every point), image (points binned to an image), surface (binned image as 3D surface) or auto (scatter for up to --max_scatter_points points, image otherwise) [default %default]",type="string")
+   parser.add_option('--bins','--n_bins',dest="n_bins",default=512, help="Number of bins in X and Y of the binned image [default %default]",type="int")
+   parser.add_option('--statistic',dest="statistic",default="mean", help="Value of a pixel of the binned image : mean, median or count [default %default]",type="string")
+   parser.add_option('--max_scatter_points',dest="max_scatter_points",default=DEFAULT_MAX_SCATTER_POINTS, help="Maximum number of points plotted as scatter plot in the auto mode [default %default]",type="int")
+   parser.add_option('--outfile','--png','--out_png',dest="outfile",default=None, help="Save plot to this file (e.g. plot.png) using Agg backend instead of showing it [default %default]",type="string")
    
 #   parser.add_option('--image_size','--size',dest="image_size",default=8192, help="Image size [default %]",type="int")
 
@@ -37,40 +78,140 @@ def parse_options():
 
 #  X   Y   RA_image[deg]    DEC_image[deg]  Flux_image[Jy]   RA_gleam[deg]    DEC_gleam[deg]    Flux_gleam[Jy]   AngDist[arcsec]    CalConst
 # 16   2930   284.3990    -23.1885    0.023    284.3999    -23.1880    0.569    3.40    24.60445805 
-def read_text_file( filename , ncols=10 , plotcol=2 , min_val=-1e20, max_val=1e20, verbose=0 ) :
-   x_list = []
-   y_list = []
-   calconst_list = []
-
-   if os.path.exists(filename) and os.stat(filename).st_size > 0 :
-      file=open(filename,'r')
-      data=file.readlines()
-      for line in data :
-         if line[0] != "#" :
-#            words = line.split(' ')
-            words = re.split( '\s+' , line )
-
-            if verbose > 0 :         
-               print("DEBUG : line = %s -> |%s|%s|" % (line,words[0+0],words[1+0]))
-            x = float(words[0+0])
-            y = float(words[1+0])
-            calconst = float(words[plotcol+0])
-         
-            if calconst > min_val and calconst < max_val :
-               x_list.append(x)
-               y_list.append(y)
-               calconst_list.append(calconst)               
-            
-      file.close()      
-   else :
-      print("WARNING : empty or non-existing file %s" % (filename))
+def read_text_file( filename , ncols=10 , plotcol=2 , min_val=-1e20, max_val=1e20, verbose=0, use_cache=True ) :
+   (x_list,y_list,calconst_list) = data_reader.read_columns( filename, columns=(0,1,plotcol), use_cache=use_cache, verbose=verbose )
+
+   mask = (calconst_list > min_val) & (calconst_list < max_val)
+   if not np.all( mask ) :
+      x_list = x_list[mask]
+      y_list = y_list[mask]
+      calconst_list = calconst_list[mask]
 
    print("READ %d values from file %s" % (len(x_list),filename))
    
    return (x_list,y_list,calconst_list)
 
-def plot_scatter( filename , ncols=5, plotcol=2, vmin=0, vmax=20, verbose=0 ) :   
+########################################################################################################################################
+# RETURNS medians of values in pixels index (0 - n_pixels-1), NaN in pixels without values
+########################################################################################################################################
+def calc_pixel_medians( index, values, n_pixels ) :
+   # values sorted by value and then (stable sort, 2-3x faster than np.lexsort) by pixel, median from the middle value(s) of every pixel :
+   order = np.argsort( values )
+   pixels = index[order]
+   if n_pixels <= 65536 :
+      pixels = pixels.astype( np.uint16 ) # radix sort
+   values_sorted = values[ order[ np.argsort( pixels, kind="stable" ) ] ]
+   counts = np.bincount( index, minlength=n_pixels )
+   starts = np.cumsum( counts ) - counts
+   filled = ( counts > 0 )
+   medians = np.full( n_pixels, np.nan )
+   medians[filled] = 0.50*( values_sorted[ starts[filled] + (counts[filled]-1)//2 ] + values_sorted[ starts[filled] + counts[filled]//2 ] )
+
+   return medians
+
+########################################################################################################################################
+# Bins points (x,y,z) to an image of n_bins x n_bins pixels covering extent=(x_min,x_max,y_min,y_max) (default range of the data)
+#   statistic : mean, median or count of the points in every pixel (NaN in pixels without points for mean and median),
+#               median is calculated from at most MAX_MEDIAN_POINTS randomly selected points
+# RETURNS : (image,extent) where image has shape (n_bins,n_bins) with rows corresponding to Y
+########################################################################################################################################
+def bin_points( x, y, z, n_bins=512, extent=None, statistic="mean" ) :
+   if extent is None :
+      extent = ( float(np.min(x)), float(np.max(x)), float(np.min(y)), float(np.max(y)) )
+   (x_min,x_max,y_min,y_max) = extent
+   x_scale = n_bins / max( x_max - x_min, 1e-300 )
+   y_scale = n_bins / max( y_max - y_min, 1e-300 )
+   n_pixels = n_bins*n_bins
+
+   def get_pixel_index( x_chunk, y_chunk ) :
+      ix = np.clip( ( ( x_chunk - x_min ) * x_scale ).astype( np.intp ), 0, n_bins-1 )
+      iy = np.clip( ( ( y_chunk - y_min ) * y_scale ).astype( np.intp ), 0, n_bins-1 )
+      return iy*n_bins + ix
+
+   if statistic == "median" :
+      selected = slice( 0, len(z) )
+      if len(z) > MAX_MEDIAN_POINTS :
+         selected = np.sort( np.random.default_rng( 0 ).choice( len(z), MAX_MEDIAN_POINTS, replace=False ) )
+      z_selected = np.asarray( z[selected] )
+      index = get_pixel_index( x[selected], y[selected] )
+
+      image = calc_pixel_medians( index, z_selected, n_pixels )
+   elif statistic in ("mean","count") :
+      sums = np.zeros( n_pixels )
+      counts = np.zeros( n_pixels )
+      for start in range(0,len(z),BIN_CHUNK_SIZE) :
+         end = min( start + BIN_CHUNK_SIZE, len(z) )
+         index = get_pixel_index( x[start:end], y[start:end] )
+         counts += np.bincount( index, minlength=n_pixels )
+         if statistic == "mean" :
+            sums += np.bincount( index, weights=z[start:end], minlength=n_pixels )
+
+      image = counts
+      if statistic == "mean" :
+         image = np.full( n_pixels, np.nan )
+         np.divide( sums, counts, out=image, where=(counts > 0) )
+   else :
+      raise ValueError("Unknown statistic %s (expected mean, median or count)" % (statistic))
+
+   return (image.reshape( (n_bins,n_bins) ),extent)
+
+########################################################################################################################################
+# Plots points binned to an image (see bin_points) :
+#   mode = image   : image shown with imshow and colorbar
+#   mode = surface : image (with at most 200 x 200 bins) plotted as a 3D surface
+#   outfile        : the plot is saved to this file with the Agg backend, otherwise it is shown
+########################################################################################################################################
+def plot_binned( x, y, z, vmin=0, vmax=20, n_bins=512, statistic="mean", mode="image", outfile=None ) :
+   (m,plt) = import_matplotlib( backend=( "Agg" if outfile is not None else None ) )
+   if mode == "surface" :
+      n_bins = min( n_bins, 200 )
+   (image,extent) = bin_points( x, y, z, n_bins=n_bins, statistic=statistic )
+   print("Binned %d points to an image of %d x %d pixels (%s)" % (len(z),n_bins,n_bins,statistic))
+   if statistic == "count" :
+      (vmin,vmax) = (None,None)
+
+   plt.clf()
+   if mode == "surface" :
+      from mpl_toolkits.mplot3d import Axes3D # registers 3d projection
+      x_centres = extent[0] + ( np.arange( 0, n_bins ) + 0.50 )*( extent[1] - extent[0] )/n_bins
+      y_centres = extent[2] + ( np.arange( 0, n_bins ) + 0.50 )*( extent[3] - extent[2] )/n_bins
+      (x_grid,y_grid) = np.meshgrid( x_centres, y_centres )
+      ax = plt.axes(projection='3d')
+      ax.plot_surface( x_grid, y_grid, np.ma.masked_invalid( image ), cmap='rainbow', vmin=vmin, vmax=vmax )
+   elif mode == "image" :
+      plt.imshow( image, origin="lower", extent=extent, aspect="auto", interpolation="nearest", cmap='rainbow', vmin=vmin, vmax=vmax )
+      plt.colorbar()
+      plt.grid( False )
+   else :
+      raise ValueError("Unknown plot mode %s (expected image or surface)" % (mode))
+   plt.xlabel('X pixel')
+   plt.ylabel('Y pixel')
+
+   show_or_save( plt, outfile )
+
+def show_or_save( plt, outfile=None ) :
+   if outfile is not None :
+      plt.savefig( outfile )
+      print("Plot saved to file %s" % (outfile))
+   else :
+      plt.show()
+
+########################################################################################################################################
+# Plots file with columns X Y VALUE (column plotcol) :
+#   mode    : scatter (every point), image or surface (binned points, see plot_binned) or auto (scatter for up to max_scatter_points
+#             points, image otherwise)
+#   outfile : the plot is saved to this file with the Agg backend (no display required) instead of being shown
+########################################################################################################################################
+def plot_scatter( filename , ncols=5, plotcol=2, vmin=0, vmax=20, verbose=0, mode="auto", n_bins=512, statistic="mean", max_scatter_points=DEFAULT_MAX_SCATTER_POINTS, outfile=None ) :
    (x_list,y_list,calconst_list) = read_text_file( filename , ncols=ncols, plotcol=plotcol, min_val=vmin, max_val=vmax, verbose=verbose )
+   if mode == "auto" :
+      mode = ( "scatter" if len(x_list) <= max_scatter_points else "image" )
+   if mode != "scatter" :
+      plot_binned( x_list, y_list, calconst_list, vmin=vmin, vmax=vmax, n_bins=n_bins, statistic=statistic, mode=mode, outfile=outfile )
+      return
+
+   (m,plt) = import_matplotlib( backend=( "Agg" if outfile is not None else None ) )
+   from mpl_toolkits.mplot3d import Axes3D # registers 3d projection
    # rng = np.random.RandomState(0)
    x = x_list # rng.randn(100)
    y = y_list # rng.randn(100)
@@ -93,8 +234,8 @@ def plot_scatter( filename , ncols=5, plotcol=2, vmin=0, vmax=20, verbose=0 ) :
    ax = plt.axes(projection='3d')
    ax.scatter3D( x, y, colors, c=colors, cmap='rainbow' , vmin=vmin, vmax=vmax );
    
-#   plt.colorbar();  # show color scale   
-   plt.show()
+#   plt.colorbar();  # show color scale
+   show_or_save( plt, outfile )
    
 
 if __name__ == '__main__':
@@ -104,7 +245,7 @@ if __name__ == '__main__':
       
    (options, args) = parse_options()   
       
-   plot_scatter( filename , ncols = options.ncols, plotcol=options.plotcol , vmin=options.vmin, vmax=options.vmax )   
+   plot_scatter( filename , ncols = options.ncols, plotcol=options.plotcol , vmin=options.vmin, vmax=options.vmax, mode=options.mode, n_bins=options.n_bins, statistic=options.statistic, max_scatter_points=options.max_scatter_points, outfile=options.outfile )   
       
       
 
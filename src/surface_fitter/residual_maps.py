@@ -0,0 +1,176 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Spatially binned statistics of the residuals (DATA - FIT) of the fit accumulated in a single pass over the data while the fitted
+# values are evaluated, so that quality of fits of 1e8+ points can be assessed without the per-point fitted_vs_data file :
+#
+#    maps = ResidualMaps( n_bins=64, extent=(0,8192,0,8192), n_points=len(z) )
+#    for every block of points :
+#       maps.add( x, y, z - fitted_values )
+#    maps.save( "residual_stats_order03.npz" )   # arrays count, mean, rms, median, mad of shape (n_bins,n_bins) - rows are Y
+#    maps.print_summary()                         # cells with the largest RMS of the residuals
+#
+# Count, mean and RMS are exact (sums accumulated with np.bincount), median and median absolute deviation (MAD) are calculated from a
+# uniform random subsample of the residuals (about MEDIAN_POINTS_PER_CELL per cell, as the median image of plot_scatter_3d.bin_points).
+# NaN residuals (masked pixels of gridded data) are skipped.
+#
+########################################################################################################################
+import numpy as np
+
+try :
+   from . import plot_scatter_3d
+except ImportError :
+   import plot_scatter_3d
+
+DEFAULT_N_BINS = 64
+
+# number of the worst cells printed in the summary and saved to the output file :
+DEFAULT_N_WORST = 10
+
+# cells with fewer points are not included in the list of the worst cells :
+DEFAULT_MIN_COUNT = 10
+
+# average number of residuals per cell kept for the median and MAD (at most plot_scatter_3d.MAX_MEDIAN_POINTS in total) :
+MEDIAN_POINTS_PER_CELL = 500
+
+STATISTICS = ["count","mean","rms","median","mad"]
+
+class ResidualMaps :
+   #####################################################################################################################################
+   #   n_bins            : number of cells along X and Y
+   #   extent            : (x_min,x_max,y_min,y_max) covered by the cells (points outside are counted in the edge cells)
+   #   n_points          : expected total number of points, used to sample residuals for the median and MAD uniformly
+   #   max_median_points : maximum number of residuals kept for the median and MAD (default MEDIAN_POINTS_PER_CELL per cell)
+   #####################################################################################################################################
+   def __init__( self, n_bins=DEFAULT_N_BINS, extent=(0,8192,0,8192), n_points=None, max_median_points=None, seed=0 ) :
+      if max_median_points is None :
+         max_median_points = min( plot_scatter_3d.MAX_MEDIAN_POINTS, MEDIAN_POINTS_PER_CELL*n_bins*n_bins )
+      self.n_bins = n_bins
+      self.extent = tuple( [ float(value) for value in extent ] )
+      (x_min,x_max,y_min,y_max) = self.extent
+      self.x_scale = n_bins / max( x_max - x_min, 1e-300 )
+      self.y_scale = n_bins / max( y_max - y_min, 1e-300 )
+
+      n_cells = n_bins*n_bins
+      self.counts = np.zeros( n_cells, dtype=np.int64 )
+      self.sums = np.zeros( n_cells )
+      self.sums2 = np.zeros( n_cells )
+      self.n_points = 0
+
+      self.median_fraction = 1.00
+      if n_points is not None and n_points > max_median_points :
+         self.median_fraction = float(max_median_points) / n_points
+      self.rng = np.random.default_rng( seed )
+      self.sample_index = []
+      self.sample_values = []
+      self.maps = None
+
+   def get_cell_index( self, x, y ) :
+      (x_min,x_max,y_min,y_max) = self.extent
+      ix = np.clip( ( ( np.asarray( x, dtype=np.float64 ) - x_min ) * self.x_scale ).astype( np.intp ), 0, self.n_bins-1 )
+      iy = np.clip( ( ( np.asarray( y, dtype=np.float64 ) - y_min ) * self.y_scale ).astype( np.intp ), 0, self.n_bins-1 )
+
+      return iy*self.n_bins + ix
+
+   #####################################################################################################################################
+   # Adds residuals of points at pixel coordinates (x,y) to the statistics
+   #####################################################################################################################################
+   def add( self, x, y, residuals ) :
+      residuals = np.asarray( residuals, dtype=np.float64 )
+      index = self.get_cell_index( x, y )
+      valid = np.isfinite( residuals )
+      if not np.all( valid ) :
+         (index,residuals) = (index[valid],residuals[valid])
+
+      n_cells = self.n_bins*self.n_bins
+      self.counts += np.bincount( index, minlength=n_cells )
+      self.sums += np.bincount( index, weights=residuals, minlength=n_cells )
+      self.sums2 += np.bincount( index, weights=residuals*residuals, minlength=n_cells )
+      self.n_points += len(residuals)
+
+      if self.median_fraction < 1.00 :
+         selected = ( self.rng.random( len(residuals) ) < self.median_fraction )
+         (index,residuals) = (index[selected],residuals[selected])
+      self.sample_index.append( index )
+      self.sample_values.append( residuals )
+      self.maps = None
+
+      return self
+
+   #####################################################################################################################################
+   # RETURNS dictionary of maps count, mean, rms, median and mad of shape (n_bins,n_bins) (rows correspond to Y, NaN in empty cells)
+   #####################################################################################################################################
+   def get_maps( self ) :
+      if self.maps is not None :
+         return self.maps
+
+      n_cells = self.n_bins*self.n_bins
+      filled = ( self.counts > 0 )
+      mean = np.full( n_cells, np.nan )
+      np.divide( self.sums, self.counts, out=mean, where=filled )
+      rms = np.full( n_cells, np.nan )
+      np.divide( self.sums2, self.counts, out=rms, where=filled )
+      rms = np.sqrt( rms )
+
+      median = np.full( n_cells, np.nan )
+      mad = np.full( n_cells, np.nan )
+      if len(self.sample_values) > 0 :
+         index = np.concatenate( self.sample_index )
+         values = np.concatenate( self.sample_values )
+         self.sample_index = [index]
+         self.sample_values = [values]
+         if len(values) > 0 :
+            median = plot_scatter_3d.calc_pixel_medians( index, values, n_cells )
+            mad = plot_scatter_3d.calc_pixel_medians( index, np.abs( values - median[index] ), n_cells )
+
+      shape = (self.n_bins,self.n_bins)
+      self.maps = { "count" : self.counts.reshape( shape ), "mean" : mean.reshape( shape ), "rms" : rms.reshape( shape ),
+                    "median" : median.reshape( shape ), "mad" : mad.reshape( shape ) }
+      return self.maps
+
+   #####################################################################################################################################
+   # RETURNS RMS of all the residuals
+   #####################################################################################################################################
+   def get_total_rms( self ) :
+      return np.sqrt( np.sum( self.sums2 ) / max( 1, self.n_points ) )
+
+   #####################################################################################################################################
+   # RETURNS structured array of up to n_worst cells with at least min_count points sorted by decreasing RMS of the residuals with
+   # fields ix, iy (cell), x_min, x_max, y_min, y_max (range in pixels) and the statistics
+   #####################################################################################################################################
+   def get_worst_cells( self, n_worst=DEFAULT_N_WORST, min_count=DEFAULT_MIN_COUNT ) :
+      maps = self.get_maps()
+      rms = np.where( maps["count"] >= min_count, maps["rms"], np.nan ).ravel()
+      candidates = np.nonzero( np.isfinite( rms ) )[0]
+      worst = candidates[ np.argsort( -rms[candidates], kind="stable" )[0:n_worst] ]
+
+      (iy,ix) = np.divmod( worst, self.n_bins )
+      (x_min,x_max,y_min,y_max) = self.extent
+      (x_step,y_step) = (1.00/self.x_scale,1.00/self.y_scale)
+      cells = np.zeros( len(worst), dtype=[ ("ix",np.int64), ("iy",np.int64), ("x_min",np.float64), ("x_max",np.float64), ("y_min",np.float64), ("y_max",np.float64) ] + [ (name,np.float64) for name in STATISTICS ] )
+      (cells["ix"],cells["iy"]) = (ix,iy)
+      (cells["x_min"],cells["x_max"]) = (x_min + ix*x_step,x_min + (ix+1)*x_step)
+      (cells["y_min"],cells["y_max"]) = (y_min + iy*y_step,y_min + (iy+1)*y_step)
+      for name in STATISTICS :
+         cells[name] = maps[name].ravel()[worst]
+
+      return cells
+
+   #####################################################################################################################################
+   # Saves maps (arrays count, mean, rms, median, mad), extent and the worst cells to .npz file (np.load( filename ) to read them)
+   #####################################################################################################################################
+   def save( self, filename, n_worst=DEFAULT_N_WORST, min_count=DEFAULT_MIN_COUNT ) :
+      maps = self.get_maps()
+      np.savez( filename, extent=np.array( self.extent ), n_points=self.n_points, total_rms=self.get_total_rms(), worst_cells=self.get_worst_cells( n_worst=n_worst, min_count=min_count ), **maps )
+      print("Binned residual statistics (%d x %d cells) saved to file %s" % (self.n_bins,self.n_bins,filename))
+
+   #####################################################################################################################################
+   # Prints RMS of all the residuals and the cells with the largest RMS
+   #####################################################################################################################################
+   def print_summary( self, n_worst=DEFAULT_N_WORST, min_count=DEFAULT_MIN_COUNT ) :
+      maps = self.get_maps()
+      print("Residuals of %d points in %d x %d cells (%d non-empty) : RMS = %.8f , mean = %.8f" % (self.n_points,self.n_bins,self.n_bins,np.count_nonzero( maps["count"] ),self.get_total_rms(),np.sum( self.sums ) / max( 1, self.n_points )))
+      print("Cells with the largest RMS of the residuals (at least %d points) :" % (min_count))
+      print("#  IX  IY       X_RANGE          Y_RANGE       COUNT        MEAN          RMS         MEDIAN         MAD")
+      for cell in self.get_worst_cells( n_worst=n_worst, min_count=min_count ) :
+         print("%4d %4d  %7.1f-%-7.1f  %7.1f-%-7.1f  %8d  %12.6f %12.6f %12.6f %12.6f" % (cell["ix"],cell["iy"],cell["x_min"],cell["x_max"],cell["y_min"],cell["y_max"],cell["count"],cell["mean"],cell["rms"],cell["median"],cell["mad"]))
@@ -0,0 +1,206 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Robust fitting of the polynomial surface (outliers such as bad sources or RFI) :
+#    sigma_clip : iterative sigma clipping, points with |residual| > threshold*sigma are rejected (weight 0)
+#    huber      : IRLS with Huber weights w = min( 1 , threshold/|r| ) , r = residual/sigma
+#    tukey      : IRLS with Tukey biweight w = (1 - (r/threshold)^2)^2 for |r| < threshold, 0 otherwise
+# When only a small fraction of weights changes (sigma clipping rejects or re-admits few points) the normal equations are not rebuilt,
+# only points whose weights changed are used to update them :
+#    gram += X_c^T diag(w_new - w_old) X_c    rhs += X_c^T ( (w_new - w_old)*z_c )
+# so that an iteration costs O(n_changed*P^2) instead of O(N*P^2). The full design matrix is never stored, it is built only for the
+# points with changed weights. Sigma clipping also re-calculates residuals only for points close to the threshold (see fit_sigma_clip).
+# Huber and Tukey weights change for almost all the points in every iteration, so the weighted normal equations are rebuilt when
+# more than REBUILD_FRACTION of the weights changed, and IRLS stops when the relative change of the coefficients is below
+# coeff_tolerance (float weights practically never repeat exactly).
+# All the functions accept basis of the polynomial (monomial, legendre or chebyshev, see orthogonal_basis.py).
+#
+########################################################################################################################
+import numpy as np
+
+try :
+   from . import fit_engine
+except ImportError :
+   import fit_engine
+
+ROBUST_METHODS = ["sigma_clip","huber","tukey"]
+
+# consistency constant of the median absolute deviation for the Gaussian distribution :
+MAD_TO_SIGMA = 1.4826
+
+# normal equations are rebuilt (instead of updated) when more than this fraction of the weights changed :
+REBUILD_FRACTION = 0.25
+
+# IRLS stops when max|a_new - a| <= DEFAULT_COEFF_TOLERANCE * max|a_new| :
+DEFAULT_COEFF_TOLERANCE = 1e-06
+
+########################################################################################################################################
+# RETURNS scale (sigma) of the residuals : standard deviation of not rejected points for sigma clipping, MAD based estimate for IRLS
+########################################################################################################################################
+def calc_scale( residuals, weights, method ) :
+   if method == "sigma_clip" :
+      used = residuals[ weights > 0 ]
+      if len(used) <= 1 :
+         return 0.00
+      return np.std( used )
+
+   return MAD_TO_SIGMA*np.median( np.abs( residuals - np.median(residuals) ) )
+
+########################################################################################################################################
+# RETURNS weights of the points for the given residuals, scale (sigma) and threshold (in units of sigma)
+########################################################################################################################################
+def calc_weights( residuals, scale, method="sigma_clip", threshold=3.00 ) :
+   if scale <= 0 :
+      return np.ones( len(residuals) )
+
+   r = np.abs( residuals ) / scale
+   if method == "sigma_clip" :
+      return ( r <= threshold ).astype( np.float64 )
+
+   if method == "huber" :
+      return np.minimum( 1.00, threshold / np.maximum( r, np.finfo(float).tiny ) )
+
+   if method == "tukey" :
+      return np.where( r < threshold, (1.00 - (r/threshold)**2)**2, 0.00 )
+
+   print("ERROR : unknown robust fitting method %s, allowed are : %s" % (method,ROBUST_METHODS))
+   raise ValueError("Unknown robust fitting method %s" % (method))
+
+########################################################################################################################################
+# Updates (in place) normal equations gram, rhs with points whose weights changed by delta_w (negative delta_w removes the points)
+########################################################################################################################################
+def update_normal_equations( gram, rhs, x, y, z, indexes, delta_w, n, basis="monomial" ) :
+   design_changed = fit_engine.calc_design_matrix( x[indexes], y[indexes], n, basis=basis )
+   gram += np.dot( design_changed.T, delta_w[:,None]*design_changed )
+   rhs  += np.dot( design_changed.T, delta_w*z[indexes] )
+
+########################################################################################################################################
+# Iterative sigma clipping with lazily updated residuals.
+# Residuals r_ref are calculated for all the points only for coefficients a_ref. Since |B_p(x) B_q(y)| <= mono_max = B_p(r_x) * B_q(r_y)
+# for |x| <= r_x, |y| <= r_y (r >= 1, for monomials r^p, Legendre and Chebyshev polynomials are bounded by their value at r) the residual for the current coefficients a differs from r_ref by at most delta = Sum |a - a_ref|*mono_max, so only points with
+# | |r_ref| - threshold*sigma | <= delta can change their status and their residuals are re-calculated. Sigma is obtained from the
+# weighted normal equations : sigma^2 = ( Sum w z^2 - 2 a^T rhs + a^T gram a ) / n_used (mean residual of the fit is 0).
+# Residuals of all the points are re-calculated when more than refresh_fraction of points are candidates.
+########################################################################################################################################
+def fit_sigma_clip( x, y, z, n, gram, rhs, a, threshold=3.00, n_iter=10, solver="cholesky", refresh_fraction=0.05, verbose=0, basis="monomial" ) :
+   len_data = len(z)
+   weights = np.ones( len_data )
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   x_bound = np.array( fit_engine.calc_basis_powers( np.array( [ max( 1.00, np.max(np.abs(x)) ) ] ), n, basis=basis ) )[:,0]
+   y_bound = np.array( fit_engine.calc_basis_powers( np.array( [ max( 1.00, np.max(np.abs(y)) ) ] ), n, basis=basis ) )[:,0]
+   mono_max = np.abs( x_bound[p_exp] * y_bound[q_exp] )
+
+   sum_wz2 = np.dot( z, z )
+   n_used = len_data
+   a_ref = a.copy()
+   abs_r_ref = np.abs( z - fit_engine.calc_poly_values( x, y, a, n, basis=basis ) )
+   chi2 = np.dot( abs_r_ref, abs_r_ref )
+   chi2_list = [ chi2 ]
+   print("Robust fit (sigma_clip, threshold = %.2f sigma) : iteration 0 , chi2 = %.8f" % (threshold,chi2))
+
+   iteration = 0
+   for iteration in range(1,n_iter+1) :
+      scale = np.sqrt( max( chi2, 0.00 ) / max( n_used, 1 ) )
+      limit = threshold*scale
+      delta = np.sum( np.abs( a - a_ref ) * mono_max )
+
+      new_weights = ( abs_r_ref <= limit )
+      if delta > 0 :
+         candidates = np.nonzero( np.abs( abs_r_ref - limit ) <= delta )[0]
+         if len(candidates) > refresh_fraction*len_data :
+            a_ref = a.copy()
+            abs_r_ref = np.abs( z - fit_engine.calc_poly_values( x, y, a, n, basis=basis ) )
+            new_weights = ( abs_r_ref <= limit )
+            if verbose > 0 :
+               print("DEBUG : residuals of all %d points re-calculated (%d candidates)" % (len_data,len(candidates)))
+         else :
+            r_candidates = z[candidates] - fit_engine.calc_poly_values( x[candidates], y[candidates], a, n, basis=basis )
+            new_weights[candidates] = ( np.abs( r_candidates ) <= limit )
+            if verbose > 0 :
+               print("DEBUG : residuals of %d candidate points re-calculated" % (len(candidates)))
+      new_weights = new_weights.astype( np.float64 )
+
+      changed = np.nonzero( new_weights != weights )[0]
+      if len(changed) <= 0 :
+         print("Robust fit converged after %d iterations" % (iteration-1))
+         iteration -= 1
+         break
+
+      delta_w = new_weights[changed] - weights[changed]
+      update_normal_equations( gram, rhs, x, y, z, changed, delta_w, n, basis=basis )
+      sum_wz2 += np.dot( delta_w, z[changed]**2 )
+      n_used += int( np.sum( delta_w ) )
+      weights = new_weights
+
+      a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+      chi2 = sum_wz2 - 2.00*np.dot( a, rhs ) + np.dot( a, np.dot( gram, a ) )
+      if chi2 <= 1e-10*sum_wz2 :
+         # chi2 from the normal equations is dominated by round-off errors -> calculate from the residuals :
+         a_ref = a.copy()
+         abs_r_ref = np.abs( z - fit_engine.calc_poly_values( x, y, a, n, basis=basis ) )
+         chi2 = np.dot( weights, abs_r_ref**2 )
+      chi2_list.append( chi2 )
+      print("Robust fit (sigma_clip) : iteration %d , sigma = %.8f , %d weights changed , %d points rejected , chi2 = %.8f" % (iteration,scale,len(changed),len_data-n_used,chi2))
+
+   return { "a" : a, "mask" : (weights > 0), "weights" : weights, "chi2" : chi2_list, "gram" : gram, "rhs" : rhs, "n_iter" : iteration }
+
+########################################################################################################################################
+# Robust fit of polynomial of order n to normalised coordinates x,y and values z
+#   method    : sigma_clip, huber or tukey
+#   threshold : in units of sigma of the residuals
+#   n_iter    : maximum number of iterations (stops earlier when weights do not change)
+#   coeff_tolerance : IRLS (huber, tukey) stops when the relative change of the coefficients is below this value
+#   basis     : monomial, legendre or chebyshev
+# RETURNS : dictionary with keys :
+#   a (coefficients), mask (True for points used in the final fit), weights, chi2 (list of weighted chi2 of every iteration),
+#   gram, rhs (final weighted normal equations), n_iter (number of iterations done)
+########################################################################################################################################
+def fit_robust( x, y, z, n, method="sigma_clip", threshold=3.00, n_iter=10, solver="cholesky", coeff_tolerance=DEFAULT_COEFF_TOLERANCE, verbose=0, basis="monomial" ) :
+   if method not in ROBUST_METHODS :
+      print("ERROR : unknown robust fitting method %s, allowed are : %s" % (method,ROBUST_METHODS))
+      raise ValueError("Unknown robust fitting method %s" % (method))
+
+   x = np.asarray( x, dtype=np.float64 )
+   y = np.asarray( y, dtype=np.float64 )
+   z = np.asarray( z, dtype=np.float64 )
+   (gram,rhs) = fit_engine.calc_normal_equations( x, y, z, n, basis=basis )
+   a = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+
+   if method == "sigma_clip" :
+      return fit_sigma_clip( x, y, z, n, gram, rhs, a, threshold=threshold, n_iter=n_iter, solver=solver, verbose=verbose, basis=basis )
+
+   # IRLS (scale from the median absolute deviation requires residuals of all the points in every iteration) :
+   weights = np.ones( len(z) )
+   residuals = z - fit_engine.calc_poly_values( x, y, a, n, basis=basis )
+   chi2_list = [ np.dot( weights, residuals**2 ) ]
+   print("Robust fit (%s, threshold = %.2f sigma) : iteration 0 , chi2 = %.8f" % (method,threshold,chi2_list[0]))
+
+   iteration = 0
+   for iteration in range(1,n_iter+1) :
+      scale = calc_scale( residuals, weights, method )
+      new_weights = calc_weights( residuals, scale, method=method, threshold=threshold )
+
+      changed = np.nonzero( new_weights != weights )[0]
+      if len(changed) <= 0 :
+         print("Robust fit converged after %d iterations" % (iteration-1))
+         iteration -= 1
+         break
+
+      if len(changed) > REBUILD_FRACTION*len(z) :
+         (gram,rhs) = fit_engine.calc_normal_equations( x, y, z, n, weights=new_weights, basis=basis )
+      else :
+         # update (downdate) normal equations using only points with changed weights :
+         update_normal_equations( gram, rhs, x, y, z, changed, new_weights[changed] - weights[changed], n, basis=basis )
+      weights = new_weights
+
+      a_new = fit_engine.solve_normal_equations( gram, rhs, solver=solver )
+      coeff_change = np.max( np.abs( a_new - a ) ) / max( np.max( np.abs( a_new ) ), np.finfo(float).tiny )
+      a = a_new
+      residuals = z - fit_engine.calc_poly_values( x, y, a, n, basis=basis )
+      chi2_list.append( np.dot( weights, residuals**2 ) )
+      print("Robust fit (%s) : iteration %d , sigma = %.8f , %d weights changed , %d points rejected , chi2 = %.8f" % (method,iteration,scale,len(changed),np.sum(weights <= 0),chi2_list[-1]))
+      if coeff_change <= coeff_tolerance :
+         print("Robust fit converged after %d iterations (relative change of the coefficients %.3e)" % (iteration,coeff_change))
+         break
+
+   return { "a" : a, "mask" : (weights > 0), "weights" : weights, "chi2" : chi2_list, "gram" : gram, "rhs" : rhs, "n_iter" : iteration }
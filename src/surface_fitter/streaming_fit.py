@@ -0,0 +1,161 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Streaming (out-of-core) version of the polynomial surface fit.
+# Only the normal equations, i.e. the (P x P) Gram matrix X^T X and the P-vector X^T z, are kept in memory, so the
+# memory used does not depend on the number of data points. Data are provided in chunks of (x,y,z) values :
+#
+#    fitter = StreamingFitter( polynomial_order=3, image_size=8192 )
+#    for chunk in read_text_chunks( "test.txt.gz", chunk_size=1000000 ) :
+#       fitter.partial_fit( chunk )
+#    (ok,coeff_list,a) = fitter.solve()
+#
+# Accumulators filled with separate parts of the data (e.g. different files or processes) can be combined with merge.
+#
+########################################################################################################################
+import gzip
+import itertools
+import numpy as np
+
+try :
+   from . import fit_engine
+except ImportError :
+   import fit_engine
+
+# number of lines read from a text file at once :
+DEFAULT_CHUNK_SIZE = 1000000
+
+########################################################################################################################################
+# RETURNS True if the file is gzip-compressed (recognised by the gzip magic bytes not the extension)
+########################################################################################################################################
+def is_gzip_file( filename ) :
+   with open(filename,'rb') as f :
+      magic = f.read(2)
+
+   return (magic == b'\x1f\x8b')
+
+########################################################################################################################################
+# Opens plain or gzip-compressed text file
+########################################################################################################################################
+def open_text_file( filename ) :
+   if is_gzip_file( filename ) :
+      return gzip.open(filename,'rt')
+
+   return open(filename,'r')
+
+########################################################################################################################################
+# Generator of chunks of data from a plain or gzip-compressed text file. Every chunk is a 2D array of shape (n_lines,len(columns))
+# with the required columns of at most chunk_size lines. Lines starting with # are skipped.
+########################################################################################################################################
+def read_text_chunks( filename, chunk_size=DEFAULT_CHUNK_SIZE, columns=(0,1,2), verbose=0 ) :
+   f = open_text_file( filename )
+   try :
+      while True :
+         lines = list( itertools.islice( f, chunk_size ) )
+         if len(lines) <= 0 :
+            break
+
+         chunk = np.loadtxt( lines, comments="#", usecols=columns, ndmin=2 )
+         if verbose > 0 :
+            print("DEBUG : read chunk of %d lines -> %d data points from file %s" % (len(lines),chunk.shape[0],filename))
+
+         if chunk.shape[0] > 0 :
+            yield chunk
+   finally :
+      f.close()
+
+########################################################################################################################################
+# Incremental accumulator of the normal equations of the least-squares polynomial fit
+#   x_c , y_c : centre of the image used to normalise coordinates to [-1,1] (x_c=y_c=image_size/2 by default)
+#   n_columns : number of value columns fitted at once (columns 2,3,... of a chunk), for n_columns > 1 the RHS and the coefficients
+#               have shape (n_params,n_columns)
+#   basis     : monomial (default), legendre or chebyshev (see orthogonal_basis.py)
+########################################################################################################################################
+class StreamingFitter :
+   def __init__( self, polynomial_order=7, image_size=8192, x_c=None, y_c=None, solver="cholesky", n_columns=1, basis="monomial" ) :
+      if x_c is None :
+         x_c = image_size / 2.00
+      if y_c is None :
+         y_c = image_size / 2.00
+
+      self.polynomial_order = polynomial_order
+      self.x_c = x_c
+      self.y_c = y_c
+      self.solver = solver
+      self.n_columns = n_columns
+      self.basis = basis
+      self.n_params = fit_engine.get_n_params( polynomial_order )
+
+      column_shape = ()
+      if n_columns > 1 :
+         column_shape = (n_columns,)
+      self.gram = np.zeros( (self.n_params,self.n_params) )
+      self.rhs  = np.zeros( (self.n_params,) + column_shape )
+      self.sum_z2 = np.zeros( column_shape )  # sum of z^2 required to calculate chi2 without the data
+      self.n_points = 0
+
+   #####################################################################################################################################
+   # Adds a chunk of data to the normal equations. The chunk can be a tuple (x,y,z) or 2D array with columns X Y Z (Z1 Z2 ...)
+   #####################################################################################################################################
+   def partial_fit( self, chunk ) :
+      if isinstance( chunk, tuple ) :
+         (x,y,z) = chunk
+      else :
+         chunk = np.asarray( chunk )
+         x = chunk[:,0]
+         y = chunk[:,1]
+         if self.n_columns > 1 :
+            z = chunk[:,2:2+self.n_columns]
+         else :
+            z = chunk[:,2]
+
+      x = ( np.asarray( x, dtype=np.float64 ) - self.x_c ) / self.x_c
+      y = ( np.asarray( y, dtype=np.float64 ) - self.y_c ) / self.y_c
+      z = np.asarray( z, dtype=np.float64 )
+
+      (gram,rhs) = fit_engine.calc_normal_equations( x, y, z, self.polynomial_order, basis=self.basis )
+      self.gram += gram
+      self.rhs  += rhs
+      self.sum_z2 += np.sum( z*z, axis=0 )
+      self.n_points += len(z)
+
+      return self
+
+   #####################################################################################################################################
+   # Adds normal equations accumulated by another fitter (has to be the same order, normalisation and basis)
+   #####################################################################################################################################
+   def merge( self, other ) :
+      if other.polynomial_order != self.polynomial_order or other.x_c != self.x_c or other.y_c != self.y_c or other.n_columns != self.n_columns or other.basis != self.basis :
+         print("ERROR : cannot merge fitters with different polynomial order, image centre or basis (%d,%.3f,%.3f,%s) != (%d,%.3f,%.3f,%s)" % (other.polynomial_order,other.x_c,other.y_c,other.basis,self.polynomial_order,self.x_c,self.y_c,self.basis))
+         raise ValueError("Cannot merge fitters with different polynomial order, image centre or basis")
+
+      self.gram += other.gram
+      self.rhs  += other.rhs
+      self.sum_z2 += other.sum_z2
+      self.n_points += other.n_points
+
+      return self
+
+   #####################################################################################################################################
+   # chi2 = Sum (z - Xa)^2 = z^T z - 2 a^T X^T z + a^T X^T X a , calculated from the accumulated sums only (one value per column)
+   #####################################################################################################################################
+   def calc_chi2( self, a ) :
+      return self.sum_z2 - 2.00*np.sum( a*self.rhs, axis=0 ) + np.sum( a*np.dot( self.gram, a ), axis=0 )
+
+   #####################################################################################################################################
+   # Solves the accumulated normal equations
+   # RETURNS : (ok,coeff_list,a) the same as fit_poly_base, for n_columns > 1 coeff_list is a list of coefficient lists (one per column),
+   #           coeff_list are always monomial coefficients and a coefficients in the basis
+   #####################################################################################################################################
+   def solve( self ) :
+      if self.n_points < self.n_params :
+         print("WARNING : only %d data points accumulated for %d parameters" % (self.n_points,self.n_params))
+
+      a = fit_engine.solve_normal_equations( self.gram, self.rhs, solver=self.solver )
+      ok = np.allclose( np.dot(self.gram, a), self.rhs )
+      if self.n_columns > 1 :
+         coeff_list = [ fit_engine.get_coeff_list( fit_engine.to_monomial( a[:,col], self.polynomial_order, basis=self.basis ), self.polynomial_order ) for col in range(0,self.n_columns) ]
+      else :
+         coeff_list = fit_engine.get_coeff_list( fit_engine.to_monomial( a, self.polynomial_order, basis=self.basis ), self.polynomial_order )
+
+      return (ok,coeff_list,a)
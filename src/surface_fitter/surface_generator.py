@@ -2,32 +2,165 @@ from __future__ import print_function
 ########################################################################################################################
 #
 # Developed by Marcin Sokolowski (marcin.sokolowski@curtin.edu.au) , version 1.00 , 2021-11
-# generates a test surface and prints 3 columns (X,Y,Z) to a text file 
+# generates a test surface and prints 3 columns (X,Y,Z) to a text file
 #
-######################################################################################################################## 
-import math
+# Points are generated in vectorised chunks of chunk_size points and streamed to the output file, so that the memory usage
+# does not depend on the number of points (tests with 1e7 - 1e9 points) :
+#
+#    python ./surface_generator.py                      # default 82 x 82 grid saved to test.txt (as template/test.txt)
+#    python ./surface_generator.py big.txt --sampling=random --n_points=10000000 --noise=0.01 --outlier_fraction=0.001 --seed=1
+#    python ./surface_generator.py big.npy --sampling=random --n_points=100000000 --order=5 --seed=1
+#
+# Output format is recognised by the extension : .txt (text X Y Z), .gz (gzip-compressed text) or .npy (binary array of
+# shape (3,n_points) read directly by fit_poly_3d.py and plot_scatter_3d.py).
+#
+########################################################################################################################
+import gzip
+import numpy as np
+from optparse import OptionParser
+
+try :
+   from . import fit_engine
+   from . import fitted_surface
+   from . import text_writer
+except ImportError :
+   import fit_engine
+   import fitted_surface
+   import text_writer
+
+# coefficients [a_pq,p,q] of the generated surface val = 2.0*xp**3 + 1.0*(xp**2)*(yp) + 3.0*(xp)*(yp**2) + 4*xp*yp + 3*xp + yp + 10
+# (format of fit_poly_3d.get_polynonial), used to check accuracy of the fits (see benchmark.py)
+GENERATOR_COEFF_LIST = [ [10.0,0,0], [1.0,0,1], [3.0,1,0], [4.0,1,1], [3.0,1,2], [1.0,2,1], [2.0,3,0] ]
+
+DEFAULT_CHUNK_SIZE = 1000000
+
+########################################################################################################################################
+# RETURNS list of [a_pq,p,q] of a polynomial of order n with random coefficients (uniform in -max_coeff,max_coeff)
+########################################################################################################################################
+def get_random_coeff_list( n, seed=None, max_coeff=10.00 ) :
+   rng = np.random.default_rng( seed )
+   (p_exp,q_exp) = fit_engine.get_exponents( n )
+   coeffs = rng.uniform( -max_coeff, max_coeff, len(p_exp) )
+
+   return [ [float(coeffs[m]),int(p_exp[m]),int(q_exp[m])] for m in range(0,len(p_exp)) ]
+
+########################################################################################################################################
+# Yields chunks (x,y) of positions in pixels :
+#   sampling = "grid"   : grid with step of step pixels (rows of constant Y as in the original generator), n_points ignored
+#   sampling = "random" : n_points positions uniformly distributed in the image, rounded to 4 decimal places (precision of the text
+#                         output, so that values correspond exactly to the saved positions)
+########################################################################################################################################
+def generate_positions( rng, size=8192, step=100, sampling="grid", n_points=0, chunk_size=DEFAULT_CHUNK_SIZE ) :
+   if sampling == "grid" :
+      axis = np.arange( 0, size, step, dtype=np.float64 )
+      rows_per_chunk = max( 1, chunk_size // len(axis) )
+      for start in range(0,len(axis),rows_per_chunk) :
+         y_rows = axis[start:start+rows_per_chunk]
+         yield (np.tile( axis, len(y_rows) ),np.repeat( y_rows, len(axis) ))
+   elif sampling == "random" :
+      for start in range(0,n_points,chunk_size) :
+         count = min( chunk_size, n_points - start )
+         x = np.round( rng.uniform( 0, size, count ), 4 )
+         y = np.round( rng.uniform( 0, size, count ), 4 )
+         yield (x,y)
+   else :
+      raise ValueError("Unknown sampling %s (expected grid or random)" % (sampling))
+
+########################################################################################################################################
+# Returns number of points which will be generated
+########################################################################################################################################
+def get_n_points( size=8192, step=100, sampling="grid", n_points=0 ) :
+   if sampling == "grid" :
+      return len( range(0,size,step) )**2
+
+   return n_points
 
+########################################################################################################################################
+# Generates points (X,Y,Z) of the polynomial surface coeff_list (list of [a_pq,p,q]) with optional noise and saves them to outfile
+#   noise_sigma      : standard deviation of the Gaussian noise added to all the values
+#   outlier_fraction : fraction of points with additional Gaussian noise of standard deviation outlier_sigma (outliers)
+#   seed             : seed of the random generator, the same seed and chunk_size give the same output
+#   chunk_size       : number of points generated and written at once (memory usage ~ 100 bytes per point of the chunk)
+# RETURNS : number of generated points
+########################################################################################################################################
+def generate_points( outfile, coeff_list=GENERATOR_COEFF_LIST, size=8192, step=100, sampling="grid", n_points=0, noise_sigma=0.00, outlier_fraction=0.00, outlier_sigma=10.00, seed=None, chunk_size=DEFAULT_CHUNK_SIZE, verbose=0 ) :
+   rng = np.random.default_rng( seed )
+   surface = fitted_surface.FittedSurface.from_coeff_list( coeff_list, size/2.00, size/2.00 )
+   total = get_n_points( size=size, step=step, sampling=sampling, n_points=n_points )
+
+   out_array = None
+   out_f = None
+   if outfile.endswith(".npy") :
+      out_array = np.lib.format.open_memmap( outfile, mode="w+", dtype=np.float64, shape=(3,total) )
+   elif outfile.endswith(".gz") :
+      out_f = gzip.open( outfile, "wb" )
+   else :
+      out_f = open( outfile, "w" )
+
+   start = 0
+   for (x,y) in generate_positions( rng, size=size, step=step, sampling=sampling, n_points=n_points, chunk_size=chunk_size ) :
+      z = surface( x, y )
+      if noise_sigma > 0 :
+         z += rng.normal( 0.00, noise_sigma, len(z) )
+      if outlier_fraction > 0 :
+         outliers = np.nonzero( rng.random( len(z) ) < outlier_fraction )[0]
+         z[outliers] += rng.normal( 0.00, outlier_sigma, len(outliers) )
+
+      if out_array is not None :
+         out_array[:,start:start+len(z)] = (x,y,z)
+      else :
+         text_writer.write_columns( out_f, [x,y,z], [4,4,8] )
+      start += len(z)
+      if verbose > 0 :
+         print("Progress : generated %d / %d points" % (start,total))
+
+   if out_array is not None :
+      out_array.flush()
+   else :
+      out_f.close()
+
+   return total
+
+########################################################################################################################################
+# Original generator : 82 x 82 grid (step 100 pixels) of the surface GENERATOR_COEFF_LIST without noise (template/test.txt)
+########################################################################################################################################
 def generate_data( outfile="test.txt" ) :
-   size = 8192
-   xc = float( size ) / 2.00
-   yc = float( size ) / 2.00
-
-   outf = open(outfile,"w")
-      
-   for y in range(0,size,100) :
-      for x in range(0,size,100) :
-         xp = float(x-xc)/xc
-         yp = float(y-yc)/yc
-         
-         val = 2.0*xp**3 + 1.0*(xp**2)*(yp) + 3.0*(xp)*(yp**2) + 4*xp*yp + 3*xp + yp + 10
-         line = "%.4f %.4f %.8f\n" % (x,y,val)
-         print("%.4f %.4f %.8f" % (x,y,val))
-         
-         outf.write(line)
-
-   outf.close()
+   generate_points( outfile )
    print("Generated test data and saved to file %s" % (outfile))
 
+def parse_options():
+   usage="Usage: %prog [OUTFILE] [options]\n"
+   usage+='\tGenerates points X Y Z of a polynomial surface and saves them to text (.txt, .gz) or binary (.npy) file [default test.txt]\n'
+   parser = OptionParser(usage=usage,version=1.00)
+   parser.add_option('--sampling',dest="sampling",default="grid", help="Positions of points : grid or random [default %default]",type="string")
+   parser.add_option('--n_points','--n',dest="n_points",default=1000000, help="Number of points for --sampling=random [default %default]",type="int")
+   parser.add_option('--step','--grid_step',dest="step",default=100, help="Step of the grid in pixels for --sampling=grid [default %default]",type="int")
+   parser.add_option('--image_size','--size',dest="image_size",default=8192, help="Image size [default %default]",type="int")
+   parser.add_option('--order','--poly_order','--polynomial_order',dest="polynomial_order",default=None, help="Polynomial order of a surface with random coefficients (printed) [default %default - surface GENERATOR_COEFF_LIST]",type="int")
+   parser.add_option('--coeffs','--coeff_list',dest="coeffs",default=None, help="Coefficients of the surface as a_pq,p,q;a_pq,p,q;... (e.g. 10,0,0;3,1,0) [default %default - surface GENERATOR_COEFF_LIST]",type="string")
+   parser.add_option('--noise','--noise_sigma',dest="noise_sigma",default=0.00, help="Standard deviation of the Gaussian noise [default %default]",type="float")
+   parser.add_option('--outlier_fraction',dest="outlier_fraction",default=0.00, help="Fraction of outliers [default %default]",type="float")
+   parser.add_option('--outlier_sigma',dest="outlier_sigma",default=10.00, help="Standard deviation of the Gaussian noise of outliers [default %default]",type="float")
+   parser.add_option('--seed',dest="seed",default=None, help="Seed of the random generator [default %default]",type="int")
+   parser.add_option('--chunk_size','--chunk',dest="chunk_size",default=DEFAULT_CHUNK_SIZE, help="Number of points generated and written at once [default %default]",type="int")
+   parser.add_option('--verb','--verbose','--debug_level',dest="verbose",default=0, help="Verbosity level [default %default]",type="int")
+
+   (options, args) = parser.parse_args()
+
+   return (options, args)
+
 if __name__ == '__main__':
-   generate_data( "test.txt" )
-   
\ No newline at end of file
+   (options, args) = parse_options()
+   outfile = "test.txt"
+   if len(args) > 0 :
+      outfile = args[0]
+
+   coeff_list = GENERATOR_COEFF_LIST
+   if options.coeffs is not None :
+      coeff_list = [ [float(a_pq),int(p),int(q)] for (a_pq,p,q) in [ term.split(",") for term in options.coeffs.split(";") ] ]
+   elif options.polynomial_order is not None :
+      coeff_list = get_random_coeff_list( options.polynomial_order, seed=options.seed )
+      print("Random coefficients [a_pq,p,q] : %s" % (coeff_list))
+
+   total = generate_points( outfile, coeff_list=coeff_list, size=options.image_size, step=options.step, sampling=options.sampling, n_points=options.n_points, noise_sigma=options.noise_sigma, outlier_fraction=options.outlier_fraction, outlier_sigma=options.outlier_sigma, seed=options.seed, chunk_size=options.chunk_size, verbose=options.verbose )
+   print("Generated %d points and saved to file %s" % (total,outfile))
@@ -0,0 +1,142 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Vectorised writer of numeric text columns (fitted_vs_data_orderNN.txt, fitted_orderNN.txt).
+# Formatting numbers one by one with the % operator costs ~0.5-1 us per number, which dominates writing files with
+# millions of lines. Here the columns are formatted with NumPy integer arithmetic :
+#    value -> round( value * 10^decimals ) as int64 -> groups of 4 digits (lookup table of ASCII digits) -> bytes
+# in blocks of block_rows lines. The output is identical to "%.<decimals>f" formatting, i.e. rounding half to even of the
+# exact binary value as in printf : the product p = value*10^decimals is rounded to the nearest double, so the rounding
+# to an integer can only be wrong when p is exactly a half-integer - for these values the sign of the rounding error of
+# the product (calculated exactly with the Dekker's two-product algorithm) decides. Blocks with non-finite or too large
+# values (|value|*10^decimals >= 2^52) are formatted with the % operator.
+#
+########################################################################################################################
+import io
+import numpy as np
+
+DEFAULT_BLOCK_ROWS = 1000000
+
+# half-integers are exactly representable below this limit :
+MAX_EXACT_VALUE = 2.00**52
+
+# ASCII digits of all the numbers 0000 - 9999 :
+DIGITS_TABLE = np.array( [ [ ord(c) for c in ("%04d" % i) ] for i in range(0,10000) ], dtype=np.uint8 )
+
+########################################################################################################################################
+# RETURNS rounding error of the product a*b (a*b = fl(a*b) + error exactly), Dekker's two-product algorithm
+########################################################################################################################################
+def calc_product_error( a, b ) :
+   p = a*b
+   c = 134217729.00*a # 2^27 + 1
+   a_hi = c - ( c - a )
+   a_lo = a - a_hi
+   c = 134217729.00*b
+   b_hi = c - ( c - b )
+   b_lo = b - b_hi
+
+   return ( ( a_hi*b_hi - p ) + a_hi*b_lo + a_lo*b_hi ) + a_lo*b_lo
+
+########################################################################################################################################
+# RETURNS integers round( x * 10^decimals ) (round half to even of the exact value of x) as int64 array, or None if some values are
+# not finite or too large to be formatted with integer arithmetic
+########################################################################################################################################
+def round_scaled( x, decimals ) :
+   scale = 10.00**decimals
+   v = x * scale
+   if not np.all( np.abs( v ) < MAX_EXACT_VALUE ) : # also False for NaN
+      return None
+
+   r = np.rint( v )
+   ties = np.nonzero( ( v - np.floor( v ) ) == 0.50 )[0]
+   if len(ties) > 0 :
+      # exact product is above the tie -> round up, below -> round down, exactly at the tie -> rint (half to even) :
+      error = calc_product_error( x[ties], np.full( len(ties), scale ) )
+      r[ties] = np.where( error > 0, np.floor( v[ties] ) + 1.00, np.where( error < 0, np.floor( v[ties] ), r[ties] ) )
+
+   return r.astype( np.int64 )
+
+########################################################################################################################################
+# Writes digits of non-negative integers values (n_digits digits, with leading zeros) to columns start:start+n_digits of out
+########################################################################################################################################
+def write_digits( out, start, values, n_digits ) :
+   end = start + n_digits
+   values = values.copy()
+   while end > start :
+      n_group = min( 4, end - start )
+      (values,group) = np.divmod( values, 10**n_group )
+      out[:,end-n_group:end] = DIGITS_TABLE[ group, 4-n_group: ]
+      end -= n_group
+
+########################################################################################################################################
+# Formats column x as "%.<decimals>f" into a byte matrix of shape (len(x),width) right-aligned with zero bytes as padding
+# RETURNS : byte matrix or None if the column cannot be formatted with integer arithmetic (see round_scaled)
+########################################################################################################################################
+def format_column( x, decimals ) :
+   x = np.asarray( x, dtype=np.float64 )
+   r = round_scaled( x, decimals )
+   if r is None :
+      return None
+
+   negative = np.signbit( x ) # printf writes also -0.000
+   r = np.abs( r )
+   (int_part,frac_part) = np.divmod( r, 10**decimals )
+
+   max_int = int( np.max( int_part ) ) if len(int_part) > 0 else 0
+   n_int_digits = len( "%d" % max_int )
+   frac_width = ( decimals + 1 if decimals > 0 else 0 )
+   width = 1 + n_int_digits + frac_width
+   out = np.zeros( (len(x),width), dtype=np.uint8 )
+
+   if decimals > 0 :
+      out[:,width-frac_width] = ord(".")
+      write_digits( out, width-decimals, frac_part, decimals )
+   write_digits( out, 1, int_part, n_int_digits )
+
+   # leading zeros of the integer part are replaced by padding, minus sign is written before the first digit :
+   n_digits = np.ones( len(x), dtype=np.int64 )
+   for j in range(1,n_int_digits) :
+      shorter = ( int_part < 10**j )
+      out[shorter,n_int_digits-j] = 0
+      n_digits += ~shorter
+   rows = np.nonzero( negative )[0]
+   out[ rows, n_int_digits - n_digits[rows] ] = ord("-")
+
+   return out
+
+########################################################################################################################################
+# RETURNS bytes of lines with columns (list of 1D arrays of the same length) formatted with the given numbers of decimal places,
+# separated by single spaces
+########################################################################################################################################
+def format_columns( columns, decimals ) :
+   parts = []
+   for (x,d) in zip( columns, decimals ) :
+      formatted = format_column( x, d )
+      if formatted is None :
+         # fall back to the standard formatting :
+         line_format = " ".join( [ ("%%.%df" % d) for d in decimals ] ) + "\n"
+         rows = np.column_stack( [ np.asarray( c, dtype=np.float64 ) for c in columns ] )
+         return ( ( line_format*len(rows) ) % tuple( rows.ravel().tolist() ) ).encode()
+      parts.append( formatted )
+      parts.append( np.full( (len(x),1), ord(" "), dtype=np.uint8 ) )
+   parts[-1] = np.full( (len(columns[0]),1), ord("\n"), dtype=np.uint8 )
+
+   buf = np.hstack( parts ).ravel()
+
+   return buf[ buf != 0 ].tobytes()
+
+########################################################################################################################################
+# Writes columns (list of 1D arrays) to an opened text file in blocks of block_rows lines
+#   decimals : number of decimal places of every column (0 - integer values without decimal point, "%.0f")
+########################################################################################################################################
+def write_columns( out_f, columns, decimals, block_rows=DEFAULT_BLOCK_ROWS ) :
+   n_rows = len(columns[0])
+   binary = not isinstance( out_f, io.TextIOBase ) # e.g. files opened with "wb" or gzip.open
+
+   for start in range(0,n_rows,block_rows) :
+      end = min( start + block_rows, n_rows )
+      block = format_columns( [ c[start:end] for c in columns ], decimals )
+      if binary :
+         out_f.write( block )
+      else :
+         out_f.write( block.decode() )
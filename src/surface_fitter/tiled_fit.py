@@ -0,0 +1,359 @@
+from __future__ import print_function
+########################################################################################################################
+#
+# Tiled local-polynomial fit : the image of size x size pixels is divided into n_tiles x n_tiles tiles, every tile is extended
+# by overlap*tile_size pixels on each side and a low-order polynomial is fitted to the points in the extended tile with
+# fit_poly_3d.fit_poly_base (tiles are fitted in parallel by a pool of processes). The tiles are blended with the
+# partition-of-unity weights :
+#    value(x,y) = Sum_t w_t(x,y) * p_t(x,y) / Sum_t w_t(x,y) ,  w_t(x,y) = cos^2(pi/2 * (x-x_t)/h) * cos^2(pi/2 * (y-y_t)/h)
+# where (x_t,y_t) is the centre of the tile and h = (0.5 + overlap)*tile_size half-width of the extended tile, so that the
+# weights and the blended surface are smooth (continuous first derivatives) and a point is covered by at most 2 x 2 tiles
+# (0 < overlap <= 0.5, with overlap = 0 the weights would vanish on the tile edges) :
+#
+#    mosaic = fit_tiles( x, y, z, size=8192, n_tiles=8, polynomial_order=3, workers=8 )
+#    values = mosaic( x, y )
+#    mosaic.evaluate_map( outfile="map.npy", step=1 )   # full resolution map streamed to a memory-mapped .npy file
+#    mosaic.save( "mosaic.npz" ) ; mosaic = MosaicSurface.load( "mosaic.npz" )
+#
+########################################################################################################################
+import contextlib
+import io
+import json
+import os
+import numpy as np
+
+try :
+   from . import fit_engine
+   from . import fitted_surface
+   from . import grid_eval
+except ImportError :
+   import fit_engine
+   import fitted_surface
+   import grid_eval
+
+DEFAULT_N_TILES = 8
+DEFAULT_OVERLAP = 0.25
+DEFAULT_TILE_ORDER = 3
+
+# minimum number of points in a tile per fitted parameter (tiles with fewer points are not fitted) :
+MIN_POINTS_PER_PARAM = 2
+
+# arrays (x,y,z,order,offsets) shared with forked workers (see sort_by_tile) :
+_shared_arrays = None
+
+class MosaicSurface :
+   #####################################################################################################################################
+   #   tiles : list of n_tiles*n_tiles FittedSurface objects (in pixel coordinates) or None for tiles which were not fitted, tile
+   #           (tile_x,tile_y) has index tile_x*n_tiles + tile_y
+   #####################################################################################################################################
+   def __init__( self, tiles, size=8192, n_tiles=DEFAULT_N_TILES, overlap=DEFAULT_OVERLAP ) :
+      if overlap <= 0 or overlap > 0.50 :
+         # weights of all the tiles are zero on the edges of tiles without overlap :
+         print("ERROR : overlap of tiles %.3f outside the allowed range (0,0.5]" % (overlap))
+         raise ValueError("Overlap of tiles %.3f outside the range (0,0.5]" % (overlap))
+      if len(tiles) != n_tiles*n_tiles :
+         print("ERROR : %d tiles provided for a mosaic of %d x %d tiles" % (len(tiles),n_tiles,n_tiles))
+         raise ValueError("Number of tiles %d does not match %d x %d" % (len(tiles),n_tiles,n_tiles))
+
+      self.tiles = list( tiles )
+      self.size = float(size)
+      self.n_tiles = int(n_tiles)
+      self.overlap = float(overlap)
+      self.tile_size = self.size / self.n_tiles
+      self.half_width = ( 0.50 + self.overlap ) * self.tile_size
+
+      # statistics of the stages of the fit (fit_stats.FitStats), set by fit_poly_tiles :
+      self.stats = None
+
+   #####################################################################################################################################
+   # RETURNS range (start,end) of pixel coordinates of the extended tile tile_index (along one axis)
+   #####################################################################################################################################
+   def get_tile_range( self, tile_index ) :
+      centre = ( tile_index + 0.50 ) * self.tile_size
+
+      return (centre - self.half_width,centre + self.half_width)
+
+   #####################################################################################################################################
+   # RETURNS index of the tile containing coordinates x (along one axis), points outside the image belong to the border tiles
+   #####################################################################################################################################
+   def get_tile_index( self, x ) :
+      return np.clip( np.floor( np.asarray( x, dtype=np.float64 ) / self.tile_size ), 0, self.n_tiles-1 ).astype(np.int64)
+
+   #####################################################################################################################################
+   # RETURNS blending weights cos^2(pi/2 * (x-x_t)/h) of coordinates x (along one axis) for tiles tile_index (scalar or array)
+   #####################################################################################################################################
+   def calc_weights( self, x, tile_index ) :
+      t = ( np.asarray( x, dtype=np.float64 ) - ( tile_index + 0.50 )*self.tile_size ) / self.half_width
+      weights = np.cos( ( np.pi / 2.00 ) * np.clip( t, -1.00, 1.00 ) )**2
+      weights[ np.abs( t ) >= 1.00 ] = 0.00
+
+      return weights
+
+   @property
+   def n_fitted( self ) :
+      return sum( [ 1 for tile in self.tiles if tile is not None ] )
+
+   #####################################################################################################################################
+   # Blended values at pixel coordinates x,y (arrays of any shape), NaN at points not covered by any fitted tile
+   #####################################################################################################################################
+   def __call__( self, x, y ) :
+      (x,y) = np.broadcast_arrays( np.asarray( x, dtype=np.float64 ), np.asarray( y, dtype=np.float64 ) )
+      x_flat = x.ravel()
+      y_flat = y.ravel()
+      numerator = np.zeros( len(x_flat) )
+      denominator = np.zeros( len(x_flat) )
+
+      (order,offsets) = sort_by_tile( self, x_flat, y_flat )
+      for tile_x in range(0,self.n_tiles) :
+         for tile_y in range(0,self.n_tiles) :
+            surface = self.tiles[tile_x*self.n_tiles + tile_y]
+            if surface is None :
+               continue
+            indexes = get_tile_candidates( self, order, offsets, tile_x, tile_y )
+            weights = self.calc_weights( x_flat[indexes], tile_x ) * self.calc_weights( y_flat[indexes], tile_y )
+            inside = weights > 0
+            (indexes,weights) = (indexes[inside],weights[inside])
+            numerator[indexes] += weights * surface( x_flat[indexes], y_flat[indexes] )
+            denominator[indexes] += weights
+
+      with np.errstate( invalid="ignore", divide="ignore" ) :
+         values = np.where( denominator > 0, numerator / denominator, np.nan )
+      if x.ndim == 0 :
+         return values[0]
+
+      return values.reshape( x.shape )
+
+   #####################################################################################################################################
+   # Blended values on the grid x_axis (columns) x y_axis (rows), every tile is evaluated only on its sub-grid (FittedSurface.evaluate_grid)
+   # RETURNS array of shape (len(y_axis),len(x_axis)), NaN at points not covered by any fitted tile
+   #####################################################################################################################################
+   def evaluate_grid( self, x_axis, y_axis ) :
+      x_axis = np.asarray( x_axis, dtype=np.float64 )
+      y_axis = np.asarray( y_axis, dtype=np.float64 )
+      numerator = np.zeros( (len(y_axis),len(x_axis)) )
+      denominator = np.zeros( numerator.shape )
+
+      for tile_x in range(0,self.n_tiles) :
+         x_weights = self.calc_weights( x_axis, tile_x )
+         columns = np.nonzero( x_weights > 0 )[0]
+         if len(columns) == 0 :
+            continue
+         (col_start,col_end) = (columns[0],columns[-1]+1)
+
+         for tile_y in range(0,self.n_tiles) :
+            surface = self.tiles[tile_x*self.n_tiles + tile_y]
+            if surface is None :
+               continue
+            y_weights = self.calc_weights( y_axis, tile_y )
+            rows = np.nonzero( y_weights > 0 )[0]
+            if len(rows) == 0 :
+               continue
+            (row_start,row_end) = (rows[0],rows[-1]+1)
+
+            weights = np.outer( y_weights[row_start:row_end], x_weights[col_start:col_end] )
+            numerator[row_start:row_end,col_start:col_end] += weights * surface.evaluate_grid( x_axis[col_start:col_end], y_axis[row_start:row_end] )
+            denominator[row_start:row_end,col_start:col_end] += weights
+
+      with np.errstate( invalid="ignore", divide="ignore" ) :
+         return np.where( denominator > 0, numerator / denominator, np.nan )
+
+   #####################################################################################################################################
+   # Evaluates the mosaic on a grid of pixels (as grid_eval.evaluate_grid), blocks of tile_rows rows are streamed to a memory-mapped
+   # .npy file outfile (when set), so that the full resolution map (step=1) does not have to fit in memory
+   # RETURNS : (x_axis,y_axis,values)
+   #####################################################################################################################################
+   def evaluate_map( self, outfile=None, step=1, region=None, tile_rows=grid_eval.DEFAULT_TILE_ROWS, threads=1, verbose=0 ) :
+      (x_axis,y_axis) = grid_eval.get_grid_axes( size=int(self.size), step=step, region=region )
+      shape = (len(y_axis),len(x_axis))
+
+      if outfile is not None :
+         values = np.lib.format.open_memmap( outfile, mode="w+", dtype=np.float64, shape=shape )
+      else :
+         values = np.empty( shape )
+
+      def eval_rows( start ) :
+         end = min( start + tile_rows, shape[0] )
+         values[start:end,:] = self.evaluate_grid( x_axis, y_axis[start:end] )
+         if verbose > 0 :
+            print("Progress y = %d" % (y_axis[start]))
+
+      starts = range(0,shape[0],tile_rows)
+      if threads > 1 :
+         from concurrent.futures import ThreadPoolExecutor # imported only when required (fast import of the package)
+         with ThreadPoolExecutor( max_workers=threads ) as pool :
+            list( pool.map( eval_rows, starts ) )
+      else :
+         for start in starts :
+            eval_rows( start )
+
+      if outfile is not None :
+         values.flush()
+         print("Mosaic surface on a grid of %d x %d pixels saved to file %s" % (shape[1],shape[0],outfile))
+
+      return (x_axis,y_axis,values)
+
+   #####################################################################################################################################
+   # RETURNS parameters of the mosaic as a dictionary (JSON serialisable), tiles which were not fitted are None
+   #####################################################################################################################################
+   def to_dict( self ) :
+      return { "format" : "surface_fitter.MosaicSurface", "size" : self.size, "n_tiles" : self.n_tiles, "overlap" : self.overlap,
+               "tiles" : [ ( tile.to_dict() if tile is not None else None ) for tile in self.tiles ] }
+
+   @classmethod
+   def from_dict( cls, params ) :
+      tiles = [ ( fitted_surface.FittedSurface.from_dict( tile ) if tile is not None else None ) for tile in params["tiles"] ]
+
+      return cls( tiles, size=params["size"], n_tiles=params["n_tiles"], overlap=params["overlap"] )
+
+   #####################################################################################################################################
+   # Saves mosaic to .npz (binary) or .json (text) file, format recognised by the extension. All the tiles have the same order and basis,
+   # in the .npz file coefficients are saved as array (n_tiles*n_tiles,n_params) with NaN rows for tiles which were not fitted
+   #####################################################################################################################################
+   def save( self, filename ) :
+      if filename.endswith(".json") :
+         with open(filename,"w") as out_f :
+            json.dump( self.to_dict(), out_f, indent=1 )
+      else :
+         fitted = [ tile for tile in self.tiles if tile is not None ]
+         n_params = len(fitted[0].coeffs) if len(fitted) > 0 else 0
+         coeffs = np.full( (len(self.tiles),n_params), np.nan )
+         centres = np.full( (len(self.tiles),2), np.nan )
+         scales = np.full( (len(self.tiles),2), np.nan )
+         for (index,tile) in enumerate( self.tiles ) :
+            if tile is not None :
+               coeffs[index] = tile.coeffs
+               centres[index] = (tile.x_c,tile.y_c)
+               scales[index] = (tile.x_scale,tile.y_scale)
+         p_exp = fitted[0].p_exp if len(fitted) > 0 else np.zeros( 0, dtype=int )
+         q_exp = fitted[0].q_exp if len(fitted) > 0 else np.zeros( 0, dtype=int )
+         basis = fitted[0].basis if len(fitted) > 0 else "monomial"
+         np.savez( filename, coeffs=coeffs, p=p_exp, q=q_exp, centres=centres, scales=scales, basis=basis, size=self.size, n_tiles=self.n_tiles, overlap=self.overlap )
+      print("Mosaic surface saved to file %s" % (filename))
+
+   #####################################################################################################################################
+   # Loads mosaic from .npz or .json file saved by save
+   #####################################################################################################################################
+   @classmethod
+   def load( cls, filename ) :
+      if filename.endswith(".json") :
+         with open(filename,"r") as in_f :
+            return cls.from_dict( json.load( in_f ) )
+
+      with np.load( filename ) as data :
+         tiles = []
+         for index in range(0,len(data["coeffs"])) :
+            if np.all( np.isfinite( data["coeffs"][index] ) ) :
+               tiles.append( fitted_surface.FittedSurface( data["coeffs"][index], data["p"], data["q"], data["centres"][index][0], data["centres"][index][1], x_scale=data["scales"][index][0], y_scale=data["scales"][index][1], basis=str( data["basis"] ) ) )
+            else :
+               tiles.append( None )
+         return cls( tiles, size=float( data["size"] ), n_tiles=int( data["n_tiles"] ), overlap=float( data["overlap"] ) )
+
+   def __repr__( self ) :
+      return ("MosaicSurface(size=%d, tiles=%d x %d, overlap=%.3f, fitted=%d)" % (self.size,self.n_tiles,self.n_tiles,self.overlap,self.n_fitted))
+
+########################################################################################################################################
+# Sorts points by the tile containing them (index tile_x*n_tiles + tile_y of the mosaic)
+# RETURNS : (order,offsets) - points of tile k are order[offsets[k]:offsets[k+1]]
+########################################################################################################################################
+def sort_by_tile( mosaic, x, y ) :
+   tile_index = mosaic.get_tile_index( x ) * mosaic.n_tiles + mosaic.get_tile_index( y )
+   order = np.argsort( tile_index, kind="stable" )
+   offsets = np.searchsorted( tile_index[order], np.arange( 0, mosaic.n_tiles*mosaic.n_tiles + 1 ) )
+
+   return (order,offsets)
+
+########################################################################################################################################
+# RETURNS indexes of the points in the tile (tile_x,tile_y) and its neighbours - the only points which can be inside the extended tile
+########################################################################################################################################
+def get_tile_candidates( mosaic, order, offsets, tile_x, tile_y ) :
+   segments = []
+   for neighbour_x in range(max(0,tile_x-1),min(mosaic.n_tiles,tile_x+2)) :
+      for neighbour_y in range(max(0,tile_y-1),min(mosaic.n_tiles,tile_y+2)) :
+         index = neighbour_x*mosaic.n_tiles + neighbour_y
+         segments.append( order[offsets[index]:offsets[index+1]] )
+
+   return np.sort( np.concatenate( segments ) )
+
+########################################################################################################################################
+# Worker function : fits polynomial to the points of the extended tile (tile_x,tile_y) with fit_poly_3d.fit_poly_base (coordinates
+# relative to the tile, output files are not saved and the output of the fit is printed only for verbose > 0)
+# RETURNS : (tile_x,tile_y,surface,n_points) , surface is FittedSurface in pixel coordinates or None when not enough points
+########################################################################################################################################
+def fit_tile( args ) :
+   try :
+      from . import fit_poly_3d
+   except ImportError :
+      import fit_poly_3d
+
+   (tile_x,tile_y,mosaic,polynomial_order,solver,basis,verbose,points) = args
+   if points is None :
+      (x,y,z,order,offsets) = _shared_arrays
+      indexes = get_tile_candidates( mosaic, order, offsets, tile_x, tile_y )
+      points = (x[indexes],y[indexes],z[indexes])
+   (x,y,z) = [ np.asarray( values, dtype=np.float64 ) for values in points ]
+
+   inside = ( mosaic.calc_weights( x, tile_x ) > 0 ) & ( mosaic.calc_weights( y, tile_y ) > 0 )
+   n_points = int( np.count_nonzero( inside ) )
+   if n_points < MIN_POINTS_PER_PARAM * fit_engine.get_n_params( polynomial_order ) :
+      return (tile_x,tile_y,None,n_points)
+
+   (x_start,x_end) = mosaic.get_tile_range( tile_x )
+   (y_start,y_end) = mosaic.get_tile_range( tile_y )
+   x_tile = x[inside] - x_start
+   y_tile = y[inside] - y_start
+
+   out = None if verbose > 0 else io.StringIO()
+   with ( contextlib.redirect_stdout( out ) if out is not None else contextlib.nullcontext() ) :
+      surface = fit_poly_3d.fit_poly_base( x_tile, y_tile, z[inside], image_size=2.00*mosaic.half_width, polynomial_order=polynomial_order, save_files=False, verbose=verbose, solver=solver, return_surface=True, basis=basis )
+
+   # the same polynomial in pixel coordinates (centre shifted by the start of the tile) :
+   surface = fitted_surface.FittedSurface( surface.coeffs, surface.p_exp, surface.q_exp, surface.x_c + x_start, surface.y_c + y_start, x_scale=surface.x_scale, y_scale=surface.y_scale, basis=surface.basis )
+
+   return (tile_x,tile_y,surface,n_points)
+
+########################################################################################################################################
+# Fits polynomials of order polynomial_order to overlapping tiles of the image (size x size pixels divided into n_tiles x n_tiles tiles)
+#   overlap : extension of every tile on each side in units of the tile size (0 < overlap <= 0.5)
+#   workers : number of processes fitting the tiles (default number of CPU cores), arrays are inherited by forked workers without copying
+#   solver, basis : as in fit_poly_base
+# RETURNS : MosaicSurface
+########################################################################################################################################
+def fit_tiles( x, y, z, size=8192, n_tiles=DEFAULT_N_TILES, overlap=DEFAULT_OVERLAP, polynomial_order=DEFAULT_TILE_ORDER, solver="cholesky", basis="monomial", workers=None, verbose=0 ) :
+   global _shared_arrays
+
+   if workers is None or workers <= 0 :
+      workers = os.cpu_count() or 1
+   mosaic = MosaicSurface( [None]*(n_tiles*n_tiles), size=size, n_tiles=n_tiles, overlap=overlap )
+   (order,offsets) = sort_by_tile( mosaic, x, y )
+   tasks = [ (tile_x,tile_y,mosaic,polynomial_order,solver,basis,verbose,None) for tile_x in range(0,n_tiles) for tile_y in range(0,n_tiles) ]
+   print("Fitting %d order polynomials to %d x %d tiles of %.1f pixels (overlap %.2f) using %d workers" % (polynomial_order,n_tiles,n_tiles,mosaic.tile_size,overlap,workers))
+
+   _shared_arrays = (x,y,z,order,offsets)
+   try :
+      if workers > 1 :
+         import multiprocessing
+         from concurrent.futures import ProcessPoolExecutor # imported only when required (fast import of the package)
+         if "fork" in multiprocessing.get_all_start_methods() :
+            with ProcessPoolExecutor( max_workers=workers, mp_context=multiprocessing.get_context("fork") ) as pool :
+               results = list( pool.map( fit_tile, tasks ) )
+         else :
+            # points of the tiles are sent to the workers :
+            for (index,task) in enumerate( tasks ) :
+               candidates = get_tile_candidates( mosaic, order, offsets, task[0], task[1] )
+               tasks[index] = task[:-1] + ((x[candidates],y[candidates],z[candidates]),)
+            with ProcessPoolExecutor( max_workers=workers ) as pool :
+               results = list( pool.map( fit_tile, tasks ) )
+      else :
+         results = [ fit_tile( task ) for task in tasks ]
+   finally :
+      _shared_arrays = None
+
+   tiles = [None]*(n_tiles*n_tiles)
+   for (tile_x,tile_y,surface,n_points) in results :
+      tiles[tile_x*n_tiles + tile_y] = surface
+      if surface is None :
+         print("WARNING : tile (%d,%d) has only %d points -> not fitted" % (tile_x,tile_y,n_points))
+      elif verbose > 0 :
+         print("Tile (%d,%d) : %d points fitted" % (tile_x,tile_y,n_points))
+
+   return MosaicSurface( tiles, size=size, n_tiles=n_tiles, overlap=overlap )
@@ -0,0 +1,160 @@
+########################################################################################################################
+#
+# Equivalence of the fitting modes : in-memory, streaming (chunk_size > 0), parallel (workers > 1), grid (separable
+# normal equations), cache of fits and the solvers must give the same coefficients to within round-off, and the fit
+# of template/test.txt must reproduce template/fitted_vs_data_order03.txt. Also edge cases of gridded data (NaN
+# values, masks, detection of the grid).
+#
+#    python -m pytest -q
+#
+########################################################################################################################
+import contextlib
+import io
+import os
+import shutil
+import numpy as np
+import pytest
+
+from surface_fitter import fit_poly_3d
+from surface_fitter import grid_fit
+
+TEMPLATE_DIR = os.path.join( os.path.dirname( os.path.abspath( fit_poly_3d.__file__ ) ), "template" )
+
+# coefficients of the same fit calculated in different ways agree to within round-off :
+RTOL = 1e-13
+ATOL = 1e-13
+
+########################################################################################################################################
+# RETURNS result of function func called with the output printed by the fitting code suppressed
+########################################################################################################################################
+def run_quiet( func, *args, **kwargs ) :
+   with contextlib.redirect_stdout( io.StringIO() ) :
+      return func( *args, **kwargs )
+
+def get_coeffs( result ) :
+   return np.asarray( result[2] )
+
+@pytest.fixture
+def template_file( tmp_path, monkeypatch ) :
+   # output files are written to the current directory :
+   monkeypatch.chdir( tmp_path )
+   shutil.copy( os.path.join( TEMPLATE_DIR, "test.txt" ), "test.txt" )
+
+   return "test.txt"
+
+@pytest.fixture
+def scattered_file( tmp_path, monkeypatch ) :
+   monkeypatch.chdir( tmp_path )
+   rng = np.random.default_rng( 5 )
+   (x,y) = (rng.random( 50000 )*8192,rng.random( 50000 )*8192)
+   z = 4.00 + 1e-4*x - 2e-4*y + 3e-9*x*y + rng.normal( 0.00, 0.01, len(x) )
+   np.savetxt( "scattered.txt", np.c_[x,y,z], fmt="%.6f" )
+
+   return "scattered.txt"
+
+########################################################################################################################################
+# Fit of the template data reproduces the template output (columns X Y FIT DATA DATA-FIT)
+########################################################################################################################################
+def test_template_reproduction( template_file ) :
+   run_quiet( fit_poly_3d.fit_poly, template_file, polynomial_order=3 )
+
+   expected = np.loadtxt( os.path.join( TEMPLATE_DIR, "fitted_vs_data_order03.txt" ) )
+   fitted = np.loadtxt( "fitted_vs_data_order03.txt" )
+   assert fitted.shape == expected.shape
+   # (values are written with 8 decimals) :
+   np.testing.assert_allclose( fitted, expected, rtol=0.00, atol=2e-8 )
+
+@pytest.mark.parametrize( "basis", ["monomial","legendre","chebyshev"] )
+@pytest.mark.parametrize( "data", ["template_file","scattered_file"] )
+def test_modes_agree( data, basis, request ) :
+   filename = request.getfixturevalue( data )
+   reference = get_coeffs( run_quiet( fit_poly_3d.fit_poly, filename, polynomial_order=3, save_files=False, basis=basis, detect_grid=False ) )
+
+   modes = { "grid"            : {},
+             "stream"          : { "chunk_size" : 7000 },
+             "parallel"        : { "workers" : 2 },
+             "stream_parallel" : { "chunk_size" : 7000, "workers" : 2 },
+             "lstsq"           : { "solver" : "lstsq", "detect_grid" : False },
+             "qr"              : { "solver" : "qr", "detect_grid" : False },
+             "no_npy_cache"    : { "use_cache" : False } }
+   for (name,kwargs) in modes.items() :
+      a = get_coeffs( run_quiet( fit_poly_3d.fit_poly, filename, polynomial_order=3, save_files=False, basis=basis, **kwargs ) )
+      np.testing.assert_allclose( a, reference, rtol=RTOL, atol=ATOL, err_msg=name )
+
+   # the second fit is served from the cache of fits without reading the data :
+   for i in range(0,2) :
+      result = run_quiet( fit_poly_3d.fit_poly, filename, polynomial_order=3, save_files=False, basis=basis, cache_dir="fit_cache" )
+      np.testing.assert_allclose( get_coeffs( result ), reference, rtol=RTOL, atol=ATOL, err_msg="cache %d" % (i) )
+   assert "read" not in result.stats.stages
+
+########################################################################################################################################
+# Gridded data with NaN values and masked pixels : all the solvers and fit_poly_grid give the fit of the valid points only
+########################################################################################################################################
+def get_masked_grid() :
+   rng = np.random.default_rng( 7 )
+   (x_axis,y_axis) = (np.arange( 0.00, 8192.00, 64.00 ),np.arange( 0.00, 8192.00, 96.00 ))
+   (x,y) = np.meshgrid( x_axis, y_axis )
+   z = 4.00 + 1e-4*x - 2e-4*y + 3e-9*x*y + rng.normal( 0.00, 0.01, x.shape )
+   mask = rng.random( x.shape ) > 0.10
+
+   return (x_axis,y_axis,x,y,z,mask)
+
+def test_masked_grid_solvers_agree() :
+   (x_axis,y_axis,x,y,z,mask) = get_masked_grid()
+   z_nan = np.where( mask, z, np.nan )
+   # shuffled points, so that the grid has to be detected :
+   order = np.random.default_rng( 1 ).permutation( z.size )
+   (x_list,y_list,z_list) = (np.ravel( x )[order],np.ravel( y )[order],np.ravel( z_nan )[order])
+   valid = np.isfinite( z_list )
+
+   reference = get_coeffs( run_quiet( fit_poly_3d.fit_poly_base, x_list[valid], y_list[valid], z_list[valid], polynomial_order=3, save_files=False, detect_grid=False ) )
+   for solver in ["cholesky","lstsq","qr"] :
+      a = get_coeffs( run_quiet( fit_poly_3d.fit_poly_base, x_list, y_list, z_list, polynomial_order=3, save_files=False, solver=solver ) )
+      np.testing.assert_allclose( a, reference, rtol=1e-12, atol=1e-12, err_msg=solver )
+
+   a = get_coeffs( run_quiet( fit_poly_3d.fit_poly_grid, z, x_axis=x_axis, y_axis=y_axis, mask=mask, polynomial_order=3, save_files=False ) )
+   np.testing.assert_allclose( a, reference, rtol=1e-12, atol=1e-12, err_msg="fit_poly_grid" )
+
+def test_masked_grid_diagnostics_finite() :
+   (x_axis,y_axis,x,y,z,mask) = get_masked_grid()
+   z_nan = np.where( mask, z, np.nan )
+
+   output = io.StringIO()
+   with contextlib.redirect_stdout( output ) :
+      fit_poly_3d.fit_poly_base( np.ravel( x ), np.ravel( y ), np.ravel( z_nan ), polynomial_order=3, save_files=False, diagnostics=True )
+   lines = [ line for line in output.getvalue().splitlines() if "dChi2/da" in line ]
+   assert len(lines) > 0
+   assert not any( [ "nan" in line.lower() for line in lines ] )
+
+def test_detect_grid() :
+   (x_axis,y_axis,x,y,z,mask) = get_masked_grid()
+   order = np.random.default_rng( 2 ).permutation( z.size )
+   (x_list,y_list) = (np.ravel( x )[order],np.ravel( y )[order])
+
+   # shuffled grid, also processed in small chunks :
+   for chunk_size in [grid_fit.DETECT_CHUNK_SIZE,1000] :
+      grid = grid_fit.detect_grid( x_list, y_list, chunk_size=chunk_size )
+      assert grid is not None
+      np.testing.assert_array_equal( grid[0], x_axis )
+      np.testing.assert_array_equal( grid[1], y_axis )
+
+   # missing nodes (up to 1 - min_fill) are allowed :
+   assert grid_fit.detect_grid( x_list[mask.ravel()[order]], y_list[mask.ravel()[order]] ) is not None
+   assert grid_fit.detect_grid( x_list[:z.size//3], y_list[:z.size//3] ) is None
+
+   # repeated node (after the sample used for the quick check) :
+   assert grid_fit.detect_grid( np.append( x_list, x_list[-1] ), np.append( y_list, y_list[-1] ), chunk_size=1000 ) is None
+
+   # scattered data :
+   rng = np.random.default_rng( 3 )
+   assert grid_fit.detect_grid( rng.random( 10000 )*8192, rng.random( 10000 )*8192 ) is None
+   assert grid_fit.detect_grid( np.zeros( 0 ), np.zeros( 0 ) ) is None
+
+def test_grid_image() :
+   (x_axis,y_axis,x,y,z,mask) = get_masked_grid()
+   order = np.random.default_rng( 4 ).permutation( z.size )
+   keep = mask.ravel()[order]
+   (x_list,y_list,z_list) = (np.ravel( x )[order][keep],np.ravel( y )[order][keep],np.ravel( z )[order][keep])
+
+   image = grid_fit.get_grid_image( x_list, y_list, z_list, x_axis, y_axis, chunk_size=1000 )
+   np.testing.assert_array_equal( image, np.where( mask, z, np.nan ) )